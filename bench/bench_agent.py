@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Drive the real poll loop against a fake BaseLinker and report throughput.
+
+Usage:
+    python3 bench/bench_agent.py [--orders 1000] [--latency 0.05] [--error-rate 0.01]
+    python3 bench/bench_agent.py --replay traffic.jsonl
+    python3 bench/bench_agent.py --accounts 50 --orders 100
+
+The fake ``connector.php`` and Messenger (see ``fake_baselinker.py``) run
+in a child process, so the peak RSS reported is the agent's own. Labels go
+to a printer that only counts them (``--print-delay`` seconds per job).
+Reports orders/sec, p50/p99 label latency (from the order becoming visible
+in ``getOrders`` to all of its labels printed), API calls per order and
+peak RSS.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bl_api_print_agent as bl
+import fake_baselinker
+
+
+class CountingBackend(bl.PrinterBackend):
+    """Counts jobs and bytes instead of printing."""
+
+    name = "bench"
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.jobs = 0
+        self.documents = 0
+        self.bytes = 0
+
+    def _send(self, documents, extension, title):
+        if self.delay:
+            time.sleep(self.delay)
+        self.jobs += 1
+        self.documents += len(documents)
+        self.bytes += sum(len(d) for d in documents)
+        return ""
+
+
+def serve(args, ready, stop):
+    server = fake_baselinker.make_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.put(server.url)
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+
+
+def start_fake(args):
+    ctx = multiprocessing.get_context("spawn")
+    ready, stop = ctx.Queue(), ctx.Event()
+    process = ctx.Process(target=serve, args=(args, ready, stop), daemon=True)
+    process.start()
+    return process, stop, ready.get(timeout=30)
+
+
+def fake_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats", timeout=30) as response:
+        return json.load(response)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def setup_agent(args, url):
+    tmp = tempfile.mkdtemp()
+    backend = CountingBackend(args.print_delay)
+    bl.configure(
+        DB_FILE=os.path.join(tmp, "bench.db"),
+        LOG_FILE=os.path.join(tmp, "agent.log"),
+        LOG_LEVEL=args.log_level,
+        BASE_URL=f"{url}/connector.php",
+        MESSENGER_URL=f"{url}/messenger",
+        API_TOKEN="shop0",
+        STATUS_ID=args.status_id,
+        API_RATE_LIMIT=args.rate_limit,
+        FETCH_WORKERS=args.workers,
+        ORDER_POLL_MODE=args.poll_mode,
+        NOTIFY_INTERVAL=0.05,
+        PRINTER_ROUTES="",
+        ENABLE_HTTP_SERVER=False,
+    )
+    if args.accounts > 1:
+        bl.printer = backend
+        agent = bl.AccountSet([
+            {"name": f"shop{n}", "api_token": f"shop{n}",
+             "db_file": os.path.join(tmp, f"shop{n}.db")}
+            for n in range(args.accounts)
+        ])
+    else:
+        agent = bl.Agent(printer=backend)
+    bl.setup_logging()
+    bl.is_quiet_time = lambda: False
+
+    printed_at = {}
+    notify_order = bl.notify_order
+
+    def timed_notify(data):
+        account = bl.current_account()
+        key = str(data.get("order_id"))
+        if account is not None:
+            key = f"{account.name}/{key}"
+        printed_at.setdefault(key, time.time())
+        notify_order(data)
+
+    bl.notify_order = timed_notify
+    return agent, backend, printed_at
+
+
+def notified(agent):
+    storages = [a.storage for a in getattr(agent, "accounts", [agent])]
+    return sum(s.count_order_states().get("notified", 0) for s in storages)
+
+
+def run(args, agent, expected):
+    """Poll until ``expected`` orders are printed (or the loop goes idle)."""
+    idle = 0
+    cycles = 0
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        stats = agent.run_once()
+        if isinstance(agent, bl.AccountSet):
+            found = sum(s["orders"] for s in stats.values() if s)
+        else:
+            found = stats["orders"]
+        cycles += 1
+        if expected and notified(agent) >= expected:
+            break
+        idle = 0 if found else idle + 1
+        if not expected and idle >= args.idle_cycles:
+            break
+        if not found:
+            time.sleep(args.interval)
+    for router in [a.router for a in getattr(agent, "accounts", [agent])]:
+        router.wait(args.timeout)
+    return cycles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_baselinker.add_arguments(parser)
+    parser.add_argument("--workers", type=int, default=bl.FETCH_WORKERS,
+                        help="label fetch threads")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="API calls per minute (0: unlimited)")
+    parser.add_argument("--print-delay", type=float, default=0.0,
+                        help="seconds the fake printer takes per job")
+    parser.add_argument("--poll-mode", default=bl.ORDER_POLL_MODE,
+                        choices=("full", "watermark", "journal"))
+    parser.add_argument("--interval", type=float, default=0.05,
+                        help="sleep after a cycle without new orders")
+    parser.add_argument("--idle-cycles", type=int, default=3,
+                        help="with --replay, stop after this many empty cycles")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    process, stop, url = start_fake(args)
+    try:
+        agent, backend, printed_at = setup_agent(args, url)
+        agent.start()
+        if isinstance(agent, bl.Agent):
+            with agent.activate():
+                agent.notifier.start()
+        expected = 0 if args.replay else args.orders * args.accounts
+        start = time.perf_counter()
+        cycles = run(args, agent, expected)
+        elapsed = time.perf_counter() - start
+        flush = agent.notifier.run_once if isinstance(agent, bl.Agent) else agent.notify_once
+        for _ in range(100):
+            if not flush():
+                break
+        stats = fake_stats(url)
+    finally:
+        stop.set()
+        process.join(5)
+
+    visible = stats["visible"]
+    latencies = [
+        printed_at[oid] - visible[oid] for oid in printed_at if oid in visible
+    ]
+    orders = len(printed_at)
+    calls = sum(stats["calls"].values())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+
+    print(f"orders printed:      {orders} in {elapsed:.2f}s ({cycles} cycles)")
+    print(f"orders/sec:          {orders / elapsed:.1f}" if elapsed else "orders/sec: -")
+    print(f"label latency p50:   {percentile(latencies, 0.5) * 1000:.1f} ms")
+    print(f"label latency p99:   {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"API calls:           {calls} ({calls / max(orders, 1):.2f} per order)")
+    for method, count in sorted(stats["calls"].items()):
+        failed = stats["errors"].get(method, 0)
+        print(f"  {method:<18} {count:>7} ({failed} injected errors)")
+    print(f"print jobs:          {backend.jobs} ({backend.documents} documents, "
+          f"{backend.bytes / 1024 / 1024:.1f} MiB)")
+    print(f"messages sent:       {stats['messages']}")
+    print(f"peak RSS:            {peak_rss / 1024:.1f} MiB"
+          + (f" ({peak_rss / 1024 / args.accounts:.1f} MiB per account)"
+             if args.accounts > 1 else ""))
+
+
+if __name__ == "__main__":
+    main()
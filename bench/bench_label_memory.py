@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Measure peak memory of turning a getLabel response into label bytes.
+
+Compares the old path (``response.json()``, ``b64decode``, temp file) with
+the streaming decoder used by ``get_label`` now.
+
+Usage: python3 bench/bench_label_memory.py [label_size_kb]
+"""
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bl_api_print_agent as bl
+
+
+def fake_response(body):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(body)
+    response.encoding = "utf-8"
+    return response
+
+
+def old_path(body):
+    data = fake_response(body).json()
+    label = base64.b64decode(data["label"])
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+        f.write(label)
+    return len(label)
+
+
+def new_path(body):
+    response = fake_response(body)
+    data = bl.read_streamed_field(response.iter_content(bl.LABEL_CHUNK_SIZE), "label")
+    return len(data["label"])
+
+
+def peak(func, body):
+    tracemalloc.start()
+    func(body)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_bytes
+
+
+def main():
+    size_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    label = os.urandom(size_kb * 1024)
+    body = json.dumps({
+        "status": "SUCCESS",
+        "label": base64.b64encode(label).decode(),
+        "extension": "pdf",
+    }).encode()
+    print(f"label size:          {size_kb} KiB ({len(body) // 1024} KiB response)")
+    for name, func in (("old (json + b64decode)", old_path), ("streaming decoder", new_path)):
+        print(f"{name:<22} peak {peak(func, body) / 1024:>10.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Compare the pooled ``Storage`` against the old connect-per-call helpers.
+
+Usage: python3 bench/bench_storage.py [iterations]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bl_api_print_agent as bl
+
+
+def legacy_setup(db):
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS printed_orders(order_id TEXT PRIMARY KEY, printed_at TEXT)"
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_mark_as_printed(db, order_id):
+    legacy_setup(db)
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
+        (order_id, datetime.now().isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_load_printed_orders(db):
+    legacy_setup(db)
+    conn = sqlite3.connect(db)
+    rows = conn.execute("SELECT order_id, printed_at FROM printed_orders").fetchall()
+    conn.close()
+    return {oid: datetime.fromisoformat(ts) for oid, ts in rows}
+
+
+def measure(label, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {iterations / elapsed:>12.0f} ops/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, "legacy.db")
+        measure(
+            "legacy mark_as_printed",
+            lambda i: legacy_mark_as_printed(legacy_db, f"o{i}"),
+            iterations,
+        )
+        measure(
+            "legacy load_printed_orders",
+            lambda i: legacy_load_printed_orders(legacy_db),
+            max(iterations // 10, 1),
+        )
+
+        storage = bl.Storage(os.path.join(tmp, "pooled.db"))
+        measure(
+            "Storage.mark_as_printed",
+            lambda i: storage.mark_as_printed(f"o{i}"),
+            iterations,
+        )
+        measure(
+            "Storage.load_printed_orders",
+            lambda i: storage.load_printed_orders(),
+            max(iterations // 10, 1),
+        )
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""Fake BaseLinker ``connector.php`` and Messenger endpoint for offline runs.
+
+Serves a synthetic shop (``--orders`` orders with ``--packages`` labels
+each, released at ``--arrival-rate`` orders per second), or ``--accounts``
+such shops told apart by API token (``shop0``, ``shop1``…), with injectable
+latency and errors, or replays traffic recorded from production. Point the
+agent at it with ``BL_API_URL`` and ``MESSENGER_URL``.
+
+Usage:
+    python3 bench/fake_baselinker.py [--port 8090] [--orders 1000]
+    python3 bench/fake_baselinker.py --record traffic.jsonl --upstream URL
+    python3 bench/fake_baselinker.py --replay traffic.jsonl
+
+Recording proxies every call to ``--upstream`` (the real API) and appends
+``{"method", "parameters", "status", "elapsed", "response"}`` lines to the
+file; replaying serves those responses back. ``GET /_stats`` returns call
+counts and when every order became visible, for the benchmark.
+"""
+import argparse
+import base64
+import http.server
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qs
+
+import requests
+
+PAGE_SIZE = 100
+JOURNAL_STATUS_CHANGED = 18
+
+
+class FakeShop:
+    """Synthetic orders, packages and labels answering connector methods.
+
+    Every released order also has one journal event (``log_id`` equal to its
+    ``order_id``) moving it into ``status_id``, served by ``getJournalList``.
+    """
+
+    def __init__(self, orders=1000, packages=1, label_size=20 * 1024,
+                 arrival_rate=0.0, status_id=91618, courier="dpd", ext="pdf",
+                 start=None):
+        self.count = orders
+        self.packages = packages
+        self.label_size = label_size
+        self.arrival_rate = arrival_rate
+        self.status_id = status_id
+        self.courier = courier
+        self.ext = ext
+        self.start = time.time() if start is None else start
+        self.base_date = int(self.start) - orders
+
+    def released(self, now=None):
+        """Number of orders visible at ``now``."""
+        if self.arrival_rate <= 0:
+            return self.count
+        now = time.time() if now is None else now
+        return min(self.count, int((now - self.start) * self.arrival_rate) + 1)
+
+    def release_time(self, index):
+        if self.arrival_rate <= 0:
+            return self.start
+        return self.start + index / self.arrival_rate
+
+    def order(self, index):
+        return {
+            "order_id": index + 1,
+            "date_confirmed": self.base_date + index,
+            "order_status_id": self.status_id,
+            "order_source": "allegro",
+            "delivery_fullname": f"Klient {index + 1}",
+            "delivery_method": "Kurier",
+            "delivery_package_module": self.courier,
+            "products": [{"name": "Produkt testowy numer jeden", "quantity": 1}],
+        }
+
+    def label(self, package_id):
+        head = f"label {package_id} ".encode()
+        return head + b"x" * max(self.label_size - len(head), 0)
+
+    def handle(self, method, parameters):
+        if method == "getOrders":
+            return self.get_orders(parameters)
+        if method == "getOrderPackages":
+            order_id = int(parameters.get("order_id") or 0)
+            if not 0 < order_id <= self.released():
+                return {"status": "SUCCESS", "packages": []}
+            return {"status": "SUCCESS", "packages": [
+                {"package_id": order_id * 100 + n, "courier_code": self.courier}
+                for n in range(self.packages)
+            ]}
+        if method == "getJournalList":
+            return self.get_journal(parameters)
+        if method == "getLabel":
+            label = self.label(parameters.get("package_id"))
+            return {
+                "status": "SUCCESS",
+                "extension": self.ext,
+                "label": base64.b64encode(label).decode(),
+            }
+        return {"status": "ERROR", "error_code": "ERROR_UNKNOWN_METHOD",
+                "error_message": f"{method} is not faked"}
+
+    def get_orders(self, parameters):
+        status = parameters.get("status_id")
+        if status is not None and int(status) != self.status_id:
+            return {"status": "SUCCESS", "orders": []}
+        if "order_id" in parameters:
+            index = int(parameters["order_id"]) - 1
+            found = 0 <= index < self.released()
+            return {"status": "SUCCESS", "orders": [self.order(index)] if found else []}
+        since = int(parameters.get("date_confirmed_from") or 0)
+        first = max(since - self.base_date, 0)
+        last = min(first + PAGE_SIZE, self.released())
+        return {
+            "status": "SUCCESS",
+            "orders": [self.order(i) for i in range(first, last)],
+        }
+
+    def get_journal(self, parameters):
+        types = parameters.get("logs_types")
+        if types and JOURNAL_STATUS_CHANGED not in types:
+            return {"status": "SUCCESS", "logs": []}
+        first = max(int(parameters.get("last_log_id") or 0), 0)
+        last = min(first + PAGE_SIZE, self.released())
+        return {"status": "SUCCESS", "logs": [
+            {
+                "log_id": i + 1,
+                "log_type": JOURNAL_STATUS_CHANGED,
+                "order_id": i + 1,
+                "object_id": self.status_id,
+                "date": int(self.release_time(i)),
+            }
+            for i in range(first, last)
+        ]}
+
+    def visible(self):
+        """``{order_id: time the order became visible}``."""
+        return {
+            str(i + 1): self.release_time(i) for i in range(self.released())
+        }
+
+
+class Replay:
+    """Serve recorded responses back in the order they were recorded.
+
+    A call with the same method and parameters as a recorded one gets that
+    response; otherwise the next unused response of the method is served.
+    Exhausted ``getOrders`` answers with no orders.
+    """
+
+    def __init__(self, path, latency=False):
+        self.latency = latency
+        self.exact = defaultdict(deque)
+        self.by_method = defaultdict(deque)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                entry = [record, False]
+                self.exact[self._key(record["method"], record["parameters"])].append(entry)
+                self.by_method[record["method"]].append(entry)
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    @staticmethod
+    def _key(method, parameters):
+        return method, json.dumps(parameters, sort_keys=True)
+
+    def _take(self, queue):
+        while queue:
+            entry = queue.popleft()
+            if not entry[1]:
+                entry[1] = True
+                return entry[0]
+        return None
+
+    def handle(self, method, parameters):
+        with self._lock:
+            record = self._take(self.exact[self._key(method, parameters)])
+            if record is None:
+                record = self._take(self.by_method[method])
+        if record is None:
+            if method == "getOrders":
+                return {"status": "SUCCESS", "orders": []}
+            return {"status": "ERROR", "error_code": "ERROR_REPLAY_EXHAUSTED"}
+        if self.latency:
+            time.sleep(record.get("elapsed", 0))
+        response = record["response"]
+        if isinstance(response, str):
+            response = json.loads(response)
+        if method == "getOrders":
+            now = time.time()
+            with self._lock:
+                for order in response.get("orders", []):
+                    self._seen.setdefault(str(order["order_id"]), now)
+        return response
+
+    def visible(self):
+        with self._lock:
+            return dict(self._seen)
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; avoid the delayed-ACK stall
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.startswith("/messenger"):
+            with server.lock:
+                server.messages += 1
+                mid = server.messages
+            return self._json(200, {"recipient_id": "0", "message_id": f"m.{mid}"})
+        form = parse_qs(body.decode())
+        method = form.get("method", [""])[0]
+        parameters = json.loads(form.get("parameters", ["{}"])[0] or "{}")
+        with server.lock:
+            server.calls[method] += 1
+        if server.latency:
+            time.sleep(server.latency * random.uniform(1 - server.jitter, 1 + server.jitter))
+        if server.error_rate and random.random() < server.error_rate:
+            with server.lock:
+                server.errors[method] += 1
+            if server.error_kind == "api":
+                return self._json(200, {"status": "ERROR", "error_code": "ERROR_FAKE"})
+            return self._json(500, {"status": "ERROR", "error_code": "ERROR_FAKE"})
+        if server.upstream:
+            return self._proxy(method, parameters, body)
+        backend = server.backend
+        if isinstance(backend, dict):
+            backend = backend.get(self.headers.get("X-BLToken"))
+            if backend is None:
+                return self._json(200, {"status": "ERROR", "error_code": "ERROR_USER_TOKEN"})
+        self._json(200, backend.handle(method, parameters))
+
+    def _proxy(self, method, parameters, body):
+        server = self.server
+        start = time.perf_counter()
+        response = server.session.post(
+            server.upstream, data=body,
+            headers={
+                "X-BLToken": self.headers.get("X-BLToken", ""),
+                "Content-Type": self.headers.get("Content-Type", ""),
+            },
+            timeout=60,
+        )
+        record = {
+            "method": method,
+            "parameters": parameters,
+            "status": response.status_code,
+            "elapsed": round(time.perf_counter() - start, 4),
+            "response": response.text,
+        }
+        with server.lock:
+            server.record_file.write(json.dumps(record) + "\n")
+            server.record_file.flush()
+        self._send(response.status_code, response.content)
+
+    def do_GET(self):
+        if self.path != "/_stats":
+            return self._json(404, {"error": "not found"})
+        server = self.server
+        with server.lock:
+            stats = {
+                "calls": dict(server.calls),
+                "errors": dict(server.errors),
+                "messages": server.messages,
+            }
+        backend = server.backend
+        if isinstance(backend, dict):
+            stats["visible"] = {
+                f"{token}/{oid}": at
+                for token, shop in backend.items()
+                for oid, at in shop.visible().items()
+            }
+        else:
+            stats["visible"] = backend.visible() if backend else {}
+        self._json(200, stats)
+
+    def _json(self, status, data):
+        self._send(status, json.dumps(data).encode())
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class FakeBaseLinker(http.server.ThreadingHTTPServer):
+    """HTTP server answering ``connector.php`` calls from ``backend``.
+
+    ``backend`` is a :class:`FakeShop` or :class:`Replay`, or a dict of
+    shops keyed by API token; with ``upstream`` calls are proxied there
+    instead and recorded to ``record``.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), backend=None, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_kind="http",
+                 upstream=None, record=None):
+        super().__init__(address, FakeHandler)
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_kind = error_kind
+        self.upstream = upstream
+        self.session = requests.Session() if upstream else None
+        self.record_file = open(record, "a", encoding="utf-8") if record else None
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.messages = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def server_close(self):
+        super().server_close()
+        if self.record_file:
+            self.record_file.close()
+        if self.session:
+            self.session.close()
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("fake BaseLinker")
+    group.add_argument("--orders", type=int, default=1000, help="orders per account")
+    group.add_argument("--accounts", type=int, default=1,
+                       help="shops served, with API tokens shop0, shop1…")
+    group.add_argument("--packages", type=int, default=1, help="labels per order")
+    group.add_argument("--label-size", type=int, default=20 * 1024, help="bytes per label")
+    group.add_argument("--arrival-rate", type=float, default=0.0,
+                       help="orders released per second (0: all at once)")
+    group.add_argument("--status-id", type=int,
+                       default=int(os.getenv("STATUS_ID", "91618")))
+    group.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    group.add_argument("--jitter", type=float, default=0.0,
+                       help="latency varies by this fraction either way")
+    group.add_argument("--error-rate", type=float, default=0.0,
+                       help="fraction of API calls that fail")
+    group.add_argument("--error-kind", choices=("http", "api"), default="http",
+                       help="fail with HTTP 500 or with status ERROR")
+    group.add_argument("--replay", metavar="FILE", help="serve recorded traffic")
+    group.add_argument("--replay-latency", action="store_true",
+                       help="sleep as long as the recorded call took")
+
+
+def make_server(args, port=0, upstream=None, record=None):
+    if upstream:
+        backend = None
+    elif args.replay:
+        backend = Replay(args.replay, latency=args.replay_latency)
+    else:
+        shops = {
+            f"shop{n}": FakeShop(
+                orders=args.orders, packages=args.packages,
+                label_size=args.label_size, arrival_rate=args.arrival_rate,
+                status_id=args.status_id,
+            )
+            for n in range(args.accounts)
+        }
+        backend = shops if args.accounts > 1 else shops["shop0"]
+    return FakeBaseLinker(
+        ("127.0.0.1", port), backend, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, error_kind=args.error_kind,
+        upstream=upstream, record=record,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--record", metavar="FILE", help="append proxied traffic here")
+    parser.add_argument("--upstream", default="https://api.baselinker.com/connector.php",
+                        help="real API used with --record")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(
+        args, args.port,
+        upstream=args.upstream if args.record else None, record=args.record,
+    )
+    print(f"BL_API_URL={server.url}/connector.php")
+    print(f"MESSENGER_URL={server.url}/messenger")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measure requests per second served by the HTTP UI.
+
+Usage:
+    python3 bench/load_test_http.py [--url URL] [--clients N] [--requests N]
+
+Without ``--url`` a local server is started on a temporary database filled
+with ``--orders`` printed orders, so the script can run without an agent.
+"""
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bl_api_print_agent as bl
+
+
+def start_local_server(orders):
+    tmp = tempfile.mkdtemp()
+    bl.configure(DB_FILE=os.path.join(tmp, "load.db"))
+    storage = bl.get_storage()
+    for i in range(orders):
+        storage.mark_as_printed(str(i))
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/history"
+
+
+def client(url, count, latencies, errors):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+        except Exception as e:
+            errors.append(repr(e))
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="page to load, e.g. http://127.0.0.1:8082/history")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="requests per client")
+    parser.add_argument("--orders", type=int, default=1000, help="rows for the local server")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_local_server(args.orders)
+
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=client, args=(url, args.requests, latencies, errors))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"URL:          {url}")
+    print(f"Requests:     {total} ({len(errors)} errors)")
+    print(f"Requests/s:   {total / elapsed:.1f}")
+    print(f"p50 latency:  {latencies[total // 2] * 1000:.1f} ms")
+    print(f"p99 latency:  {latencies[min(total - 1, int(total * 0.99))] * 1000:.1f} ms")
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
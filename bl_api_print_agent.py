@@ -1,332 +1,3491 @@
 #!/usr/bin/env python3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
 import base64
+import hashlib
+import math
 import os
 import subprocess
+import codecs
+import contextvars
+import functools
+import re
+import contextlib
+import socket
+import struct
 import logging
+import logging.handlers
+import atexit
+import queue
+import random
 from datetime import datetime, timedelta
 import threading
+import heapq
+import bisect
+import itertools
+import zlib
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import http.server
-import socketserver
 import sqlite3
 import html
+import signal
+from urllib.parse import parse_qs, urlencode, urlsplit
 from dotenv import load_dotenv
 
 # === WCZYTAJ Z .env ===
-load_dotenv()
-
-API_TOKEN = os.getenv("API_TOKEN")
-PAGE_ACCESS_TOKEN = os.getenv("PAGE_ACCESS_TOKEN")
-RECIPIENT_ID = os.getenv("RECIPIENT_ID")
-STATUS_ID = int(os.getenv("STATUS_ID", "91618"))
-PRINTER_NAME = os.getenv("PRINTER_NAME", "Xprinter")
-POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))
-QUIET_HOURS_START = int(os.getenv("QUIET_HOURS_START", "10"))
-QUIET_HOURS_END = int(os.getenv("QUIET_HOURS_END", "22"))
-BASE_URL = "https://api.baselinker.com/connector.php"
+# Only when run as a script; importing the module leaves .env, the
+# environment, the log file and the network alone.
+if __name__ == "__main__":
+    load_dotenv()
+
+def _flag(value):
+    return value.lower() in ("1", "true", "yes")
+
+def _lower(value):
+    return value.lower()
+
+def _upper(value):
+    return value.upper()
+
+
+# name: (environment variable, parser, default before parsing)
+SETTINGS = {
+    "API_TOKEN": ("API_TOKEN", str, None),
+    "PAGE_ACCESS_TOKEN": ("PAGE_ACCESS_TOKEN", str, None),
+    "RECIPIENT_ID": ("RECIPIENT_ID", str, None),
+    "STATUS_ID": ("STATUS_ID", int, "91618"),
+    "PRINTER_NAME": ("PRINTER_NAME", str, "Xprinter"),
+    "PRINTER_BACKEND": ("PRINTER_BACKEND", str, "lp"),
+    "PRINTER_ROUTES": ("PRINTER_ROUTES", str, ""),
+    "POLL_INTERVAL": ("POLL_INTERVAL", int, "60"),
+    "QUIET_HOURS_START": ("QUIET_HOURS_START", int, "10"),
+    "QUIET_HOURS_END": ("QUIET_HOURS_END", int, "22"),
+    "BASE_URL": ("BL_API_URL", str, "https://api.baselinker.com/connector.php"),
+    "PRINTED_EXPIRY_DAYS": ("PRINTED_EXPIRY_DAYS", int, "5"),
+    "DEDUP_MODE": ("DEDUP_MODE", _lower, "exact"),
+    "DEDUP_BLOOM_CAPACITY": ("DEDUP_BLOOM_CAPACITY", int, "10000"),
+    "DEDUP_BLOOM_ERROR": ("DEDUP_BLOOM_ERROR", float, "0.001"),
+    "LOG_LEVEL": ("LOG_LEVEL", _upper, "INFO"),
+    "DB_FILE": ("DATA_DB", str, os.path.join(os.path.dirname(__file__), "data.db")),
+    "ENABLE_HTTP_SERVER": ("ENABLE_HTTP_SERVER", _flag, "1"),
+    "LOG_FILE": ("LOG_FILE", str, os.path.join(os.path.dirname(__file__), "agent.log")),
+    "HTTP_PORT": ("HTTP_PORT", int, "8082"),
+    "LOG_MAX_BYTES": ("LOG_MAX_BYTES", int, str(10 * 1024 * 1024)),
+    "LOG_BACKUP_COUNT": ("LOG_BACKUP_COUNT", int, "5"),
+    "LOG_ROTATE_WHEN": ("LOG_ROTATE_WHEN", str, ""),
+    "LOG_FORMAT": ("LOG_FORMAT", _lower, "text"),
+    "LOG_RAW_SAMPLE_RATE": ("LOG_RAW_SAMPLE_RATE", float, "1"),
+    "LOG_RAW_MAX_CHARS": ("LOG_RAW_MAX_CHARS", int, "4000"),
+    "QUEUE_MAX_ATTEMPTS": ("QUEUE_MAX_ATTEMPTS", int, "5"),
+    "QUEUE_BATCH_SIZE": ("QUEUE_BATCH_SIZE", int, "100"),
+    "PRINT_BATCH_SIZE": ("PRINT_BATCH_SIZE", int, "20"),
+    "PRINT_TIMEOUT": ("PRINT_TIMEOUT", float, "30"),
+    "FETCH_WORKERS": ("FETCH_WORKERS", int, "4"),
+    "API_RATE_LIMIT": ("API_RATE_LIMIT", int, "100"),
+    "API_RATE_BURST": ("API_RATE_BURST", int, "10"),
+    "ORDER_POLL_MODE": ("ORDER_POLL_MODE", _lower, "journal"),
+    "ORDER_RESYNC_MINUTES": ("ORDER_RESYNC_MINUTES", float, "5"),
+    "ORDERS_PER_CYCLE": ("ORDERS_PER_CYCLE", int, "500"),
+    "ORDERS_MAX_PAGES": ("ORDERS_MAX_PAGES", int, "50"),
+    "POLL_MIN_INTERVAL": ("POLL_MIN_INTERVAL", int, "10"),
+    "POLL_MAX_INTERVAL": ("POLL_MAX_INTERVAL", int, "0"),
+    "POLL_RATE_WINDOW": ("POLL_RATE_WINDOW", int, "900"),
+    "TRIGGER_TOKEN": ("TRIGGER_TOKEN", str, None),
+    "HTTP_REQUEST_TIMEOUT": ("HTTP_REQUEST_TIMEOUT", int, "30"),
+    "NOTIFY_INTERVAL": ("NOTIFY_INTERVAL", float, "5"),
+    "NOTIFY_BACKOFF": ("NOTIFY_BACKOFF", float, "30"),
+    "NOTIFY_MAX_BACKOFF": ("NOTIFY_MAX_BACKOFF", float, "3600"),
+    "NOTIFY_MAX_ATTEMPTS": ("NOTIFY_MAX_ATTEMPTS", int, "10"),
+    "MESSENGER_DIGEST_THRESHOLD": ("MESSENGER_DIGEST_THRESHOLD", int, "5"),
+    "MESSENGER_DIGEST_SIZE": ("MESSENGER_DIGEST_SIZE", int, "20"),
+    "LABEL_CACHE_DAYS": ("LABEL_CACHE_DAYS", float, "7"),
+    "LABEL_CACHE_MAX_BYTES": ("LABEL_CACHE_MAX_BYTES", int, str(256 * 1024 * 1024)),
+    "HISTORY_PAGE_SIZE": ("HISTORY_PAGE_SIZE", int, "50"),
+    "API_CONNECT_TIMEOUT": ("API_CONNECT_TIMEOUT", float, "3.05"),
+    "API_READ_TIMEOUT": ("API_READ_TIMEOUT", float, "10"),
+    "API_RETRIES": ("API_RETRIES", int, "3"),
+    "API_BACKOFF": ("API_BACKOFF", float, "0.5"),
+    "MESSENGER_TIMEOUT": ("MESSENGER_TIMEOUT", float, "10"),
+    "MESSENGER_URL": ("MESSENGER_URL", str, "https://graph.facebook.com/v17.0/me/messages"),
+    "ACCOUNTS_FILE": ("ACCOUNTS_FILE", str, ""),
+    "ACCOUNT_SHARD": ("ACCOUNT_SHARD", str, ""),
+    "ACCOUNT_WORKERS": ("ACCOUNT_WORKERS", int, "4"),
+}
+CONFIG_NAMES = frozenset(SETTINGS)
+
 PRINTED_FILE = os.path.join(os.path.dirname(__file__), "printed_orders.txt")
-PRINTED_EXPIRY_DAYS = int(os.getenv("PRINTED_EXPIRY_DAYS", "5"))
 LABEL_QUEUE = os.path.join(os.path.dirname(__file__), "queued_labels.jsonl")
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-DB_FILE = os.getenv("DATA_DB", os.path.join(os.path.dirname(__file__), "data.db"))
-ENABLE_HTTP_SERVER = os.getenv("ENABLE_HTTP_SERVER", "1").lower() in ("1", "true", "yes")
-LOG_FILE = os.getenv("LOG_FILE", os.path.join(os.path.dirname(__file__), "agent.log"))
-HTTP_PORT = int(os.getenv("HTTP_PORT", "8082"))
-
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler(),
-    ],
-)
+LABEL_CHUNK_SIZE = 64 * 1024
+
+
+class Config:
+    """Settings by name (``SETTINGS``), each parsed from the environment on first use.
+
+    Importing the module reads nothing, so a malformed variable fails where
+    the setting is used (or in ``validate_env``), naming the variable.
+    Values passed by name win; the rest come from ``parent`` when given, so
+    ``config.derive(STATUS_ID=1)`` overrides one setting and follows the
+    others.
+    """
+
+    def __init__(self, parent=None, **values):
+        self._parent = parent
+        self.update(**values)
+
+    def __getattr__(self, name):
+        if name not in SETTINGS:
+            raise AttributeError(name)
+        if self._parent is not None:
+            return getattr(self._parent, name)
+        env, parse, default = SETTINGS[name]
+        raw = os.environ.get(env, default)
+        try:
+            value = raw if raw is None else parse(raw)
+        except ValueError:
+            raise ValueError(f"Nieprawidłowa wartość {env}: {raw!r}") from None
+        self.__dict__[name] = value
+        return value
+
+    def update(self, **values):
+        unknown = sorted(set(values) - CONFIG_NAMES)
+        if unknown:
+            raise ValueError(f"Nieznane ustawienia: {', '.join(unknown)}")
+        self.__dict__.update(values)
+
+    def derive(self, **values):
+        return Config(self, **values)
+
+    def load(self):
+        """Parse every setting now; raises ``ValueError`` on the first bad one."""
+        for name in SETTINGS:
+            getattr(self, name)
+        return self
+
+
+config = Config()
+
+_log_context = threading.local()
+_active = contextvars.ContextVar("active", default=None)
+
+def current_account():
+    """The ``Account`` active in this context, or ``None``."""
+    active = _active.get()
+    return active if isinstance(active, Account) else None
+
+def settings():
+    """The ``Config`` of the active ``Agent`` or ``Account``, else ``config``."""
+    active = _active.get()
+    return config if active is None else active.config
+
+def __getattr__(name):
+    # ``bl.STATUS_ID`` reads the setting of the active agent or account.
+    if name in SETTINGS:
+        return getattr(settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach ``fields`` (``order_id``, ``method``…) to records logged in the block."""
+    previous = getattr(_log_context, "fields", {})
+    _log_context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+
+class LogContextFilter(logging.Filter):
+    """Copy the thread's ``log_context`` fields onto each record."""
+
+    def filter(self, record):
+        for key, value in getattr(_log_context, "fields", {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        account = current_account()
+        if account is not None and not hasattr(record, "account"):
+            record.account = account.name
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the structured fields when present."""
+
+    FIELDS = ("account", "order_id", "method", "status", "printer")
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+log_listener = None
+
+def setup_logging():
+    """Log through a queue so file and console writes happen off the hot path.
+
+    Callers only put records on the queue; a ``QueueListener`` thread
+    formats and writes them. The file rotates by size, or by time when
+    ``LOG_ROTATE_WHEN`` is set (``midnight``, ``H``, ``D``…). Called once
+    the agent starts, not at import; later calls return the same listener.
+    """
+    global log_listener
+    if log_listener is not None:
+        return log_listener
+    config = settings()
+    if config.LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            config.LOG_FILE, when=config.LOG_ROTATE_WHEN, backupCount=config.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            config.LOG_FILE, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    if config.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, config.LOG_LEVEL, logging.INFO))
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    log_listener = listener
+    return listener
+
+
 logger = logging.getLogger(__name__)
 
-HEADERS = {
-    "X-BLToken": API_TOKEN,
-    "Content-Type": "application/x-www-form-urlencoded"
-}
+def log_raw_payload(method, response):
+    """Log a sampled, truncated copy of a raw API response at DEBUG level."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    config = settings()
+    if random.random() >= config.LOG_RAW_SAMPLE_RATE:
+        return
+    text = json.dumps(response, ensure_ascii=False)
+    limit = config.LOG_RAW_MAX_CHARS
+    if limit and len(text) > limit:
+        text = f"{text[:limit]}… (+{len(text) - limit} znaków)"
+    logger.debug("🔁 Surowa odpowiedź %s: %s", method, text, extra={"method": method})
+
+def api_headers(token):
+    return {
+        "X-BLToken": token,
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+
+last_order_data = {}
+
+def validate_env():
+    """Ensure every setting parses and the mandatory ones are present.
+
+    With ``ACCOUNTS_FILE`` the tokens come from the file (see ``load_accounts``).
+    """
+    try:
+        config.load()
+    except ValueError as e:
+        logger.error("Błędna konfiguracja: %s", e)
+        raise SystemExit(1)
+    required = {} if config.ACCOUNTS_FILE else {
+        "API_TOKEN": config.API_TOKEN,
+        "PAGE_ACCESS_TOKEN": config.PAGE_ACCESS_TOKEN,
+        "RECIPIENT_ID": config.RECIPIENT_ID,
+    }
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        logger.error(
+            "Brak wymaganych zmiennych środowiskowych: %s",
+            ", ".join(missing),
+        )
+        raise SystemExit(1)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _migrate_label_queue_v1(conn):
+    """Give ``label_queue`` a primary key and a status column."""
+    conn.execute(
+        "CREATE TABLE label_queue_new("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "order_id TEXT NOT NULL, "
+        "label_data TEXT, "
+        "ext TEXT, "
+        "last_order_data TEXT, "
+        "status TEXT NOT NULL DEFAULT 'pending', "
+        "attempts INTEGER NOT NULL DEFAULT 0, "
+        "last_error TEXT, "
+        "created_at TEXT, "
+        "updated_at TEXT)"
+    )
+    conn.execute(
+        "INSERT INTO label_queue_new(order_id, label_data, ext, last_order_data, created_at) "
+        "SELECT order_id, label_data, ext, last_order_data, ? FROM label_queue ORDER BY rowid",
+        (datetime.now().isoformat(),),
+    )
+    conn.execute("DROP TABLE label_queue")
+    conn.execute("ALTER TABLE label_queue_new RENAME TO label_queue")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_label_queue_status ON label_queue(status, id)"
+    )
+
+
+def _migrate_label_blobs_v2(conn):
+    """Move label payloads into content-addressed, decoded BLOBs."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS label_blobs("
+        "sha256 TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL)"
+    )
+    conn.execute("ALTER TABLE label_queue ADD COLUMN label_ref TEXT")
+    rows = conn.execute(
+        "SELECT id, label_data FROM label_queue WHERE label_data IS NOT NULL"
+    ).fetchall()
+    for qid, label_data in rows:
+        try:
+            data = base64.b64decode(label_data)
+        except Exception as e:
+            logger.error(f"Nie można zdekodować etykiety z kolejki ({qid}): {e}")
+            continue
+        ref = _store_blob(conn, data)
+        conn.execute(
+            "UPDATE label_queue SET label_ref = ?, label_data = NULL WHERE id = ?",
+            (ref, qid),
+        )
+
+
+def _migrate_agent_state_v3(conn):
+    """Key/value table for watermarks and other small agent state."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS agent_state(key TEXT PRIMARY KEY, value TEXT)"
+    )
+
+
+def _migrate_history_indexes_v4(conn):
+    """Indexes used by the history view and printed order expiry."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_printed_orders_printed_at ON printed_orders(printed_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_label_queue_order ON label_queue(order_id, status)"
+    )
+
+
+def _migrate_notification_outbox_v5(conn):
+    """Outbox of Messenger notifications, one row per order."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS notification_outbox("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "order_id TEXT NOT NULL UNIQUE, "
+        "payload TEXT NOT NULL, "
+        "status TEXT NOT NULL DEFAULT 'pending', "
+        "attempts INTEGER NOT NULL DEFAULT 0, "
+        "next_attempt_at TEXT NOT NULL, "
+        "last_error TEXT, "
+        "created_at TEXT NOT NULL, "
+        "sent_at TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(status, next_attempt_at)"
+    )
+
+
+def _migrate_label_cache_v6(conn):
+    """Fetched labels by package, so retries and reprints skip ``getLabel``."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS label_cache("
+        "courier_code TEXT NOT NULL, "
+        "package_id TEXT NOT NULL, "
+        "order_id TEXT, "
+        "label_ref TEXT NOT NULL, "
+        "ext TEXT, "
+        "size INTEGER NOT NULL, "
+        "fetched_at TEXT NOT NULL, "
+        "used_at TEXT NOT NULL, "
+        "PRIMARY KEY(courier_code, package_id))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_label_cache_used ON label_cache(used_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_label_cache_order ON label_cache(order_id)")
+
+
+def _migrate_order_state_v7(conn):
+    """Where each order is in its fetched → … → notified life cycle."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS order_state("
+        "order_id TEXT PRIMARY KEY, "
+        "state TEXT NOT NULL, "
+        "data TEXT, "
+        "updated_at TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_state ON order_state(state, updated_at)")
+
+
+# Applied in order; PRAGMA user_version stores how many have already run.
+SCHEMA_MIGRATIONS = [
+    _migrate_label_queue_v1,
+    _migrate_label_blobs_v2,
+    _migrate_agent_state_v3,
+    _migrate_history_indexes_v4,
+    _migrate_notification_outbox_v5,
+    _migrate_label_cache_v6,
+    _migrate_order_state_v7,
+]
+
+ORDER_STATES = ("fetched", "queued", "printing", "printed", "notified", "failed")
+
+
+def _store_blob(conn, data):
+    ref = hashlib.sha256(data).hexdigest()
+    conn.execute(
+        "INSERT OR IGNORE INTO label_blobs(sha256, data, size) VALUES (?, ?, ?)",
+        (ref, sqlite3.Binary(data), len(data)),
+    )
+    return ref
+
+
+def _set_order_state(conn, order_id, state, data=None):
+    conn.execute(
+        "INSERT INTO order_state(order_id, state, data, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(order_id) DO UPDATE SET state = excluded.state, "
+        "data = COALESCE(excluded.data, data), updated_at = excluded.updated_at",
+        (
+            order_id,
+            state,
+            None if data is None else json.dumps(data, ensure_ascii=False),
+            datetime.now().isoformat(),
+        ),
+    )
+
+
+def _queue_orders(conn, ids):
+    if not ids:
+        return []
+    return [row[0] for row in conn.execute(
+        "SELECT DISTINCT order_id FROM label_queue WHERE id IN "
+        f"({', '.join('?' * len(ids))})",
+        list(ids),
+    )]
+
+
+def _delete_orphan_blobs(conn):
+    conn.execute(
+        "DELETE FROM label_blobs WHERE sha256 NOT IN "
+        "(SELECT label_ref FROM label_queue WHERE label_ref IS NOT NULL) "
+        "AND sha256 NOT IN (SELECT label_ref FROM label_cache)"
+    )
+
+
+class _ThreadConnection:
+    """One thread's SQLite connection, closed when the thread's locals go."""
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def _close_connection(connections, lock, conn):
+    with lock:
+        connections.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+class Storage:
+    """SQLite storage with long-lived, per-thread connections.
+
+    The main loop and the HTTP thread share one instance. Every thread gets
+    its own connection (opened lazily and reused afterwards), so SQLite's
+    statement cache stays warm and no call pays for a new connection. A
+    connection is closed as soon as its thread exits, so short-lived request
+    threads do not leave file descriptors behind.
+    Schema setup and file migrations run once, when the storage is created.
+    """
+
+    def __init__(self, path, migrate_files=True):
+        self.path = path
+        self.migrate_files = migrate_files
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._connections = set()
+        self._finalizers = []
+        self.setup()
+
+    def connection(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            conn = sqlite3.connect(
+                self.path, check_same_thread=False, cached_statements=256
+            )
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._lock:
+                self._connections.add(conn)
+                self._finalizers = [f for f in self._finalizers if f.alive]
+                self._finalizers.append(weakref.finalize(
+                    holder, _close_connection, self._connections, self._lock, conn
+                ))
+        return holder.conn
+
+    def close(self):
+        with self._lock:
+            finalizers, self._finalizers = self._finalizers, []
+        for finalizer in finalizers:
+            finalizer()
+        self._local = threading.local()
+
+    def setup(self):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS printed_orders(order_id TEXT PRIMARY KEY, printed_at TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS label_queue(order_id TEXT, label_data TEXT, ext TEXT, last_order_data TEXT)"
+            )
+        self._migrate_schema(conn)
+        if self.migrate_files:
+            self._migrate_files(conn)
+
+    def _migrate_schema(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            with conn:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+            logger.debug(f"Migracja bazy danych do wersji {target}")
+
+    def _migrate_files(self, conn):
+        # migrate old printed orders
+        if os.path.exists(PRINTED_FILE):
+            if conn.execute("SELECT COUNT(*) FROM printed_orders").fetchone()[0] == 0:
+                with conn, open(PRINTED_FILE, "r") as f:
+                    for line in f:
+                        if "," in line:
+                            oid, ts = line.strip().split(",")
+                            conn.execute(
+                                "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
+                                (oid, ts),
+                            )
+        if os.path.exists(LABEL_QUEUE):
+            if conn.execute("SELECT COUNT(*) FROM label_queue").fetchone()[0] == 0:
+                with open(LABEL_QUEUE, "r") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            item = json.loads(line)
+                            self.enqueue(
+                                item.get("order_id"),
+                                base64.b64decode(item.get("label_data") or ""),
+                                item.get("ext"),
+                                item.get("last_order_data", {}),
+                            )
+                        except Exception as e:
+                            logger.error(f"Błąd migracji z {LABEL_QUEUE}: {e}")
+
+    def load_printed_orders(self):
+        rows = self.connection().execute(
+            "SELECT order_id, printed_at FROM printed_orders"
+        ).fetchall()
+        return {oid: datetime.fromisoformat(ts) for oid, ts in rows}
+
+    def iter_printed_orders(self):
+        """Yield ``(order_id, printed_at)`` pairs, oldest first."""
+        yield from self.connection().execute(
+            "SELECT order_id, printed_at FROM printed_orders ORDER BY printed_at"
+        )
+
+    def is_printed(self, order_id):
+        return self.connection().execute(
+            "SELECT 1 FROM printed_orders WHERE order_id = ?", (order_id,)
+        ).fetchone() is not None
+
+    def mark_as_printed(self, order_id):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
+                (order_id, datetime.now().isoformat()),
+            )
+
+    def clean_old_printed_orders(self, days):
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM printed_orders WHERE printed_at < ?",
+                (threshold.isoformat(),),
+            )
+
+    def load_queue(self):
+        """Return all queued labels that still wait for printing."""
+        return self.peek_batch(limit=-1)
+
+    def enqueue(self, order_id, label, ext, last_order_data):
+        """Queue decoded label bytes for ``order_id`` and return the row id."""
+        conn = self.connection()
+        with conn:
+            return self._insert_label(conn, order_id, label, ext, last_order_data)
+
+    @staticmethod
+    def _insert_label(conn, order_id, label, ext, last_order_data):
+        ref = _store_blob(conn, label)
+        cur = conn.execute(
+            "INSERT INTO label_queue(order_id, label_ref, ext, last_order_data, status, created_at) "
+            "VALUES (?, ?, ?, ?, 'pending', ?)",
+            (
+                order_id,
+                ref,
+                ext,
+                json.dumps(last_order_data or {}),
+                datetime.now().isoformat(),
+            ),
+        )
+        return cur.lastrowid
+
+    def record_fetched(self, order_id, data):
+        """Enter ``fetched`` unless the order already has a state."""
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO order_state(order_id, state, data, updated_at) "
+                "VALUES (?, 'fetched', ?, ?)",
+                (order_id, json.dumps(data, ensure_ascii=False), datetime.now().isoformat()),
+            )
+
+    def fetched_orders(self):
+        """Ids of orders fetched but not queued yet, oldest first."""
+        return [row[0] for row in self.connection().execute(
+            "SELECT order_id FROM order_state WHERE state = 'fetched' ORDER BY updated_at"
+        )]
+
+    def forget_fetched(self, order_id):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM order_state WHERE order_id = ? AND state = 'fetched'",
+                (order_id,),
+            )
+
+    def order_state(self, order_id):
+        row = self.connection().execute(
+            "SELECT state FROM order_state WHERE order_id = ?", (order_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def queue_order(self, order_id, labels, data, notify=False):
+        """Move an order to ``queued`` and return the ids of its queue rows.
+
+        Its labels, the printed-order record and (with ``notify``) the
+        notification are written in the same transaction, so after a crash
+        either all of them exist or none does.
+        """
+        conn = self.connection()
+        with conn:
+            ids = [
+                self._insert_label(conn, order_id, label, ext, data)
+                for label, ext in labels
+            ]
+            conn.execute(
+                "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
+                (order_id, datetime.now().isoformat()),
+            )
+            _set_order_state(conn, order_id, "queued", data)
+            if notify:
+                self._insert_notification(conn, order_id, data)
+        return ids
+
+    def start_printing(self, ids):
+        """Claim queue rows for printing; their orders enter ``printing``."""
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE label_queue SET status = 'printing', updated_at = ? WHERE id = ?",
+                [(datetime.now().isoformat(), qid) for qid in ids],
+            )
+            conn.executemany(
+                "UPDATE order_state SET state = 'printing', updated_at = ? "
+                "WHERE order_id = ? AND state IN ('queued', 'printing')",
+                [(datetime.now().isoformat(), oid) for oid in _queue_orders(conn, ids)],
+            )
+
+    def finish_printing(self, ids):
+        """Mark queue rows done and return the orders that are now ``printed``."""
+        now = datetime.now().isoformat()
+        conn = self.connection()
+        finished = []
+        with conn:
+            conn.executemany(
+                "UPDATE label_queue SET status = 'done', updated_at = ? WHERE id = ?",
+                [(now, qid) for qid in ids],
+            )
+            for oid in _queue_orders(conn, ids):
+                left = conn.execute(
+                    "SELECT COUNT(*) FROM label_queue WHERE order_id = ? "
+                    "AND status IN ('pending', 'printing')",
+                    (oid,),
+                ).fetchone()[0]
+                if left:
+                    continue
+                cur = conn.execute(
+                    "UPDATE order_state SET state = 'printed', updated_at = ? "
+                    "WHERE order_id = ? AND state IN ('queued', 'printing')",
+                    (now, oid),
+                )
+                if cur.rowcount:
+                    finished.append(oid)
+        return finished
+
+    def recover_orders(self):
+        """Undo what a crash left half done.
+
+        Returns ``(requeued, unnotified)``: orders whose printing was cut
+        short (their labels are pending again) and ``(order_id, data)`` of
+        printed orders still waiting for their notification.
+        """
+        conn = self.connection()
+        with conn:
+            requeued = [row[0] for row in conn.execute(
+                "SELECT DISTINCT order_id FROM label_queue WHERE status = 'printing'"
+            )]
+            conn.execute(
+                "UPDATE label_queue SET status = 'pending' WHERE status = 'printing'"
+            )
+            conn.execute(
+                "UPDATE order_state SET state = 'queued' WHERE state = 'printing'"
+            )
+        rows = conn.execute(
+            "SELECT order_id, data FROM order_state WHERE state = 'printed'"
+        ).fetchall()
+        return requeued, [(oid, json.loads(data or "{}")) for oid, data in rows]
+
+    def count_order_states(self):
+        return dict(self.connection().execute(
+            "SELECT state, COUNT(*) FROM order_state GROUP BY state"
+        ).fetchall())
+
+    def purge_order_states(self, days):
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM order_state WHERE state IN ('notified', 'fetched', 'failed') "
+                "AND updated_at < ?",
+                (threshold.isoformat(),),
+            )
+
+    def peek_batch(self, limit=100, after_id=0):
+        """Return up to ``limit`` pending labels with ``id > after_id``.
+
+        Labels come back in insertion order; a negative ``limit`` returns
+        every pending label. Payloads are not loaded, use ``read_label``
+        with the ``label_ref`` of an item to get its bytes.
+        """
+        rows = self.connection().execute(
+            "SELECT id, order_id, label_ref, ext, last_order_data, attempts FROM label_queue "
+            "WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+        items = []
+        for qid, order_id, label_ref, ext, last_order_json, attempts in rows:
+            try:
+                last_data = json.loads(last_order_json) if last_order_json else {}
+            except Exception:
+                last_data = {}
+            items.append({
+                "id": qid,
+                "order_id": order_id,
+                "label_ref": label_ref,
+                "ext": ext,
+                "last_order_data": last_data,
+                "attempts": attempts,
+            })
+        return items
+
+    def read_label(self, ref):
+        row = self.connection().execute(
+            "SELECT data FROM label_blobs WHERE sha256 = ?", (ref,)
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def count_queue(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM label_queue WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def mark_done(self, ids):
+        """Mark labels as printed."""
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE label_queue SET status = 'done', updated_at = ? WHERE id = ?",
+                [(datetime.now().isoformat(), qid) for qid in ids],
+            )
+
+    def mark_failed(self, ids, error="", max_attempts=None):
+        """Record a failed print attempt.
+
+        Labels stay pending so the next drain retries them, until they have
+        failed ``max_attempts`` times; their order then ends in ``failed``.
+        """
+        max_attempts = max_attempts or settings().QUEUE_MAX_ATTEMPTS
+        now = datetime.now().isoformat()
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE label_queue SET attempts = attempts + 1, last_error = ?, updated_at = ?, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE id = ?",
+                [(str(error), now, max_attempts, qid) for qid in ids],
+            )
+            for oid in _queue_orders(conn, ids):
+                conn.execute(
+                    "UPDATE order_state SET updated_at = ?, state = CASE WHEN EXISTS("
+                    "SELECT 1 FROM label_queue WHERE order_id = ? AND status = 'failed') "
+                    "THEN 'failed' ELSE 'queued' END "
+                    "WHERE order_id = ? AND state IN ('queued', 'printing')",
+                    (now, oid, oid),
+                )
+
+    def purge_done_queue(self, days):
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM label_queue WHERE status = 'done' AND updated_at < ?",
+                (threshold.isoformat(),),
+            )
+            _delete_orphan_blobs(conn)
+
+    def cache_label(self, courier_code, package_id, order_id, label, ext):
+        now = datetime.now().isoformat()
+        conn = self.connection()
+        with conn:
+            ref = _store_blob(conn, label)
+            conn.execute(
+                "INSERT OR REPLACE INTO label_cache(courier_code, package_id, order_id, "
+                "label_ref, ext, size, fetched_at, used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (courier_code, str(package_id), order_id, ref, ext, len(label), now, now),
+            )
+
+    def cached_label(self, courier_code, package_id, days):
+        """Return ``(label, ext)`` fetched within ``days`` or ``None``."""
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT label_ref, ext FROM label_cache "
+            "WHERE courier_code = ? AND package_id = ? AND fetched_at >= ?",
+            (courier_code, str(package_id), threshold.isoformat()),
+        ).fetchone()
+        label = self.read_label(row[0]) if row else None
+        if label is None:
+            return None
+        with conn:
+            conn.execute(
+                "UPDATE label_cache SET used_at = ? WHERE courier_code = ? AND package_id = ?",
+                (datetime.now().isoformat(), courier_code, str(package_id)),
+            )
+        return label, row[1]
+
+    def order_labels(self, order_id):
+        """Cached ``(label, ext)`` pairs of one order, in fetch order."""
+        rows = self.connection().execute(
+            "SELECT label_ref, ext FROM label_cache WHERE order_id = ? ORDER BY rowid",
+            (order_id,),
+        ).fetchall()
+        labels = [(self.read_label(ref), ext) for ref, ext in rows]
+        return [(label, ext) for label, ext in labels if label is not None]
+
+    def cached_orders(self, order_ids):
+        """Those of ``order_ids`` that have cached labels."""
+        order_ids = list(order_ids)
+        if not order_ids:
+            return set()
+        rows = self.connection().execute(
+            "SELECT DISTINCT order_id FROM label_cache WHERE order_id IN "
+            f"({', '.join('?' * len(order_ids))})",
+            order_ids,
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def label_cache_size(self):
+        """Return ``(entries, bytes)`` held in the label cache."""
+        count, size = self.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM label_cache"
+        ).fetchone()
+        return count, size
+
+    def evict_label_cache(self, days, max_bytes):
+        """Drop labels older than ``days``, then least recently used ones
+        until the cache fits in ``max_bytes``. Returns the number removed."""
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        with conn:
+            removed = conn.execute(
+                "DELETE FROM label_cache WHERE fetched_at < ?", (threshold.isoformat(),)
+            ).rowcount
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM label_cache"
+            ).fetchone()[0]
+            if max_bytes and total > max_bytes:
+                victims = []
+                for courier_code, package_id, size in conn.execute(
+                    "SELECT courier_code, package_id, size FROM label_cache ORDER BY used_at"
+                ):
+                    victims.append((courier_code, package_id))
+                    total -= size
+                    if total <= max_bytes:
+                        break
+                conn.executemany(
+                    "DELETE FROM label_cache WHERE courier_code = ? AND package_id = ?",
+                    victims,
+                )
+                removed += len(victims)
+            if removed:
+                _delete_orphan_blobs(conn)
+        return removed
+
+    def history(self, page=1, per_page=50, order_id=None, date_from=None, date_to=None):
+        """Return ``(items, total)`` for one page of the print history.
+
+        Queued orders without a print record come first, then printed ones,
+        newest first. ``status`` is ``failed`` when a label gave up after
+        ``QUEUE_MAX_ATTEMPTS``, ``queued`` while labels wait, else
+        ``printed``. ``order_id`` matches as a prefix, ``date_from`` and
+        ``date_to`` are inclusive ``YYYY-MM-DD`` dates. Only indexed columns
+        are read; label payloads are never touched.
+        """
+        def filters(id_col, ts_col):
+            where, params = [], []
+            if order_id:
+                where.append(f"{id_col} >= ? AND {id_col} < ?")
+                params += [order_id, order_id + "\uffff"]
+            if date_from:
+                where.append(f"{ts_col} >= ?")
+                params.append(date_from)
+            if date_to:
+                where.append(f"{ts_col} < ?")
+                params.append(
+                    (datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat()
+                )
+            return where, params
+
+        conn = self.connection()
+        where, params = filters("q.order_id", "q.created_at")
+        where = [
+            "q.status = 'pending'",
+            "NOT EXISTS(SELECT 1 FROM printed_orders p WHERE p.order_id = q.order_id)",
+        ] + where
+        orphans = conn.execute(
+            "SELECT q.order_id, MIN(q.created_at) FROM label_queue q "
+            f"WHERE {' AND '.join(where)} GROUP BY q.order_id ORDER BY 2 DESC",
+            params,
+        ).fetchall()
+        items = [
+            {"order_id": oid, "printed_at": ts, "status": "queued"}
+            for oid, ts in orphans
+        ]
+        offset = (page - 1) * per_page
+        items = items[offset:offset + per_page]
+
+        where, params = filters("p.order_id", "p.printed_at")
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        total = len(orphans) + conn.execute(
+            f"SELECT COUNT(*) FROM printed_orders p{clause}", params
+        ).fetchone()[0]
+        remaining = per_page - len(items)
+        if remaining > 0:
+            rows = conn.execute(
+                "SELECT p.order_id, p.printed_at, EXISTS(SELECT 1 FROM label_queue q "
+                "WHERE q.order_id = p.order_id AND q.status = 'failed'), "
+                "EXISTS(SELECT 1 FROM label_queue q "
+                "WHERE q.order_id = p.order_id AND q.status IN ('pending', 'printing')) "
+                f"FROM printed_orders p{clause} "
+                "ORDER BY p.printed_at DESC LIMIT ? OFFSET ?",
+                params + [remaining, max(offset - len(orphans), 0)],
+            ).fetchall()
+            items += [
+                {
+                    "order_id": oid,
+                    "printed_at": ts,
+                    "status": "failed" if failed else "queued" if queued else "printed",
+                }
+                for oid, ts, failed, queued in rows
+            ]
+        return items, total
+
+    def enqueue_notification(self, order_id, data):
+        """Add a notification for ``order_id``; returns ``False`` for duplicates.
+
+        A ``printed`` order moves to ``notified`` in the same transaction.
+        """
+        conn = self.connection()
+        with conn:
+            added = self._insert_notification(conn, order_id, data)
+            conn.execute(
+                "UPDATE order_state SET state = 'notified', updated_at = ? "
+                "WHERE order_id = ? AND state = 'printed'",
+                (datetime.now().isoformat(), order_id),
+            )
+        return added
+
+    @staticmethod
+    def _insert_notification(conn, order_id, data):
+        now = datetime.now().isoformat()
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO notification_outbox"
+            "(order_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (order_id, json.dumps(data, ensure_ascii=False), now, now),
+        )
+        return cur.rowcount == 1
+
+    def due_notifications(self, limit=50):
+        rows = self.connection().execute(
+            "SELECT id, order_id, payload, attempts FROM notification_outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (datetime.now().isoformat(), limit),
+        ).fetchall()
+        return [
+            {"id": nid, "order_id": oid, "data": json.loads(payload), "attempts": attempts}
+            for nid, oid, payload, attempts in rows
+        ]
+
+    def count_notifications(self, status="pending"):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM notification_outbox WHERE status = ?", (status,)
+        ).fetchone()[0]
+
+    def mark_notifications_sent(self, ids):
+        now = datetime.now().isoformat()
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE notification_outbox SET status = 'sent', sent_at = ? WHERE id = ?",
+                [(now, nid) for nid in ids],
+            )
+
+    def mark_notifications_failed(self, ids, error, retry_in, max_attempts):
+        """Schedule another attempt in ``retry_in`` seconds or give up."""
+        next_at = (datetime.now() + timedelta(seconds=retry_in)).isoformat()
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE notification_outbox SET attempts = attempts + 1, last_error = ?, "
+                "next_attempt_at = ?, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE id = ?",
+                [(str(error), next_at, max_attempts, nid) for nid in ids],
+            )
+
+    def purge_sent_notifications(self, days):
+        threshold = datetime.now() - timedelta(days=days)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM notification_outbox WHERE status = 'sent' AND sent_at < ?",
+                (threshold.isoformat(),),
+            )
+
+    def get_state(self, key, default=None):
+        row = self.connection().execute(
+            "SELECT value FROM agent_state WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO agent_state(key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+
+class BloomFilter:
+    """Bloom filter sized for ``capacity`` items at ``error_rate`` false hits."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class PrintedIndex:
+    """Long-lived view of ``printed_orders`` used for dedup checks.
+
+    Loaded once and then kept in sync by :func:`mark_as_printed` and
+    :func:`clean_old_printed_orders`, so the poll loop does not reload the
+    table every cycle. ``exact`` mode keeps every id in memory. ``bloom`` mode
+    keeps one Bloom filter per day and confirms hits with a primary key
+    lookup, so a false positive never skips a label.
+    """
+
+    MODES = ("exact", "bloom")
+
+    def __init__(self, storage, mode="exact", capacity=10000, error_rate=0.001):
+        if mode not in self.MODES:
+            raise ValueError(f"Nieznany tryb deduplikacji: {mode}")
+        self.storage = storage
+        self.mode = mode
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lookups = 0
+        self._lock = threading.Lock()
+        self._exact = {}
+        self._order = deque()
+        self._buckets = {}
+        for oid, ts in storage.iter_printed_orders():
+            self.add(oid, datetime.fromisoformat(ts))
+
+    def add(self, order_id, printed_at=None):
+        printed_at = printed_at or datetime.now()
+        with self._lock:
+            if self.mode == "exact":
+                if order_id not in self._exact:
+                    self._exact[order_id] = printed_at
+                    self._order.append((printed_at, order_id))
+                return
+            day = printed_at.date()
+            bucket = self._buckets.get(day)
+            if bucket is None:
+                bucket = self._buckets[day] = BloomFilter(self.capacity, self.error_rate)
+            bucket.add(order_id)
+
+    def __setitem__(self, order_id, printed_at):
+        self.add(order_id, printed_at)
+
+    def __contains__(self, order_id):
+        if self.mode == "exact":
+            return order_id in self._exact
+        with self._lock:
+            buckets = list(self._buckets.values())
+        if not any(order_id in bucket for bucket in buckets):
+            return False
+        self.lookups += 1
+        return self.storage.is_printed(order_id)
+
+    def __len__(self):
+        if self.mode == "exact":
+            return len(self._exact)
+        return sum(bucket.count for bucket in self._buckets.values())
+
+    def expire(self, threshold):
+        """Forget orders printed before ``threshold``."""
+        with self._lock:
+            if self.mode == "exact":
+                while self._order and self._order[0][0] < threshold:
+                    ts, oid = self._order.popleft()
+                    if self._exact.get(oid) == ts:
+                        del self._exact[oid]
+                return
+            # Filters cannot delete; whole days are dropped and the partial
+            # day left over is corrected by the confirming lookup.
+            for day in [d for d in self._buckets if d < threshold.date()]:
+                del self._buckets[day]
+
+
+_storage = None
+_storage_lock = threading.Lock()
+# Guards the module-wide components built on first use (``get_router``…).
+_components_lock = threading.RLock()
+
+
+def _active_component(name):
+    """The ``name`` component of the active agent or account, if it has one."""
+    return getattr(_active.get(), name, None)
+
+
+def get_last_order():
+    """Summary of the last order seen by the active agent or account."""
+    active = _active.get()
+    return last_order_data if active is None else active.last_order_data
+
+
+def _remember_last_order(data):
+    global last_order_data
+    active = _active.get()
+    if active is None:
+        last_order_data = data
+    else:
+        active.last_order_data = data
+
+
+def get_storage():
+    """Return the shared storage for ``DB_FILE``, creating it on first use.
+
+    Inside ``Agent.activate`` or ``Account.activate`` their own storage is
+    returned.
+    """
+    global _storage
+    active = _active.get()
+    if active is not None:
+        return active.storage
+    with _storage_lock:
+        if _storage is None or _storage.path != config.DB_FILE:
+            if _storage is not None:
+                _storage.close()
+            _storage = Storage(config.DB_FILE)
+        return _storage
+
+
+_printed_index = None
+
+
+def get_printed_index():
+    """Return the dedup index of the shared storage, loading it on first use."""
+    global _printed_index
+    active = _active.get()
+    if active is not None:
+        return active.printed_index()
+    storage = get_storage()
+    with _storage_lock:
+        if _printed_index is None or _printed_index.storage is not storage:
+            _printed_index = PrintedIndex(
+                storage, config.DEDUP_MODE, config.DEDUP_BLOOM_CAPACITY, config.DEDUP_BLOOM_ERROR
+            )
+        return _printed_index
+
+
+def ensure_db():
+    return get_storage()
+
+def ensure_db_init():
+    ensure_db()
+
+def load_printed_orders():
+    return get_storage().load_printed_orders()
+
+def mark_as_printed(order_id):
+    get_storage().mark_as_printed(order_id)
+    get_printed_index().add(order_id)
+
+def clean_old_printed_orders():
+    storage = get_storage()
+    days = settings().PRINTED_EXPIRY_DAYS
+    storage.clean_old_printed_orders(days)
+    get_printed_index().expire(datetime.now() - timedelta(days=days))
+    get_label_cache().evict()
+    storage.purge_done_queue(days)
+    storage.purge_sent_notifications(days)
+    storage.purge_order_states(days)
+
+def ensure_queue_file():
+    ensure_db()
+
+def load_queue():
+    return get_storage().load_queue()
+
+def enqueue_label(order_id, label, ext, last_order_data):
+    return get_storage().enqueue(order_id, label, ext, last_order_data)
+
+def plan_print_jobs(items, job_size):
+    """Split queue items into print jobs of at most ``job_size`` labels.
+
+    Labels keep their queue order and every job holds a single extension.
+    Labels of one order stay together in one job unless the order alone has
+    more than ``job_size`` labels.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault((item["order_id"], item.get("ext") or "pdf"), []).append(item)
+
+    job, job_ext = [], None
+    for (_, ext), group in groups.items():
+        if job and (ext != job_ext or len(job) + len(group) > job_size):
+            yield job
+            job = []
+        job_ext = ext
+        while len(group) > job_size:
+            if job:
+                yield job
+                job = []
+            yield group[:job_size]
+            group = group[job_size:]
+        job.extend(group)
+    if job:
+        yield job
+
+def drain_queue(printed, batch_size=None, job_size=None):
+    """Hand queued labels to their printers without waiting for them.
+
+    Each batch is routed to its printers and split into jobs of up to
+    ``job_size`` labels. Rows are claimed (``printing``) before they are
+    submitted, so the next drain skips them, and every job is finished by a
+    done-callback on its printer's thread: a jammed printer holds up only
+    its own labels, never the poll loop. ``get_router().wait()`` waits for
+    the jobs like for dispatched orders.
+    """
+    with metrics.time("bl_queue_drain_seconds"):
+        _drain_queue(printed, batch_size, job_size)
+
+def _print_queued_job(storage, job, worker):
+    try:
+        labels = [
+            (storage.read_label(it["label_ref"]), it.get("ext") or "pdf")
+            for it in job
+        ]
+        description = ", ".join(dict.fromkeys(it["order_id"] for it in job))
+        return all(label is not None for label, _ in labels) and (
+            worker.print_labels(labels, description)
+        )
+    except Exception as e:
+        logger.error(f"Błąd przetwarzania z kolejki: {e}")
+        return False
+
+def _finish_queued_job(storage, printed, job, future):
+    ids = [it["id"] for it in job]
+    try:
+        if future.exception() is not None or not future.result():
+            storage.mark_failed(ids, "print failed")
+            metrics.inc("bl_queue_labels_total", len(ids), result="failed")
+            return
+        finished = set(storage.finish_printing(ids))
+        metrics.inc("bl_queue_labels_total", len(ids), result="done")
+        orders = {}
+        for item in job:
+            orders.setdefault(item["order_id"], item)
+        for oid, item in orders.items():
+            mark_as_printed(oid)
+            printed[oid] = datetime.now()
+            if oid in finished:
+                notify_order(item["last_order_data"])
+    except Exception as e:
+        logger.error(f"Błąd przetwarzania z kolejki: {e}")
+
+def _drain_queue(printed, batch_size, job_size):
+    storage = get_storage()
+    batch_size = batch_size or settings().QUEUE_BATCH_SIZE
+    job_size = max(job_size or settings().PRINT_BATCH_SIZE, 1)
+    router = get_router()
+    plans = {}
+    last_id = 0
+    while True:
+        batch = storage.peek_batch(batch_size, after_id=last_id)
+        if not batch:
+            break
+        last_id = batch[-1]["id"]
+        storage.start_printing([it["id"] for it in batch])
+        groups = {}
+        for item in batch:
+            worker = router.route(item["last_order_data"], item.get("ext") or "pdf")
+            groups.setdefault(worker, []).append(item)
+        for worker, items in groups.items():
+            plans.setdefault(worker, []).extend(plan_print_jobs(items, job_size))
+
+    for worker, jobs in plans.items():
+        # the worker runs its jobs in order, so one session spans all of them
+        session = contextlib.ExitStack()
+        worker.submit(session.enter_context, worker.session())
+        for job in jobs:
+            future = worker.submit(_print_queued_job, storage, job, worker)
+            context = contextvars.copy_context()
+            router.track(
+                [it["order_id"] for it in job], future,
+                lambda f, job=job, context=context: context.run(
+                    _finish_queued_job, storage, printed, job, f
+                ),
+            )
+        worker.submit(session.close)
+
+class Metrics:
+    """Counters, gauges and histograms served by ``/metrics``.
+
+    Metrics are declared once and then updated by name, with optional
+    labels. ``collect`` registers a callback read at scrape time for values
+    that already live elsewhere (queue depth, API budget). ``render``
+    returns the Prometheus text format.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._series = {}
+        self._collectors = []
+
+    def counter(self, name, help):
+        self._meta[name] = ("counter", help, None)
+        self._series.setdefault(name, {})
+
+    def gauge(self, name, help):
+        self._meta[name] = ("gauge", help, None)
+        self._series.setdefault(name, {})
+
+    def histogram(self, name, help, buckets=None):
+        self._meta[name] = ("histogram", help, tuple(buckets or self.BUCKETS))
+        self._series.setdefault(name, {})
+
+    def collect(self, name, kind, help, fn, label=None, per_account=False):
+        """Read ``fn()`` at scrape time; with ``label`` it returns ``{value: number}``.
+
+        A ``per_account`` metric is read inside each account passed to
+        ``render`` and labelled with its name.
+        """
+        self._collectors.append((name, kind, help, fn, label, per_account))
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[name][key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = self._key(labels)
+        with self._lock:
+            series = self._series[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def value(self, name, **labels):
+        """Current value; ``(count, sum)`` for a histogram, ``None`` if unset."""
+        with self._lock:
+            value = self._series[name].get(self._key(labels))
+        if isinstance(value, list):
+            return value[2], value[1]
+        return value
+
+    def snapshot(self):
+        """Own series as plain data, for the ``/status`` summary."""
+        out = {}
+        with self._lock:
+            for name, series in self._series.items():
+                out[name] = {
+                    ",".join(f"{k}={v}" for k, v in key): (
+                        {"count": v[2], "sum": round(v[1], 6)} if isinstance(v, list) else v
+                    )
+                    for key, v in series.items()
+                }
+        return out
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self, accounts=()):
+        lines = []
+        with self._lock:
+            series = {
+                name: [
+                    (key, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+                    for key, v in values.items()
+                ]
+                for name, values in self._series.items()
+            }
+        for name, (kind, help, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in series[name]:
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, hits in zip(buckets, counts):
+                    cumulative += hits
+                    lines.append(
+                        f"{name}_bucket{self._labels(key + (('le', repr(float(bound))),))} {cumulative}"
+                    )
+                lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(key)} {total}")
+                lines.append(f"{name}_count{self._labels(key)} {count}")
+        for name, kind, help, fn, label, per_account in self._collectors:
+            samples, read = [], False
+            for account in (accounts if per_account and accounts else [None]):
+                try:
+                    if account is None:
+                        value = fn()
+                    else:
+                        with account.activate():
+                            value = fn()
+                except Exception as e:
+                    logger.debug(f"Metryka {name} niedostępna: {e}")
+                    continue
+                read = True
+                key = () if account is None else (("account", account.name),)
+                if label is None:
+                    samples.append(f"{name}{self._labels(key)} {value}")
+                else:
+                    for item, number in value.items():
+                        samples.append(f"{name}{self._labels(key + ((label, str(item)),))} {number}")
+            if not read:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.gauge("bl_start_time_seconds", "Unix time the agent started.")
+metrics.set("bl_start_time_seconds", time.time())
+metrics.counter("bl_api_requests_total", "BaseLinker API calls by method and HTTP status.")
+metrics.histogram("bl_api_request_seconds", "BaseLinker API call duration, including label download.")
+metrics.histogram("bl_api_throttle_seconds", "Time spent waiting for the API rate limiter.")
+metrics.counter("bl_print_jobs_total", "Printer jobs by backend and result.")
+metrics.counter("bl_labels_printed_total", "Labels sent to printers.")
+metrics.histogram("bl_print_job_seconds", "Time to hand one job to the printer backend.")
+metrics.counter("bl_messenger_messages_total", "Messenger messages by result.")
+metrics.histogram("bl_messenger_request_seconds", "Messenger Send API call duration.")
+metrics.counter("bl_queue_labels_total", "Queued labels handled by the drain, by result.")
+metrics.histogram("bl_queue_drain_seconds", "Duration of one queue drain.")
+metrics.counter("bl_poll_cycles_total", "Poll cycles run.")
+metrics.counter("bl_poll_errors_total", "Poll cycles that ended with an error.")
+metrics.counter("bl_orders_new_total", "New orders found by polls.")
+metrics.histogram("bl_poll_cycle_seconds", "Duration of one poll cycle, sleep excluded.")
+metrics.gauge("bl_last_poll_time_seconds", "Unix time the last poll cycle finished.")
+
+
+class RateLimiter:
+    """Token bucket keeping API calls within ``per_minute`` for one token.
+
+    Callers that find the bucket empty queue up instead of failing. Waiters
+    are served by priority lane first (lower number wins, see
+    ``API_METHOD_PRIORITY``) and in arrival order within a lane, so a label
+    download never waits behind a backlog of ``getOrders`` pages.
+    """
+
+    def __init__(self, per_minute, burst=None, clock=time.monotonic):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst or max(per_minute // 10, 1))
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._recent = deque()
+        self.throttled = 0
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        while self._recent and self._recent[0] <= now - 60:
+            self._recent.popleft()
+        return now
+
+    def acquire(self, priority=1):
+        """Block until a call may be made in the given priority lane."""
+        if self.per_minute <= 0:
+            return
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            waited = False
+            try:
+                while True:
+                    now = self._refill()
+                    if self._waiters[0] == ticket and self._tokens >= 1:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        self._recent.append(now)
+                        if waited:
+                            self.throttled += 1
+                        self._cond.notify_all()
+                        return
+                    waited = True
+                    timeout = None
+                    if self._waiters[0] == ticket:
+                        timeout = (1 - self._tokens) / self.rate
+                    self._cond.wait(timeout)
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    def usage(self):
+        """Return a snapshot of the current budget usage."""
+        with self._cond:
+            self._refill()
+            return {
+                "limit_per_minute": self.per_minute,
+                "used_last_minute": len(self._recent),
+                "tokens": round(self._tokens, 2),
+                "waiting": len(self._waiters),
+                "throttled": self.throttled,
+            }
+
+
+API_METHOD_PRIORITY = {
+    "getLabel": 0,
+    "getOrderPackages": 1,
+    "getOrders": 2,
+}
+
+api_limiter = None
+
+def get_api_limiter():
+    """The limiter of the active agent or account, else the shared one."""
+    global api_limiter
+    limiter = _active_component("limiter")
+    if limiter is not None:
+        return limiter
+    with _components_lock:
+        if api_limiter is None:
+            api_limiter = RateLimiter(config.API_RATE_LIMIT, config.API_RATE_BURST)
+        return api_limiter
+
+
+class HttpClient:
+    """Keep-alive HTTP session with retries, timeouts and latency stats.
+
+    Connections are pooled per host and reused across calls and threads.
+    Responses with status 429 or 5xx are retried with exponential backoff
+    (honouring ``Retry-After``); the last response is returned as is. With
+    ``idempotent=False`` only failed connections are retried: a request the
+    server may already have acted on is never sent twice, the caller owns
+    those retries.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout, retries=None, backoff=None, pool_size=None,
+                 idempotent=True):
+        self.timeout = timeout
+        retries = settings().API_RETRIES if retries is None else retries
+        backoff = settings().API_BACKOFF if backoff is None else backoff
+        resend = retries if idempotent else 0
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=resend,
+            status=resend,
+            other=resend,
+            backoff_factor=backoff,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        pool_size = pool_size or max(settings().FETCH_WORKERS, 1) * 2
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def post(self, url, name, **kwargs):
+        """POST to ``url`` and record the latency under ``name``."""
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.post(url, **kwargs)
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def _record(self, name, elapsed):
+        with self._lock:
+            stats = self._latency.setdefault(
+                name, {"count": 0, "total": 0.0, "max": 0.0}
+            )
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+
+    def latency_stats(self):
+        """Return ``{name: {count, avg, max}}`` for every recorded call."""
+        with self._lock:
+            return {
+                name: {
+                    "count": st["count"],
+                    "avg": st["total"] / st["count"],
+                    "max": st["max"],
+                }
+                for name, st in self._latency.items()
+            }
+
+    def close(self):
+        self.session.close()
+
+
+api_client = None
+messenger_client = None
+
+def make_api_client(config):
+    return HttpClient((config.API_CONNECT_TIMEOUT, config.API_READ_TIMEOUT))
+
+def make_messenger_client(config):
+    return HttpClient((config.API_CONNECT_TIMEOUT, config.MESSENGER_TIMEOUT), idempotent=False)
+
+def get_api_client():
+    """The BaseLinker session of the active agent, else the shared one."""
+    global api_client
+    client = _active_component("api_client")
+    if client is not None:
+        return client
+    with _components_lock:
+        if api_client is None:
+            api_client = make_api_client(config)
+        return api_client
+
+def get_messenger_client():
+    """The Messenger session of the active agent, else the shared one."""
+    global messenger_client
+    client = _active_component("messenger_client")
+    if client is not None:
+        return client
+    with _components_lock:
+        if messenger_client is None:
+            messenger_client = make_messenger_client(config)
+        return messenger_client
+
+class Base64StreamDecoder:
+    """Decode base64 text fed in arbitrary chunks."""
+
+    def __init__(self):
+        self._rest = ""
+
+    def feed(self, text):
+        text = self._rest + "".join(text.split())
+        cut = len(text) - len(text) % 4
+        self._rest = text[cut:]
+        return base64.b64decode(text[:cut]) if cut else b""
+
+    def finish(self):
+        rest, self._rest = self._rest, ""
+        if not rest:
+            return b""
+        return base64.b64decode(rest + "=" * (-len(rest) % 4))
+
+
+def read_streamed_field(chunks, field):
+    """Parse a JSON response while decoding its base64 ``field`` on the fly.
+
+    ``chunks`` are raw bytes of the response body. The value of ``field``
+    never exists as one string: it is decoded piece by piece into a byte
+    buffer. Returns the parsed document with ``field`` set to the decoded
+    ``bytearray`` (or left as it was when it is not a string); the buffer is
+    handed over as is to avoid a second copy of the label.
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    opening = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+    head, tail = [], []
+    data = bytearray()
+    b64 = Base64StreamDecoder()
+    state = "head"
+    carry = ""
+    for chunk in chunks:
+        text = text_decoder.decode(chunk)
+        if state == "head":
+            head.append(text)
+            joined = "".join(head)
+            match = opening.search(joined)
+            if not match:
+                continue
+            head = [joined[:match.end()]]
+            text = joined[match.end():]
+            state = "value"
+        if state == "value":
+            text = carry + text
+            carry = ""
+            end = text.find('"')
+            value = text if end < 0 else text[:end]
+            if end < 0 and value.endswith("\\"):
+                carry, value = "\\", value[:-1]
+            if "\\" in value:
+                # PHP escapes slashes; line breaks are only padding here
+                value = (
+                    value.replace("\\/", "/")
+                    .replace("\\n", "")
+                    .replace("\\r", "")
+                )
+            data += b64.feed(value)
+            if end < 0:
+                continue
+            tail.append(text[end:])
+            state = "tail"
+            continue
+        tail.append(text)
+    if state == "head":
+        return json.loads("".join(head) + text_decoder.decode(b"", final=True))
+    data += b64.finish()
+    document = json.loads(
+        "".join(head) + "".join(tail) + text_decoder.decode(b"", final=True)
+    )
+    document[field] = data
+    return document
+
+
+def call_api(method, parameters={}, binary_field=None):
+    """Call a BaseLinker method and return the decoded JSON response.
+
+    With ``binary_field`` the response is streamed and that base64 field is
+    decoded into bytes while it downloads (see ``read_streamed_field``).
+    """
+    active = _active.get()
+    api = getattr(active, "api", None)
+    if api is not None:
+        return api(method, parameters, binary_field)
+    status, start = "error", None
+    headers = active.headers if active is not None else api_headers(config.API_TOKEN)
+    try:
+        with metrics.time("bl_api_throttle_seconds"):
+            get_api_limiter().acquire(API_METHOD_PRIORITY.get(method, 1))
+        start = time.perf_counter()
+        payload = {
+            "method": method,
+            "parameters": json.dumps(parameters)
+        }
+        response = get_api_client().post(
+            settings().BASE_URL, method, headers=headers, data=payload,
+            stream=binary_field is not None,
+        )
+        status = response.status_code
+        logger.info(
+            f"[{method}] {response.status_code}",
+            extra={"method": method, "status": status},
+        )
+        if binary_field is not None:
+            with response:
+                return read_streamed_field(
+                    response.iter_content(LABEL_CHUNK_SIZE), binary_field
+                )
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error in call_api({method}): {e}", extra={"method": method})
+    except Exception as e:
+        logger.error(f"Błąd w call_api({method}): {e}", extra={"method": method})
+    finally:
+        metrics.inc("bl_api_requests_total", method=method, status=status)
+        if start is not None:
+            metrics.observe("bl_api_request_seconds", time.perf_counter() - start, method=method)
+    return {}
+
+ORDERS_PAGE_SIZE = 100
+
+def iter_orders(parameters=None, max_pages=None):
+    """Yield orders in ``STATUS_ID`` page by page.
+
+    ``getOrders`` returns at most ``ORDERS_PAGE_SIZE`` orders sorted by
+    ``date_confirmed``; the next page starts at the last confirmation date
+    seen. A full page confirmed within one second is paged through with
+    ``id_from`` before moving on to the next second. Orders are yielded as
+    soon as their page arrives, so callers can start working before paging
+    is done. ``status_id=None`` in ``parameters`` reads orders of every
+    status.
+    """
+    params = {"status_id": settings().STATUS_ID, **(parameters or {})}
+    if params["status_id"] is None:
+        del params["status_id"]
+    max_pages = max_pages or settings().ORDERS_MAX_PAGES
+    seen = set()
+    page = 0
+    tie = None
+    while True:
+        page += 1
+        response = call_api("getOrders", params)
+        log_raw_payload("getOrders", response)
+        orders = response.get("orders", [])
+        logger.info(f"🔍 Zamówień znalezionych: {len(orders)} (strona {page})")
+        for order in orders:
+            if order["order_id"] in seen:
+                continue
+            seen.add(order["order_id"])
+            yield order
+        if page >= max_pages:
+            break
+        full = len(orders) >= ORDERS_PAGE_SIZE
+        dates = [int(o.get("date_confirmed") or 0) for o in orders]
+        if tie is not None:
+            if full and dates[-1] == tie:
+                params["id_from"] = max(int(o["order_id"]) for o in orders) + 1
+            else:
+                # the tied second is exhausted; go on from the next one
+                del params["id_from"]
+                params["date_confirmed_from"] = tie + 1
+                tie = None
+            continue
+        if not full:
+            break
+        if dates[0] == dates[-1]:
+            # a whole page within one second; page through it by order id
+            tie = dates[-1]
+            params["id_from"] = max(int(o["order_id"]) for o in orders) + 1
+        params["date_confirmed_from"] = dates[-1]
+
+def get_orders(parameters=None):
+    return list(iter_orders(parameters))
+
+def iter_new_orders(orders, printed, found):
+    """Yield ids of orders not printed yet and remember their summary.
+
+    ``found`` maps each yielded order id to the data used for printing and
+    notifications.
+    """
+    for order in orders:
+        order_id = str(order["order_id"])
+
+        data = {
+            "order_id": order_id,
+            "name": order.get("delivery_fullname", "Nieznany klient"),
+            "platform": order.get("order_source", "brak"),
+            "shipping": order.get("delivery_method", "brak"),
+            "products": order.get("products", []),
+            "status": order.get("order_status_id"),
+            "courier": order.get("delivery_package_module"),
+        }
+        _remember_last_order(data)
+
+        if order_id in printed:
+            continue
+
+        logger.info(
+            f"📜 Zamówienie {order_id} ({data['name']})",
+            extra={"order_id": order_id},
+        )
+        found[order_id] = data
+        yield order_id
+
+class OrderPoller:
+    """Fetch only the orders that reached the watched statuses since the last poll.
+
+    Modes (``ORDER_POLL_MODE``):
+
+    * ``full`` – every poll asks for all orders in the status,
+    * ``journal`` – follows status changes from ``getJournalList`` and falls
+      back to a full scan when the journal is unavailable,
+    * ``watermark`` – asks ``getOrders`` for orders confirmed since the
+      persisted ``(date_confirmed, order_id)`` watermark. An order confirmed
+      before the watermark and moved into the status later is not returned
+      until the next full scan.
+
+    Watermarks move only in ``commit`` and only past orders the caller
+    reports as finished, so an order whose label is not ready yet is asked
+    for again on the next poll. The journal cursor always moves past the
+    events read; orders from it that are still waiting for their labels are
+    kept in the ``fetched`` state and asked for again until they are printed
+    or leave the status. A full scan is made on the first poll and then
+    every ``resync_minutes``, catching what the journal or watermark missed.
+
+    ``statuses`` defaults to ``STATUS_ID``. With several statuses one
+    ``getOrders`` stream without a status filter serves them all; orders in
+    other statuses only move the watermark.
+    """
+
+    JOURNAL_STATUS_CHANGED = 18
+    JOURNAL_PAGE_SIZE = 100
+    JOURNAL_SEED_PAGES = 50
+    JOURNAL_POLL_PAGES = 10
+
+    def __init__(self, storage, mode=None, resync_minutes=None, statuses=None,
+                 clock=time.monotonic):
+        config = settings()
+        self.storage = storage
+        self.mode = mode or config.ORDER_POLL_MODE
+        self.statuses = {int(s) for s in statuses or [config.STATUS_ID]}
+        self.resync_minutes = config.ORDER_RESYNC_MINUTES if resync_minutes is None else resync_minutes
+        self._clock = clock
+        self._scanned_at = None
+        self._pending = []
+        self._pending_key = None
+        self._waiting = []
+        self._journal_head = None
+
+    def _resync_due(self):
+        if self.resync_minutes <= 0:
+            return False
+        now = self._clock()
+        if self._scanned_at is not None and now - self._scanned_at < self.resync_minutes * 60:
+            return False
+        self._scanned_at = now
+        return True
+
+    def poll(self):
+        """Yield orders to handle; pass the finished ones to ``commit``."""
+        self._pending = []
+        self._pending_key = None
+        self._waiting = []
+        self._journal_head = None
+        if self.mode == "full":
+            yield from self._scan()
+            return
+        resync = self._resync_due()
+        if self.mode == "journal":
+            orders = None if resync else self._poll_journal()
+            if orders is None and self.storage.get_state("orders.journal_log_id") is None:
+                # taken before the scan, so orders arriving during it are
+                # still read from the journal on the next poll
+                self._journal_head = self._seed_journal()
+            yield from self._scan() if orders is None else orders
+            return
+        mark = self.storage.get_state("orders.watermark")
+        self._pending_key = "orders.watermark"
+        if mark is None or resync:
+            orders = self._scan()
+        else:
+            orders = iter_orders({"date_confirmed_from": mark[0], **self._status_filter()})
+        for order in orders:
+            key = self._date_key(order)
+            if mark is not None and not resync and key <= tuple(mark):
+                continue
+            if not self._watched(order):
+                self._pending.append((key, None))
+                continue
+            self._pending.append((key, str(order["order_id"])))
+            yield order
+
+    def _status_filter(self, status=None):
+        """``getOrders`` parameters selecting ``status`` or all watched ones."""
+        if status is None:
+            if len(self.statuses) > 1:
+                return {"status_id": None}
+            (status,) = self.statuses
+        return {} if status == settings().STATUS_ID else {"status_id": status}
+
+    def _scan(self):
+        for status in sorted(self.statuses):
+            yield from iter_orders(self._status_filter(status))
+
+    def _watched(self, order):
+        if len(self.statuses) == 1:
+            return True
+        return int(order.get("order_status_id") or 0) in self.statuses
+
+    @staticmethod
+    def _date_key(order):
+        return (int(order.get("date_confirmed") or 0), int(order["order_id"]))
+
+    def _journal_page(self, last_log_id):
+        response = call_api("getJournalList", {
+            "last_log_id": last_log_id,
+            "logs_types": [self.JOURNAL_STATUS_CHANGED],
+        })
+        if response.get("status") != "SUCCESS":
+            return None
+        return response.get("logs", [])
+
+    def _poll_journal(self):
+        last_log_id = self.storage.get_state("orders.journal_log_id")
+        if last_log_id is None:
+            return None
+        logs = []
+        for _ in range(self.JOURNAL_POLL_PAGES):
+            page = self._journal_page(last_log_id)
+            if page is None:
+                if logs:
+                    break
+                logger.warning("getJournalList niedostępne, używam znacznika daty")
+                return None
+            logs.extend(page)
+            if len(page) < self.JOURNAL_PAGE_SIZE:
+                break
+            last_log_id = max(int(log["log_id"]) for log in page)
+        orders = []
+        seen = set()
+        for oid in self.storage.fetched_orders():
+            # still waiting for labels from an earlier poll
+            seen.add(oid)
+            found = self._fetch_order(oid)
+            if not found:
+                self.storage.forget_fetched(oid)
+            orders.extend(found)
+        for log in logs:
+            oid = str(log.get("order_id"))
+            if int(log.get("object_id") or 0) not in self.statuses or oid in seen:
+                continue
+            seen.add(oid)
+            if not self.storage.is_printed(oid):
+                orders.extend(self._fetch_order(oid))
+        self._pending_key = "orders.journal_log_id"
+        self._pending = [(int(log["log_id"]), None) for log in logs]
+        self._waiting = [str(o["order_id"]) for o in orders]
+        return orders
+
+    def _fetch_order(self, oid):
+        return [
+            o for o in iter_orders(
+                {"order_id": int(oid), **self._status_filter()}, max_pages=1
+            )
+            if self._watched(o)
+        ]
+
+    def _seed_journal(self):
+        """Return the newest journal event, where following the journal starts."""
+        last_log_id = 0
+        for _ in range(self.JOURNAL_SEED_PAGES):
+            logs = self._journal_page(last_log_id)
+            if not logs:
+                break
+            last_log_id = max(int(log["log_id"]) for log in logs)
+            if len(logs) < self.JOURNAL_PAGE_SIZE:
+                break
+        return last_log_id
+
+    def commit(self, finished):
+        """Advance the watermark past the leading run of ``finished`` orders.
+
+        Journal orders that are not finished are kept as ``fetched``.
+        """
+        for oid in self._waiting:
+            if oid not in finished:
+                self.storage.record_fetched(oid, {"order_id": oid})
+        mark = None
+        for key, oid in sorted(self._pending, key=lambda e: e[0]):
+            if oid is not None and oid not in finished:
+                break
+            mark = key
+        if mark is not None:
+            current = self.storage.get_state(self._pending_key)
+            if current is None or _as_key(mark) > _as_key(current):
+                self.storage.set_state(self._pending_key, mark)
+        if (
+            self._journal_head is not None
+            and self.storage.get_state("orders.journal_log_id") is None
+        ):
+            self.storage.set_state("orders.journal_log_id", self._journal_head)
+        self._pending = []
+        self._pending_key = None
+        self._waiting = []
+        self._journal_head = None
+
+def _as_key(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else value
+
+def get_order_packages(order_id):
+    response = call_api("getOrderPackages", {
+        "order_id": order_id
+    })
+    return response.get("packages", [])
+
+def get_label(courier_code, package_id):
+    """Return the decoded label bytes (or ``None``) and its extension."""
+    response = call_api("getLabel", {
+        "courier_code": courier_code,
+        "package_id": package_id
+    }, binary_field="label")
+    label = response.get("label")
+    return label or None, response.get("extension", "pdf")
+
+class LabelCache:
+    """Labels already fetched, keyed by ``(courier_code, package_id)``.
+
+    Entries live in SQLite for ``days`` and the least recently used ones are
+    evicted once the cache outgrows ``max_bytes``, so a retried or restarted
+    order does not call ``getLabel`` again. ``days=0`` disables the cache.
+    """
+
+    def __init__(self, storage_factory=None, days=None, max_bytes=None):
+        self.storage_factory = storage_factory or get_storage
+        self.days = settings().LABEL_CACHE_DAYS if days is None else days
+        self.max_bytes = settings().LABEL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, courier_code, package_id):
+        if not self.days:
+            return None
+        found = self.storage_factory().cached_label(courier_code, package_id, self.days)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def put(self, courier_code, package_id, order_id, label, ext):
+        if self.days:
+            self.storage_factory().cache_label(courier_code, package_id, order_id, label, ext)
+
+    def order_labels(self, order_id):
+        return self.storage_factory().order_labels(order_id)
+
+    def evict(self):
+        if self.days:
+            return self.storage_factory().evict_label_cache(self.days, self.max_bytes)
+        return 0
+
+    def stats(self):
+        entries, size = self.storage_factory().label_cache_size()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+label_cache = None
+
+def get_label_cache():
+    """The label cache of the active agent, else the shared one."""
+    global label_cache
+    cache = _active_component("label_cache")
+    if cache is not None:
+        return cache
+    with _components_lock:
+        if label_cache is None:
+            label_cache = LabelCache()
+        return label_cache
+
+def fetch_order_labels(order_id):
+    """Fetch packages and labels of one order as ``(label, ext)`` pairs."""
+    with log_context(order_id=order_id):
+        packages = get_order_packages(order_id)
+        cache = get_label_cache()
+        labels = []
+
+        for p in packages:
+            package_id = p.get("package_id")
+            courier_code = p.get("courier_code")
+            if not package_id or not courier_code:
+                logger.warning(
+                    f"  Brak danych: package_id lub courier_code ({order_id})"
+                )
+                continue
+
+            logger.info(f"  📦 Paczka {package_id} (kurier: {courier_code})")
+
+            cached = cache.get(courier_code, package_id)
+            if cached:
+                label, ext = cached
+            else:
+                label, ext = get_label(courier_code, package_id)
+                if label:
+                    cache.put(courier_code, package_id, order_id, label, ext)
+            if label:
+                labels.append((label, ext))
+            else:
+                logger.warning(f"  ❌ Brak etykiety (label_data = null) ({order_id})")
+        return labels
+
+def submit_in_context(pool, fn, *args):
+    """``pool.submit`` that runs ``fn`` in the caller's context (its agent or account)."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+def fetch_labels_concurrently(order_ids, workers=None, pool=None):
+    """Yield ``(order_id, labels)`` in the order of ``order_ids``.
+
+    Orders are fetched in parallel by a pool of ``workers`` threads (or by
+    the shared ``pool``), but results are handed back in the original
+    order, so printing and ``mark_as_printed`` keep their sequence.
+    ``order_ids`` may be a lazy iterator; work starts as soon as each id
+    arrives.
+    """
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(ThreadPoolExecutor(
+                max_workers=workers or settings().FETCH_WORKERS, thread_name_prefix="fetch"
+            ))
+        pending = deque()
+        for oid in order_ids:
+            pending.append((oid, submit_in_context(pool, fetch_order_labels, oid)))
+            while pending and pending[0][1].done():
+                yield _fetched(*pending.popleft())
+        while pending:
+            yield _fetched(*pending.popleft())
+
+def _fetched(oid, future):
+    try:
+        labels = future.result()
+    except Exception as e:
+        logger.error(f"Błąd pobierania etykiet dla {oid}: {e}")
+        labels = []
+    return oid, labels
+
+class PrinterBackend:
+    """Base class for the ways a label can reach the printer.
+
+    ``print_job`` sends a list of documents sharing one extension as a
+    single job and returns ``True`` on success. ``on_status`` (if given) is
+    called as ``on_status(title, status, detail)`` with ``submitted``,
+    ``completed`` or ``failed``. Backends that hold a connection keep it open
+    for the duration of ``session()``, so a queue drain reuses it.
+    """
+
+    name = "base"
+
+    def __init__(self, on_status=None):
+        self.on_status = on_status
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def _notify(self, title, status, detail=""):
+        if self.on_status:
+            try:
+                self.on_status(title, status, detail)
+            except Exception as e:
+                logger.error(f"Błąd callbacku statusu drukarki: {e}")
+
+    @contextlib.contextmanager
+    def session(self):
+        with self._lock:
+            self._depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.close()
+
+    def print_job(self, documents, extension, title):
+        self._notify(title, "submitted")
+        try:
+            with self._lock:
+                detail = self._send(documents, extension, title)
+                if self._depth == 0:
+                    self.close()
+        except Exception as e:
+            self.close()
+            self._notify(title, "failed", str(e))
+            raise
+        self._notify(title, "completed", detail or "")
+        return True
+
+    def _send(self, documents, extension, title):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PrintError(Exception):
+    pass
+
+
+class LpBackend(PrinterBackend):
+    """Default backend: hands jobs to CUPS through ``lp``.
+
+    Nothing is written to disk. A single document goes to ``lp -`` on stdin;
+    several documents of one job are passed as in-memory files
+    (``memfd_create``) the ``lp`` process reads through ``/dev/fd``.
+    """
+
+    name = "lp"
+
+    def __init__(self, printer=None, on_status=None):
+        super().__init__(on_status)
+        self.printer = printer
+
+    def _send(self, documents, extension, title):
+        command = ["lp", "-d", self.printer or settings().PRINTER_NAME, "-t", title]
+        if len(documents) == 1 or not hasattr(os, "memfd_create"):
+            detail = []
+            for content in documents:
+                result = subprocess.run(
+                    command + ["-"], input=content, capture_output=True,
+                    timeout=settings().PRINT_TIMEOUT,
+                )
+                self._check(result)
+                detail.append(result.stdout.decode().strip())
+            return " ".join(detail)
+        fds = []
+        try:
+            for i, content in enumerate(documents):
+                fd = os.memfd_create(f"{title}_{i}")
+                fds.append(fd)
+                view = memoryview(content)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.lseek(fd, 0, os.SEEK_SET)
+            result = subprocess.run(
+                command + [f"/dev/fd/{fd}" for fd in fds],
+                capture_output=True,
+                pass_fds=fds,
+                timeout=settings().PRINT_TIMEOUT,
+            )
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self._check(result)
+        return result.stdout.decode().strip()
+
+    @staticmethod
+    def _check(result):
+        if result.returncode != 0:
+            raise PrintError(
+                f"lp (kod {result.returncode}): {result.stderr.decode().strip()}"
+            )
+
+
+class RawSocketBackend(PrinterBackend):
+    """Raw TCP printing (JetDirect / port 9100) over a reusable connection.
+
+    Meant for label printers speaking ZPL/EPL, which print data as it
+    arrives on the socket.
+    """
+
+    name = "socket"
+
+    def __init__(self, host, port=9100, timeout=10, on_status=None):
+        super().__init__(on_status)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self.connections = 0
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.connections += 1
+        return self._sock
+
+    def _send(self, documents, extension, title):
+        for attempt in (1, 2):
+            try:
+                sock = self._connect()
+                for content in documents:
+                    sock.sendall(content)
+                return ""
+            except OSError:
+                # the printer may have dropped an idle connection; retry once
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+
+class IppBackend(PrinterBackend):
+    """IPP ``Print-Job`` requests over a keep-alive HTTP session."""
+
+    name = "ipp"
+    MIME_TYPES = {"pdf": "application/pdf", "txt": "text/plain"}
+
+    def __init__(self, uri, timeout=30, on_status=None):
+        super().__init__(on_status)
+        self.uri = uri
+        scheme, rest = uri.split("://", 1)
+        self.url = ("https" if scheme == "ipps" else "http") + "://" + rest
+        if ":" not in rest.split("/", 1)[0]:
+            host, _, path = rest.partition("/")
+            self.url = ("https" if scheme == "ipps" else "http") + f"://{host}:631/{path}"
+        self.timeout = timeout
+        self.session_http = requests.Session()
+        self._request_id = itertools.count(1)
+
+    @staticmethod
+    def _attr(tag, name, value):
+        name = name.encode()
+        value = value.encode() if isinstance(value, str) else value
+        return (
+            struct.pack(">BH", tag, len(name)) + name
+            + struct.pack(">H", len(value)) + value
+        )
+
+    def _request(self, document, extension, title):
+        mime = self.MIME_TYPES.get(extension.lower(), "application/octet-stream")
+        return (
+            struct.pack(">BBHI", 1, 1, 0x0002, next(self._request_id))
+            + b"\x01"
+            + self._attr(0x47, "attributes-charset", "utf-8")
+            + self._attr(0x48, "attributes-natural-language", "en")
+            + self._attr(0x45, "printer-uri", self.uri)
+            + self._attr(0x42, "requesting-user-name", "bl-print-agent")
+            + self._attr(0x42, "job-name", title)
+            + self._attr(0x49, "document-format", mime)
+            + b"\x03"
+            + document
+        )
+
+    @staticmethod
+    def parse_response(body):
+        """Return ``(status_code, job_id)`` from an IPP response."""
+        status = struct.unpack(">H", body[2:4])[0]
+        job_id = None
+        pos = 8
+        while pos < len(body):
+            tag = body[pos]
+            pos += 1
+            if tag <= 0x0F:
+                if tag == 0x03:
+                    break
+                continue
+            name_len = struct.unpack(">H", body[pos:pos + 2])[0]
+            name = body[pos + 2:pos + 2 + name_len]
+            pos += 2 + name_len
+            value_len = struct.unpack(">H", body[pos:pos + 2])[0]
+            value = body[pos + 2:pos + 2 + value_len]
+            pos += 2 + value_len
+            if name == b"job-id" and value_len == 4:
+                job_id = struct.unpack(">i", value)[0]
+        return status, job_id
+
+    def _send(self, documents, extension, title):
+        job_ids = []
+        for document in documents:
+            response = self.session_http.post(
+                self.url,
+                data=self._request(document, extension, title),
+                headers={"Content-Type": "application/ipp"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            status, job_id = self.parse_response(response.content)
+            if status >= 0x0100:
+                raise PrintError(f"IPP status 0x{status:04x}")
+            job_ids.append(str(job_id))
+        return "job-id " + ",".join(job_ids)
+
+    def close(self):
+        # the HTTP session is the persistent connection; it stays open
+        pass
+
+
+class FileBackend(PrinterBackend):
+    """Writes every job to a file in ``directory``; useful for tests."""
+
+    name = "file"
+
+    def __init__(self, directory, on_status=None):
+        super().__init__(on_status)
+        self.directory = directory
+        self._counter = itertools.count(1)
+
+    def _send(self, documents, extension, title):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f"{next(self._counter):06d}_{title}.{extension}"
+        )
+        with open(path, "wb") as f:
+            for content in documents:
+                f.write(content)
+        return path
+
+
+class NullBackend(PrinterBackend):
+    """Accepts and discards every job, remembering what was sent."""
+
+    name = "null"
+
+    def __init__(self, on_status=None):
+        super().__init__(on_status)
+        self.jobs = []
+
+    def _send(self, documents, extension, title):
+        self.jobs.append((title, extension, list(documents)))
+        return ""
+
+
+def make_printer_backend(spec=None, on_status=None):
+    """Build a backend from a ``PRINTER_BACKEND`` spec.
+
+    ``lp`` (default), ``lp:<printer>``, ``socket://host[:9100]``,
+    ``ipp://host[:631]/printers/name``, ``file:///directory`` or ``null``.
+    """
+    spec = (spec or "lp").strip()
+    if spec == "lp":
+        return LpBackend(on_status=on_status)
+    if spec.startswith("lp:"):
+        return LpBackend(spec[3:], on_status=on_status)
+    if spec == "null":
+        return NullBackend(on_status=on_status)
+    if spec.startswith("file://"):
+        return FileBackend(spec[len("file://"):], on_status=on_status)
+    if spec.startswith("socket://"):
+        host, _, port = spec[len("socket://"):].rstrip("/").partition(":")
+        return RawSocketBackend(host, int(port or 9100), on_status=on_status)
+    if spec.startswith(("ipp://", "ipps://")):
+        return IppBackend(spec, on_status=on_status)
+    raise ValueError(f"Nieznany backend drukarki: {spec}")
+
+
+def log_print_status(title, status, detail=""):
+    logger.debug(f"Zlecenie druku {title}: {status} {detail}".rstrip())
+
+
+printer = None
+
+def get_printer():
+    """The default printer backend of the active agent, else the shared one."""
+    global printer
+    backend = _active_component("printer")
+    if backend is not None:
+        return backend
+    with _components_lock:
+        if printer is None:
+            printer = make_printer_backend(config.PRINTER_BACKEND, on_status=log_print_status)
+        return printer
+
+def _timed_print_job(backend, documents, extension, title, labels):
+    backend = backend or get_printer()
+    result = "error"
+    try:
+        with metrics.time("bl_print_job_seconds", backend=backend.name):
+            backend.print_job(documents, extension, title)
+        result = "ok"
+        metrics.inc("bl_labels_printed_total", labels, backend=backend.name)
+    finally:
+        metrics.inc("bl_print_jobs_total", backend=backend.name, result=result)
+
+def print_label(label, extension, order_id, backend=None):
+    """Print decoded label bytes and return ``True`` on success."""
+    try:
+        _timed_print_job(backend, [label], extension, f"label_{order_id}", 1)
+        logger.info(f"📨 Etykieta wydrukowana dla zamówienia {order_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Błąd drukowania: {e}")
+        return False
+
+RAW_LABEL_FORMATS = ("zpl", "epl", "dpl")
+
+def print_labels(labels, description="", backend=None):
+    """Print several ``(bytes, ext)`` labels as one printer job.
+
+    Raw printer languages (ZPL, EPL, DPL) are concatenated into a single
+    document; other formats are sent as several documents of one job.
+    Returns ``True`` on success.
+    """
+    if len(labels) == 1:
+        label, ext = labels[0]
+        return print_label(label, ext, description, backend)
+    ext = labels[0][1]
+    if ext.lower() in RAW_LABEL_FORMATS:
+        documents = [b"".join(label for label, _ in labels)]
+    else:
+        documents = [label for label, _ in labels]
+    try:
+        _timed_print_job(backend, documents, ext, f"labels_{len(labels)}", len(labels))
+        logger.info(
+            f"📨 Wydrukowano {len(labels)} etykiet jednym zleceniem ({description})"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Błąd drukowania: {e}")
+        return False
+
+def print_test_page():
+    try:
+        get_printer().print_job([b"=== TEST PRINT ===\n"], "txt", "print_test")
+        logger.info("🔧 Testowa strona została wysłana do drukarki.")
+        return True
+    except Exception as e:
+        logger.error(f"Błąd testowego druku: {e}")
+        return False
+
+ROUTE_KEYS = ("status", "courier", "source", "ext")
+
+def load_printer_routes(spec):
+    """Parse ``PRINTER_ROUTES``: a JSON list of rules or a path to one."""
+    spec = (spec or "").strip()
+    if not spec:
+        return []
+    if not spec.startswith("["):
+        with open(spec, encoding="utf-8") as f:
+            spec = f.read()
+    routes = []
+    for rule in json.loads(spec):
+        if not rule.get("printer"):
+            raise ValueError(f"Reguła routingu bez drukarki: {rule}")
+        unknown = set(rule) - set(ROUTE_KEYS) - {"printer"}
+        if unknown:
+            raise ValueError(f"Nieznane pola reguły routingu: {', '.join(sorted(unknown))}")
+        route = {"printer": rule["printer"]}
+        for key in ROUTE_KEYS:
+            if key in rule:
+                values = rule[key] if isinstance(rule[key], list) else [rule[key]]
+                route[key] = {str(v).lower() for v in values}
+        routes.append(route)
+    return routes
+
+
+class PrintWorker:
+    """A printer with its own job thread; jobs for one printer run in order."""
+
+    def __init__(self, name, backend=None):
+        self.name = name
+        self.backend = backend
+        self._pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"print-{name}"
+        )
+
+    def submit(self, fn, *args):
+        return submit_in_context(self._pool, fn, *args)
+
+    def print_labels(self, labels, description=""):
+        with log_context(order_id=description, printer=self.name):
+            return print_labels(labels, description, self.backend)
+
+    def session(self):
+        return (self.backend or get_printer()).session()
+
+
+class PrinterRouter:
+    """Send every label to the printer chosen by the routing table.
+
+    Rules look like ``{"printer": "socket://10.0.0.5", "status": [91618],
+    "courier": ["dpd"], "source": ["allegro"], "ext": ["zpl"]}``; the first
+    rule whose conditions all match wins and other labels go to the default
+    ``printer``. Each printer has its own worker thread, so a jammed printer
+    only holds up its own labels. Orders stay in ``in_flight`` until all of
+    their labels are handled.
+
+    ``default`` and ``status_id`` stand in for ``printer`` and ``STATUS_ID``
+    (for an account); workers in ``pool`` are shared with other routers, so
+    accounts printing on one printer share its queue.
+    """
+
+    def __init__(self, routes=(), on_status=None, default=None, pool=None, status_id=None):
+        self.routes = list(routes)
+        self.default = default or PrintWorker("default")
+        self.status_id = status_id
+        pool = {} if pool is None else pool
+        self.workers = {}
+        for route in self.routes:
+            spec = route["printer"]
+            if spec in self.workers or (spec == settings().PRINTER_BACKEND and default is None):
+                continue
+            if spec not in pool:
+                pool[spec] = PrintWorker(spec, None if spec == settings().PRINTER_BACKEND else (
+                    make_printer_backend(spec, on_status=on_status)
+                ))
+            self.workers[spec] = pool[spec]
+        self.in_flight = {}
+        self._lock = threading.Lock()
+
+    def statuses(self):
+        """``STATUS_ID`` plus every status named in the routing table."""
+        found = {settings().STATUS_ID if self.status_id is None else self.status_id}
+        for route in self.routes:
+            found.update(int(s) for s in route.get("status", ()))
+        return found
+
+    def all_workers(self):
+        return [self.default, *self.workers.values()]
+
+    def route(self, order_data, ext):
+        values = {
+            "status": order_data.get("status"),
+            "courier": order_data.get("courier"),
+            "source": order_data.get("platform"),
+            "ext": ext,
+        }
+        for route in self.routes:
+            if all(
+                str(values[key]).lower() in route[key]
+                for key in ROUTE_KEYS if key in route
+            ):
+                return self.workers.get(route["printer"], self.default)
+        return self.default
+
+    def dispatch(self, order_id, queued, order_data):
+        """Print an order's queued labels, given as ``(queue_id, label, ext)``.
+
+        Rows a printer handled become done and a fully printed order is
+        notified; rows a printer failed on go back to the queue, so the
+        queue drain retries them.
+        """
+        groups = {}
+        for qid, label, ext in queued:
+            # one job holds a single extension, as in plan_print_jobs
+            key = (self.route(order_data, ext), ext)
+            groups.setdefault(key, []).append((qid, label, ext))
+        get_storage().start_printing([qid for qid, _, _ in queued])
+        jobs = [
+            (
+                worker,
+                [qid for qid, _, _ in group],
+                worker.submit(
+                    worker.print_labels, [(label, ext) for _, label, ext in group], order_id
+                ),
+            )
+            for (worker, _), group in groups.items()
+        ]
+        left = [len(jobs)]
+        context = contextvars.copy_context()
+        futures = [future for _, _, future in jobs]
+        self._hold([order_id], futures)
+
+        def done(_):
+            with self._lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            try:
+                with log_context(order_id=order_id):
+                    context.run(self._finish, order_id, order_data, jobs)
+            finally:
+                self._release([order_id], futures)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def track(self, order_ids, future, callback):
+        """Keep ``order_ids`` in flight until ``callback(future)`` has run."""
+        self._hold(order_ids, [future])
+
+        def done(f):
+            try:
+                callback(f)
+            finally:
+                self._release(order_ids, [f])
+
+        future.add_done_callback(done)
+
+    def _hold(self, order_ids, futures):
+        with self._lock:
+            for oid in order_ids:
+                self.in_flight.setdefault(oid, []).extend(futures)
+
+    def _release(self, order_ids, futures):
+        with self._lock:
+            for oid in order_ids:
+                held = [f for f in self.in_flight.get(oid, ()) if f not in futures]
+                if held:
+                    self.in_flight[oid] = held
+                else:
+                    self.in_flight.pop(oid, None)
+
+    def _finish(self, order_id, order_data, jobs):
+        storage = get_storage()
+        try:
+            done_ids = []
+            for worker, ids, future in jobs:
+                if future.exception() is None and future.result():
+                    done_ids.extend(ids)
+                    continue
+                logger.warning(
+                    f"Etykiety zamówienia {order_id} wracają do kolejki ({worker.name})"
+                )
+                storage.mark_failed(ids, "print failed")
+            if order_id in storage.finish_printing(done_ids):
+                notify_order(order_data)
+        except Exception as e:
+            logger.error(f"Błąd obsługi zamówienia {order_id}: {e}")
+
+    def wait(self, timeout=None):
+        """Block until the orders dispatched so far are handled."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.in_flight:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+router = None
+
+def get_router():
+    """Return the printer router of the active agent or account, or the module-wide one."""
+    global router
+    active = _active.get()
+    if active is not None:
+        return active.router
+    with _components_lock:
+        if router is None:
+            router = PrinterRouter(
+                load_printer_routes(config.PRINTER_ROUTES), on_status=log_print_status
+            )
+        return router
+
+def handle_order(order_id, labels, order_data, quiet=False):
+    """Take an order with fetched labels through its print states.
+
+    ``fetched`` → ``queued`` → ``printing`` → ``printed`` → ``notified``;
+    every step is one transaction, so :func:`recover_orders` can resume an
+    order after a crash. In quiet hours the order stays queued (and is
+    notified at once) until the queue is drained.
+    """
+    storage = get_storage()
+    storage.record_fetched(order_id, order_data)
+    ids = storage.queue_order(order_id, labels, order_data, notify=quiet)
+    logger.debug(f"Zamówienie {order_id} w kolejce ({len(ids)} etykiet)", extra={"order_id": order_id})
+    get_printed_index().add(order_id)
+    if quiet:
+        get_notifier().wake()
+        return
+    get_router().dispatch(
+        order_id,
+        [(qid, label, ext) for qid, (label, ext) in zip(ids, labels)],
+        order_data,
+    )
+
+def recover_orders():
+    """Resume orders a crash interrupted; run once before the poll loop.
+
+    Orders caught while their labels were with the printer are queued
+    again. Whether the printer got the job cannot be known, so these are
+    the only labels that may come out twice.
+    """
+    requeued, unnotified = get_storage().recover_orders()
+    for oid in requeued:
+        logger.warning(f"Zamówienie {oid} przerwane w trakcie druku — ponownie w kolejce")
+    for oid, data in unnotified:
+        logger.info(f"Wznawiam powiadomienie dla zamówienia {oid}")
+        notify_order(data)
+    return requeued, [oid for oid, _ in unnotified]
+
+def reprint_order(order_id):
+    """Print the cached labels of an order again, without calling BaseLinker.
+
+    Only the label format is known for a past order, so routing rules on
+    status, courier or source do not apply to reprints.
+    """
+    labels = get_label_cache().order_labels(order_id)
+    if not labels:
+        logger.warning(f"Brak etykiet zamówienia {order_id} w cache")
+        return False
+    groups = {}
+    router = get_router()
+    for label, ext in labels:
+        groups.setdefault((router.route({}, ext), ext), []).append((label, ext))
+    futures = [
+        worker.submit(worker.print_labels, group, f"reprint_{order_id}")
+        for (worker, _), group in groups.items()
+    ]
+    return all([future.result() for future in futures])
+
+def shorten_product_name(full_name):
+    words = full_name.strip().split()
+    if len(words) >= 3:
+        return f"{words[0]} {' '.join(words[-2:])}"
+    return full_name
+
+def format_order_message(data):
+    return (
+        f"📦 Nowe zamówienie od: {data.get('name', '-')}\n"
+        f"🛒 Produkty:\n" +
+        ''.join(f"- {shorten_product_name(p['name'])} (x{p['quantity']})\n" for p in data.get("products", [])) +
+        f"🚚 Wysyłka: {data.get('shipping', '-')}\n"
+        f"🌐 Platforma: {data.get('platform', '-')}\n"
+        f"📎 ID: {data.get('order_id', '-')}")
+
+def format_digest_message(orders):
+    """One message summarising several orders."""
+    lines = [f"📦 Nowe zamówienia ({len(orders)}):"]
+    for data in orders:
+        products = ", ".join(
+            f"{shorten_product_name(p['name'])} x{p['quantity']}"
+            for p in data.get("products", [])
+        )
+        lines.append(
+            f"- {data.get('name', '-')}: {products or '-'} "
+            f"[{data.get('platform', '-')}, {data.get('shipping', '-')}] "
+            f"📎 {data.get('order_id', '-')}"
+        )
+    return "\n".join(lines)
+
+def send_messenger_text(message, recipient_id=None, access_token=None):
+    result = "error"
+    config = settings()
+    try:
+        with metrics.time("bl_messenger_request_seconds"):
+            response = get_messenger_client().post(
+                config.MESSENGER_URL,
+                "messenger",
+                headers={
+                    "Authorization": f"Bearer {access_token or config.PAGE_ACCESS_TOKEN}",
+                    "Content-Type": "application/json"
+                },
+                data=json.dumps({
+                    "recipient": {"id": recipient_id or config.RECIPIENT_ID},
+                    "message": {"text": message}
+                })
+            )
+        logger.info(
+            "📬 Messenger response: %s %s", response.status_code, response.text
+        )
+        response.raise_for_status()
+        logger.info("✅ Wiadomość została wysłana przez Messengera.")
+        result = "ok"
+        return True
+    except Exception as e:
+        logger.error(f"Błąd wysyłania wiadomości: {e}")
+        return False
+    finally:
+        metrics.inc("bl_messenger_messages_total", result=result)
+
+def send_messenger_message(data):
+    return send_messenger_text(format_order_message(data))
+
+
+class NotificationWorker:
+    """Background sender draining the ``notification_outbox`` table.
+
+    Printing only inserts a row (``notify_order``), so Messenger latency or
+    outages never slow the order loop. Failed sends are retried with
+    exponential backoff; each order is notified at most once. When at least
+    ``digest_threshold`` notifications are due, up to ``digest_size`` of
+    them are coalesced into one digest message. Workers sharing one
+    ``wake`` event can be served by a single thread (see ``AccountSet``).
+    """
+
+    def __init__(self, storage_factory=None, interval=None, digest_threshold=None,
+                 digest_size=None, backoff=None, max_backoff=None, max_attempts=None,
+                 send=None, wake=None):
+        config = settings()
+        self.storage_factory = storage_factory or get_storage
+        self.interval = interval or config.NOTIFY_INTERVAL
+        self.digest_threshold = config.MESSENGER_DIGEST_THRESHOLD if digest_threshold is None else digest_threshold
+        self.digest_size = digest_size or config.MESSENGER_DIGEST_SIZE
+        self.backoff = backoff or config.NOTIFY_BACKOFF
+        self.max_backoff = max_backoff or config.NOTIFY_MAX_BACKOFF
+        self.max_attempts = max_attempts or config.NOTIFY_MAX_ATTEMPTS
+        self.send = send or send_messenger_text
+        self._wake = wake or threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._run,),
+            name="notifier", daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while self.run_once():
+                    if self._stop.is_set():
+                        return
+            except Exception as e:
+                logger.error(f"Błąd wysyłki powiadomień: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_once(self):
+        """Send what is due now; returns the number of notifications handled."""
+        storage = self.storage_factory()
+        due = storage.due_notifications(max(self.digest_size, 1))
+        if not due:
+            return 0
+        if self.digest_threshold and len(due) >= self.digest_threshold:
+            batches = [due[:self.digest_size]]
+        else:
+            batches = [[n] for n in due]
+        handled = 0
+        for batch in batches:
+            if len(batch) == 1:
+                message = format_order_message(batch[0]["data"])
+            else:
+                message = format_digest_message([n["data"] for n in batch])
+            ids = [n["id"] for n in batch]
+            if self.send(message):
+                storage.mark_notifications_sent(ids)
+            else:
+                attempts = max(n["attempts"] for n in batch)
+                retry_in = min(self.backoff * 2 ** attempts, self.max_backoff)
+                storage.mark_notifications_failed(
+                    ids, "send failed", retry_in, self.max_attempts
+                )
+            handled += len(batch)
+        return handled
+
+
+notifier = None
+
+def get_notifier():
+    """Return the notification sender of the active agent or account, or the module-wide one."""
+    global notifier
+    active = _active.get()
+    if active is not None:
+        return active.notifier
+    with _components_lock:
+        if notifier is None:
+            notifier = NotificationWorker()
+        return notifier
+
+def notify_order(data):
+    """Queue a Messenger notification for an order and wake the sender."""
+    if get_storage().enqueue_notification(str(data.get("order_id")), data):
+        get_notifier().wake()
+
+def is_quiet_time():
+    now = datetime.now().hour
+    config = settings()
+    start, end = config.QUIET_HOURS_START, config.QUIET_HOURS_END
+    if start < end:
+        return start <= now < end
+    else:
+        return now >= start or now < end
+
+def seconds_until_quiet_end(now=None):
+    """Seconds from ``now`` until the next ``QUIET_HOURS_END`` boundary."""
+    now = now or datetime.now()
+    end = now.replace(hour=settings().QUIET_HOURS_END, minute=0, second=0, microsecond=0)
+    if end <= now:
+        end += timedelta(days=1)
+    return (end - now).total_seconds()
+
+
+class PollScheduler:
+    """Decide how long the main loop sleeps between poll cycles.
+
+    The interval follows the recent order rate: while orders keep coming it
+    is about half the average gap between orders (between ``min_interval``
+    and ``base``), and after quiet cycles it grows by half up to
+    ``max_interval``. Polls never use more API calls than polling every
+    ``base`` seconds would: once a ``window`` holds ``window / base`` polls,
+    the interval stays at ``base`` until quiet cycles free some up.
+    ``max_interval`` defaults to twice ``base`` when the journal or a
+    ``/trigger`` webhook catches what a longer sleep would delay, and to
+    ``base`` otherwise. ``trigger`` wakes the loop at once, e.g. from the
+    ``/trigger`` webhook or ``SIGUSR1``. During quiet hours the sleep never
+    runs past ``QUIET_HOURS_END``, so the queue drains right at the boundary.
+    """
+
+    def __init__(self, base=None, min_interval=None, max_interval=None,
+                 window=None, clock=time.monotonic):
+        config = settings()
+        self.base = base or config.POLL_INTERVAL
+        self.min_interval = min(min_interval or config.POLL_MIN_INTERVAL, self.base)
+        max_interval = max_interval or config.POLL_MAX_INTERVAL
+        if not max_interval and (config.ORDER_POLL_MODE == "journal" or config.TRIGGER_TOKEN):
+            max_interval = 2 * self.base
+        self.max_interval = max(max_interval, self.base)
+        self.window = window or config.POLL_RATE_WINDOW
+        self.interval = float(self.base)
+        self._clock = clock
+        self._event = threading.Event()
+        self._arrivals = deque()
+        self._polls = deque()
+        self._lock = threading.Lock()
+        self.triggers = 0
 
-last_order_data = {}
+    def record(self, new_orders):
+        """Feed the number of new orders seen in the last round of polls.
 
-def validate_env():
-    """Ensure mandatory environment variables are present."""
-    required = {
-        "API_TOKEN": API_TOKEN,
-        "PAGE_ACCESS_TOKEN": PAGE_ACCESS_TOKEN,
-        "RECIPIENT_ID": RECIPIENT_ID,
-    }
-    missing = [name for name, value in required.items() if not value]
-    if missing:
-        logger.error(
-            "Brak wymaganych zmiennych środowiskowych: %s",
-            ", ".join(missing),
-        )
-        raise SystemExit(1)
+        Call it once per round: with several accounts, with their sum.
+        """
+        with self._lock:
+            now = self._clock()
+            if new_orders:
+                self._arrivals.append((now, new_orders))
+            self._polls.append(now)
+            while self._arrivals and self._arrivals[0][0] <= now - self.window:
+                self._arrivals.popleft()
+            while self._polls and self._polls[0] <= now - self.window:
+                self._polls.popleft()
+            count = sum(n for _, n in self._arrivals)
+            if count and len(self._polls) >= self.window / self.base:
+                target = self.base
+            elif count:
+                target = min(self.window / count / 2, self.base)
+            else:
+                target = self.interval * 1.5
+            self.interval = min(max(target, self.min_interval), self.max_interval)
+            return self.interval
 
-def ensure_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS printed_orders(order_id TEXT PRIMARY KEY, printed_at TEXT)"
-    )
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS label_queue(order_id TEXT, label_data TEXT, ext TEXT, last_order_data TEXT)"
-    )
-    conn.commit()
-
-    # migrate old printed orders
-    if os.path.exists(PRINTED_FILE):
-        cur.execute("SELECT COUNT(*) FROM printed_orders")
-        if cur.fetchone()[0] == 0:
-            with open(PRINTED_FILE, "r") as f:
-                for line in f:
-                    if "," in line:
-                        oid, ts = line.strip().split(",")
-                        cur.execute(
-                            "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
-                            (oid, ts),
-                        )
-            conn.commit()
-    if os.path.exists(LABEL_QUEUE):
-        cur.execute("SELECT COUNT(*) FROM label_queue")
-        if cur.fetchone()[0] == 0:
-            with open(LABEL_QUEUE, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        item = json.loads(line)
-                        cur.execute(
-                            "INSERT INTO label_queue(order_id, label_data, ext, last_order_data) VALUES (?, ?, ?, ?)",
-                            (
-                                item.get("order_id"),
-                                item.get("label_data"),
-                                item.get("ext"),
-                                json.dumps(item.get("last_order_data", {})),
-                            ),
-                        )
-                    except Exception as e:
-                        logger.error(f"Błąd migracji z {LABEL_QUEUE}: {e}")
-            conn.commit()
-    conn.close()
+    def trigger(self, reason=""):
+        self.triggers += 1
+        logger.info(f"⏰ Wybudzenie agenta {reason}".rstrip())
+        self._event.set()
 
-def ensure_db_init():
-    ensure_db()
+    def next_sleep(self):
+        with self._lock:
+            sleep = self.interval
+        if is_quiet_time():
+            sleep = min(sleep, seconds_until_quiet_end() + 1)
+        return sleep
 
-def load_printed_orders():
-    ensure_db()
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT order_id, printed_at FROM printed_orders")
-    rows = cur.fetchall()
-    conn.close()
-    orders = {oid: datetime.fromisoformat(ts) for oid, ts in rows}
-    return orders
+    def wait(self):
+        """Sleep until the next cycle is due; return ``True`` if triggered."""
+        triggered = self._event.wait(self.next_sleep())
+        self._event.clear()
+        return triggered
 
-def mark_as_printed(order_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
-        (order_id, datetime.now().isoformat()),
-    )
-    conn.commit()
-    conn.close()
 
-def clean_old_printed_orders():
-    threshold = datetime.now() - timedelta(days=PRINTED_EXPIRY_DAYS)
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM printed_orders WHERE printed_at < ?", (threshold.isoformat(),))
-    conn.commit()
-    conn.close()
+scheduler = None
 
-def ensure_queue_file():
-    ensure_db()
+def get_scheduler():
+    """The poll scheduler of the active agent, else the module-wide one."""
+    global scheduler
+    active = _active_component("scheduler")
+    if active is not None:
+        return active
+    with _components_lock:
+        if scheduler is None:
+            scheduler = PollScheduler()
+        return scheduler
 
-def load_queue():
-    ensure_db()
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT order_id, label_data, ext, last_order_data FROM label_queue")
-    rows = cur.fetchall()
-    conn.close()
-    items = []
-    for order_id, label_data, ext, last_order_json in rows:
-        try:
-            last_data = json.loads(last_order_json) if last_order_json else {}
-        except Exception:
-            last_data = {}
-        items.append({
-            "order_id": order_id,
-            "label_data": label_data,
-            "ext": ext,
-            "last_order_data": last_data,
-        })
-    return items
 
-def save_queue(items):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM label_queue")
-    for item in items:
-        cur.execute(
-            "INSERT INTO label_queue(order_id, label_data, ext, last_order_data) VALUES (?, ?, ?, ?)",
-            (
-                item.get("order_id"),
-                item.get("label_data"),
-                item.get("ext"),
-                json.dumps(item.get("last_order_data", {})),
-            ),
-        )
-    conn.commit()
-    conn.close()
+def poll_cycle(poller, fetch_pool=None):
+    """Run one cycle of the main loop and return what it did.
 
-def call_api(method, parameters={}):
+    Drains the queue (outside quiet hours), polls for new orders, fetches
+    and hands their labels over to the printers (on ``fetch_pool`` when
+    given), then moves the watermark. Returns ``{"orders", "labels",
+    "seconds"}``; errors are logged, not raised, so the loop keeps going.
+    The caller feeds the order count to the scheduler, once per round.
+    """
+    cycle_start = time.perf_counter()
     try:
-        payload = {
-            "method": method,
-            "parameters": json.dumps(parameters)
-        }
-        response = requests.post(
-            BASE_URL, headers=HEADERS, data=payload, timeout=10
+        clean_old_printed_orders()
+        if not is_quiet_time():
+            drain_queue(get_printed_index())
+    except Exception as e:
+        logger.error(f"[BŁĄD KOLEJKI] {e}")
+        metrics.inc("bl_poll_errors_total")
+
+    new_orders = {}
+    label_count = 0
+    try:
+        printed = get_printed_index()
+        order_ids = itertools.islice(
+            iter_new_orders(poller.poll(), printed, new_orders),
+            settings().ORDERS_PER_CYCLE or None,
         )
-        logger.info(f"[{method}] {response.status_code}")
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Request error in call_api({method}): {e}")
+        for order_id, labels in fetch_labels_concurrently(order_ids, pool=fetch_pool):
+            order_data = new_orders[order_id]
+            if labels:
+                quiet = is_quiet_time()
+                if quiet:
+                    logger.info(
+                        "🕒 Cisza nocna — etykiety nie zostaną wydrukowane teraz."
+                    )
+                handle_order(order_id, labels, order_data, quiet)
+                label_count += len(labels)
+
+        poller.commit(printed)
+        metrics.inc("bl_orders_new_total", len(new_orders))
     except Exception as e:
-        logger.error(f"Błąd w call_api({method}): {e}")
-    return {}
+        logger.error(f"[BŁĄD GŁÓWNY] {e}")
+        metrics.inc("bl_poll_errors_total")
 
-def get_orders():
-    response = call_api("getOrders", {
-        "status_id": STATUS_ID
-    })
-    logger.info(
-        "🔁 Surowa odpowiedź:\n%s",
-        json.dumps(response, indent=2, ensure_ascii=False),
-    )
-    orders = response.get("orders", [])
-    logger.info(f"🔍 Zamówień znalezionych: {len(orders)}")
-    return orders
+    elapsed = time.perf_counter() - cycle_start
+    metrics.inc("bl_poll_cycles_total")
+    metrics.observe("bl_poll_cycle_seconds", elapsed)
+    metrics.set("bl_last_poll_time_seconds", time.time())
+    return {"orders": len(new_orders), "labels": label_count, "seconds": elapsed}
 
-def get_order_packages(order_id):
-    response = call_api("getOrderPackages", {
-        "order_id": order_id
-    })
-    return response.get("packages", [])
 
-def get_label(courier_code, package_id):
-    response = call_api("getLabel", {
-        "courier_code": courier_code,
-        "package_id": package_id
-    })
-    return response.get("label"), response.get("extension", "pdf")
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_TAIL_MAX_BYTES = 4 * 1024 * 1024
 
-def print_label(base64_data, extension, order_id):
-    try:
-        file_path = f"/tmp/label_{order_id}.{extension}"
-        pdf_data = base64.b64decode(base64_data)
-        with open(file_path, "wb") as f:
-            f.write(pdf_data)
-        result = subprocess.run(
-            ["lp", "-d", PRINTER_NAME, file_path], capture_output=True
-        )
-        os.remove(file_path)
-        if result.returncode != 0:
-            logger.error(
-                "Błąd drukowania (kod %s): %s",
-                result.returncode,
-                result.stderr.decode().strip(),
-            )
-        else:
-            logger.info(f"📨 Etykieta wydrukowana dla zamówienia {order_id}")
-    except Exception as e:
-        logger.error(f"Błąd drukowania: {e}")
+def iter_lines_reversed(path, chunk_size=8192, max_bytes=LOG_TAIL_MAX_BYTES):
+    """Yield lines of ``path`` from the last one backwards.
 
-def print_test_page():
-    try:
-        file_path = "/tmp/print_test.txt"
-        with open(file_path, "w") as f:
-            f.write("=== TEST PRINT ===\n")
-        result = subprocess.run([
-            "lp",
-            "-d",
-            PRINTER_NAME,
-            file_path,
-        ], capture_output=True)
-        os.remove(file_path)
-        if result.returncode != 0:
-            logger.error(
-                "Błąd testowego druku (kod %s): %s",
-                result.returncode,
-                result.stderr.decode().strip(),
-            )
-            return False
-        logger.info("🔧 Testowa strona została wysłana do drukarki.")
-        return True
-    except Exception as e:
-        logger.error(f"Błąd testowego druku: {e}")
+    The file is read in chunks seeking from the end, so the cost depends on
+    how many lines are consumed, not on the file size. At most ``max_bytes``
+    are read.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        read = 0
+        rest = b""
+        while pos > 0 and read < max_bytes:
+            step = min(chunk_size, pos)
+            pos -= step
+            read += step
+            f.seek(pos)
+            parts = (f.read(step) + rest).split(b"\n")
+            rest = parts.pop(0)
+            for line in reversed(parts):
+                if line:
+                    yield line.decode("utf-8", "replace")
+        if rest and pos == 0:
+            yield rest.decode("utf-8", "replace")
+
+def log_line_matches(line, level=None, search=None):
+    if level and f"[{level}]" not in line and f'"level": "{level}"' not in line:
         return False
+    if search and search.lower() not in line.lower():
+        return False
+    return True
 
-def shorten_product_name(full_name):
-    words = full_name.strip().split()
-    if len(words) >= 3:
-        return f"{words[0]} {' '.join(words[-2:])}"
-    return full_name
+def tail_log(path, lines=200, level=None, search=None):
+    """Return up to ``lines`` last lines of ``path`` matching the filters."""
+    found = []
+    for line in iter_lines_reversed(path):
+        if log_line_matches(line, level, search):
+            found.append(line)
+            if len(found) >= lines:
+                break
+    found.reverse()
+    return found
 
-def send_messenger_message(data):
+def follow_log(path, stop, poll=0.5):
+    """Yield lines appended to ``path`` until ``stop`` is set.
+
+    Survives rotation: when the file is replaced or truncated it is reopened
+    from the start. Yields ``None`` when idle so callers can send keep-alives.
+    """
+    f = open(path, "r", encoding="utf-8", errors="replace")
     try:
-        message = (
-            f"📦 Nowe zamówienie od: {data.get('name', '-')}\n"
-            f"🛒 Produkty:\n" +
-            ''.join(f"- {shorten_product_name(p['name'])} (x{p['quantity']})\n" for p in data.get("products", [])) +
-            f"🚚 Wysyłka: {data.get('shipping', '-')}\n"
-            f"🌐 Platforma: {data.get('platform', '-')}\n"
-            f"📎 ID: {data.get('order_id', '-')}")
-
-        response = requests.post(
-            "https://graph.facebook.com/v17.0/me/messages",
-            headers={
-                "Authorization": f"Bearer {PAGE_ACCESS_TOKEN}",
-                "Content-Type": "application/json"
-            },
-            data=json.dumps({
-                "recipient": {"id": RECIPIENT_ID},
-                "message": {"text": message}
-            })
-        )
-        logger.info(
-            "📬 Messenger response: %s %s", response.status_code, response.text
-        )
-        response.raise_for_status()
-        logger.info("✅ Wiadomość została wysłana przez Messengera.")
-    except Exception as e:
-        logger.error(f"Błąd wysyłania wiadomości: {e}")
+        f.seek(0, os.SEEK_END)
+        inode = os.fstat(f.fileno()).st_ino
+        while not stop.is_set():
+            line = f.readline()
+            if line:
+                yield line.rstrip("\n")
+                continue
+            try:
+                st = os.stat(path)
+                if st.st_ino != inode or st.st_size < f.tell():
+                    f.close()
+                    f = open(path, "r", encoding="utf-8", errors="replace")
+                    inode = os.fstat(f.fileno()).st_ino
+                    continue
+            except FileNotFoundError:
+                pass
+            yield None
+            stop.wait(poll)
+    finally:
+        f.close()
 
-def is_quiet_time():
-    now = datetime.now().hour
-    if QUIET_HOURS_START < QUIET_HOURS_END:
-        return QUIET_HOURS_START <= now < QUIET_HOURS_END
-    else:
-        return now >= QUIET_HOURS_START or now < QUIET_HOURS_END
 
+metrics.collect(
+    "bl_queue_depth", "gauge", "Labels waiting in the print queue.",
+    lambda: get_storage().count_queue(), per_account=True,
+)
+metrics.collect(
+    "bl_notifications_pending", "gauge", "Messenger notifications waiting in the outbox.",
+    lambda: get_storage().count_notifications(), per_account=True,
+)
+metrics.collect(
+    "bl_orders", "gauge", "Orders by print state.",
+    lambda: get_storage().count_order_states(), label="state", per_account=True,
+)
+metrics.collect(
+    "bl_orders_in_flight", "gauge", "Orders handed to printers and not finished yet.",
+    lambda: len(get_router().in_flight), per_account=True,
+)
+metrics.collect(
+    "bl_api_calls_last_minute", "gauge", "BaseLinker API calls made in the last minute.",
+    lambda: get_api_limiter().usage()["used_last_minute"], per_account=True,
+)
+metrics.collect(
+    "bl_api_waiting", "gauge", "API calls waiting for the rate limiter.",
+    lambda: get_api_limiter().usage()["waiting"], per_account=True,
+)
+metrics.collect(
+    "bl_label_cache_requests_total", "counter", "Label cache lookups by result.",
+    lambda: {"hit": get_label_cache().hits, "miss": get_label_cache().misses}, label="result",
+)
+
+def agent_status():
+    """Short JSON-ready summary served by ``/status``."""
+    storage = get_storage()
+    last_poll = metrics.value("bl_last_poll_time_seconds")
+    cycles = metrics.value("bl_poll_cycle_seconds")
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "uptime_seconds": round(time.time() - metrics.value("bl_start_time_seconds")),
+        "quiet_hours": is_quiet_time(),
+        "last_poll": datetime.fromtimestamp(last_poll).isoformat(timespec="seconds") if last_poll else None,
+        "poll_cycles": cycles[0] if cycles else 0,
+        "avg_cycle_seconds": round(cycles[1] / cycles[0], 3) if cycles else None,
+        "next_poll_interval": get_scheduler().next_sleep(),
+        "queue_depth": storage.count_queue(),
+        "notifications_pending": storage.count_notifications(),
+        "orders": storage.count_order_states(),
+        "orders_in_flight": len(get_router().in_flight),
+        "api": get_api_limiter().usage(),
+        "api_latency": get_api_client().latency_stats(),
+        "messenger_latency": get_messenger_client().latency_stats(),
+        "label_cache": get_label_cache().stats(),
+        "metrics": metrics.snapshot(),
+    }
+
+def account_query():
+    """``{"account": name}`` while an account is active, so links stay on it."""
+    account = current_account()
+    return {} if account is None else {"account": account.name}
 
 def render_page(title, body_html):
     """Return a full HTML document with basic styling and navigation."""
+    query = urlencode(account_query())
     nav_links = [
         ("/", "Strona główna"),
         ("/history", "Historia drukowania"),
         ("/logs", "Logi"),
         ("/testprint", "Testuj drukarkę"),
     ]
-    if last_order_data:
+    if get_last_order():
         nav_links.append(("/test", "Wyślij testową wiadomość"))
 
     nav_html = (
@@ -334,7 +3493,7 @@ def render_page(title, body_html):
         "<div class='container justify-content-center'>"
         "<div class='navbar-nav'>" +
         "".join(
-            f"<a class='btn btn-secondary mx-2' href='{href}'>{text}</a>"
+            f"<a class='btn btn-secondary mx-2' href='{href}{'?' + html.escape(query, quote=True) if query else ''}'>{text}</a>"
             for href, text in nav_links
         ) +
         "</div></div></nav>"
@@ -356,65 +3515,339 @@ def render_page(title, body_html):
         "</body></html>"
     )
 
+background_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ui-job")
+background_status = {}
+
+def run_in_background(name, func, ok_message, error_message):
+    """Run a slow UI action off the request thread.
+
+    The outcome lands in ``background_status`` and is shown on the main page.
+    """
+    background_status[name] = (datetime.now(), "⏳ W toku…")
+
+    def job():
+        try:
+            ok = func()
+        except Exception as e:
+            logger.error(f"Błąd zadania w tle {name}: {e}")
+            ok = False
+        background_status[name] = (
+            datetime.now(), ok_message if ok else error_message
+        )
+
+    submit_in_context(background_pool, job)
+
+
 class AgentRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in two writes; without TCP_NODELAY every
+    # keep-alive response waits for the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    @property
+    def timeout(self):
+        # socket timeout, so a stuck client cannot hold a worker thread forever
+        return settings().HTTP_REQUEST_TIMEOUT
+
     def _send(self, content, status=200, content_type="text/html; charset=utf-8"):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
         self.send_response(status)
         self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
         self.end_headers()
-        if isinstance(content, str):
-            content = content.encode("utf-8")
         self.wfile.write(content)
 
+    def _handle_trigger(self, query):
+        token = settings().TRIGGER_TOKEN
+        if token and query.get("token", [""])[0] != token:
+            self._send(
+                json.dumps({"status": "forbidden"}),
+                status=403,
+                content_type="application/json",
+            )
+            return
+        get_scheduler().trigger("(webhook)")
+        self._send(json.dumps({"status": "ok"}), content_type="application/json")
+
+    def _account(self, query):
+        """The account picked with ``?account=`` (the first one by default).
+
+        ``None`` when the server serves a single agent; ``False`` when no
+        account has that name.
+        """
+        accounts = getattr(self.server, "accounts", None)
+        if not accounts:
+            return None
+        name = query.get("account", [""])[0] or next(iter(accounts))
+        return accounts.get(name, False)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if url.path == "/trigger":
+            self._handle_trigger(parse_qs(url.query))
+        else:
+            self.send_error(404, "Nie znaleziono strony")
+
     def do_GET(self):
-        if self.path == "/test":
-            if last_order_data:
-                send_messenger_message(last_order_data)
-                body = "<p class='w-75 mx-auto'>✅ Testowa wiadomość została wysłana.</p>"
+        url = urlsplit(self.path)
+        path, query = url.path, parse_qs(url.query)
+        if path == "/metrics":
+            accounts = getattr(self.server, "accounts", {})
+            self._send(
+                metrics.render(list(accounts.values())),
+                content_type="text/plain; version=0.0.4; charset=utf-8",
+            )
+            return
+        account = self._account(query)
+        if account is None:
+            self._get(path, query)
+        elif account is False:
+            self._send(
+                render_page("404 - Not Found", "<p class='w-75 mx-auto'>Nie znaleziono konta.</p>"),
+                status=404,
+            )
+        else:
+            with account.activate():
+                self._get(path, query)
+
+    def _get(self, path, query):
+        if path == "/trigger":
+            self._handle_trigger(query)
+        elif path == "/test":
+            last_order = get_last_order()
+            if last_order:
+                data = dict(last_order)
+                run_in_background(
+                    "Test wiadomości",
+                    lambda: send_messenger_message(data),
+                    "✅ Testowa wiadomość została wysłana.",
+                    "❌ Błąd wysyłania testowej wiadomości.",
+                )
+                body = "<p class='w-75 mx-auto'>⏳ Testowa wiadomość zlecona — wynik pojawi się na stronie głównej.</p>"
             else:
                 body = "<p class='w-75 mx-auto'>⚠️ Brak danych ostatniego zamówienia.</p>"
             self._send(render_page("Test wiadomości", body))
-        elif self.path == "/testprint":
-            if print_test_page():
-                body = "<p class='w-75 mx-auto'>✅ Testowy wydruk wysłany.</p>"
-            else:
-                body = "<p class='w-75 mx-auto'>❌ Błąd testowego wydruku.</p>"
+        elif path == "/testprint":
+            run_in_background(
+                "Test wydruku",
+                print_test_page,
+                "✅ Testowy wydruk wysłany.",
+                "❌ Błąd testowego wydruku.",
+            )
+            body = "<p class='w-75 mx-auto'>⏳ Testowy wydruk zlecony — wynik pojawi się na stronie głównej.</p>"
             self._send(render_page("Test wydruku", body))
-        elif self.path == "/history":
-            printed = load_printed_orders()
-            queue = load_queue()
-            rows = "".join(
-                f"<tr><td>{html.escape(str(oid))}</td><td>{html.escape(str(ts))}</td></tr>"
-                for oid, ts in sorted(printed.items())
-            )
-            qrows = "".join(
-                f"<tr><td>{html.escape(str(item.get('order_id')))}</td><td>W kolejce</td></tr>"
-                for item in queue
-            )
-            table_html = (
-                "<table class='table table-striped table-bordered table-custom bg-white'>"
-                "<thead><tr><th>ID zamówienia</th><th>Czas</th></tr></thead>"
-                "<tbody>" + rows + qrows + "</tbody></table>"
-            )
-            self._send(render_page("Historia drukowania", table_html))
-        elif self.path == "/logs":
+        elif path == "/reprint":
+            order_id = (query.get("order_id", [""])[0] or "").strip()
+            if order_id:
+                run_in_background(
+                    f"Ponowny wydruk {order_id}",
+                    lambda: reprint_order(order_id),
+                    "✅ Etykiety wydrukowane ponownie.",
+                    "❌ Błąd ponownego wydruku (brak etykiet w cache?).",
+                )
+                body = "<p class='w-75 mx-auto'>⏳ Ponowny wydruk zlecony — wynik pojawi się na stronie głównej.</p>"
+            else:
+                body = "<p class='w-75 mx-auto'>⚠️ Brak ID zamówienia.</p>"
+            self._send(render_page("Ponowny wydruk", body))
+        elif path == "/status":
+            self._send(
+                json.dumps(agent_status(), ensure_ascii=False),
+                content_type="application/json; charset=utf-8",
+            )
+        elif path in ("/history", "/history.json"):
+            self._history(query, as_json=path.endswith(".json"))
+        elif path == "/logs/stream":
+            self._stream_logs(query)
+        elif path == "/logs":
+            level = (query.get("level", [""])[0] or "").upper()
+            level = level if level in LOG_LEVELS else ""
+            search = query.get("q", [""])[0]
+            try:
+                count = min(max(int(query.get("lines", ["200"])[0]), 1), 5000)
+            except ValueError:
+                count = 200
+            options = "".join(
+                f"<option value='{lvl}'{' selected' if lvl == level else ''}>{lvl or 'Wszystkie'}</option>"
+                for lvl in ("",) + LOG_LEVELS
+            )
+            form_html = (
+                "<form class='w-75 mx-auto mb-3 d-flex gap-2' method='get'>"
+                f"<select class='form-select w-auto' name='level'>{options}</select>"
+                f"<input class='form-control' name='q' placeholder='Szukaj' value='{html.escape(search, quote=True)}'>"
+                f"<input class='form-control w-auto' type='number' name='lines' value='{count}'>"
+                "<button class='btn btn-primary'>Filtruj</button>"
+                "<button class='btn btn-outline-secondary' type='button' id='follow'>Na żywo</button>"
+                "</form>"
+            )
             try:
-                with open(LOG_FILE, "r") as f:
-                    lines = f.readlines()[-200:]
-                log_html = "<pre class='w-75 mx-auto bg-white p-3 border rounded overflow-auto'>" + (
-                    "".join(lines)
-                    .replace("&", "&amp;")
-                    .replace("<", "&lt;")
-                    .replace(">", "&gt;")
-                ) + "</pre>"
+                lines = tail_log(settings().LOG_FILE, count, level, search)
+                log_html = (
+                    "<pre id='log' class='w-75 mx-auto bg-white p-3 border rounded overflow-auto'>"
+                    + html.escape("\n".join(lines) + "\n" if lines else "", quote=False)
+                    + "</pre>"
+                    "<script>document.getElementById('follow').onclick=function(){"
+                    "var q=new URLSearchParams(new FormData(this.form));"
+                    "var src=new EventSource('/logs/stream?'+q.toString());"
+                    "var pre=document.getElementById('log');"
+                    "src.onmessage=function(e){pre.textContent+=e.data+'\\n';"
+                    "pre.scrollTop=pre.scrollHeight;};this.disabled=true;};</script>"
+                )
             except Exception as e:
                 log_html = f"<p class='w-75 mx-auto'>Błąd czytania logów: {e}</p>"
-            self._send(render_page("Logi", log_html))
-        elif self.path == "/":
-            body = "<p class='w-75 mx-auto'>Wybierz opcję z menu powyżej.</p>"
+            self._send(render_page("Logi", form_html + log_html))
+        elif path == "/":
+            usage = get_api_limiter().usage()
+            account = current_account()
+            body = "".join(
+                f"<a class='btn btn-sm {'btn-primary' if a is account else 'btn-outline-secondary'} m-1' "
+                f"href='/?{html.escape(urlencode({'account': name}), quote=True)}'>{html.escape(name)}</a>"
+                for name, a in getattr(self.server, "accounts", {}).items()
+            )
+            if body:
+                body = f"<p class='w-75 mx-auto'>Konto: {body}</p>"
+            body += (
+                "<p class='w-75 mx-auto'>Wybierz opcję z menu powyżej.</p>"
+                "<p class='w-75 mx-auto text-muted'>"
+                f"Budżet API: {usage['used_last_minute']}/{usage['limit_per_minute']} "
+                f"wywołań w ostatniej minucie, oczekujących: {usage['waiting']}, "
+                f"wstrzymanych: {usage['throttled']}</p>"
+            )
+            cache = get_label_cache().stats()
+            body += (
+                "<p class='w-75 mx-auto text-muted'>"
+                f"Cache etykiet: {cache['hits']} trafień, {cache['misses']} chybień, "
+                f"{cache['entries']} etykiet ({cache['bytes'] / 1048576:.1f} MiB)</p>"
+            )
+            for name, (ts, message) in sorted(background_status.items()):
+                body += (
+                    f"<p class='w-75 mx-auto'>{html.escape(name)} "
+                    f"({ts.strftime('%H:%M:%S')}): {html.escape(message)}</p>"
+                )
             self._send(render_page("BaseLinker Print Agent", body))
         else:
             self.send_error(404, "Nie znaleziono strony")
 
+    def _history(self, query, as_json=False):
+        def arg(name):
+            return (query.get(name, [""])[0] or "").strip()
+
+        try:
+            page = max(int(arg("page") or 1), 1)
+            per_page = min(max(int(arg("per_page") or settings().HISTORY_PAGE_SIZE), 1), 500)
+            for name in ("from", "to"):
+                if arg(name):
+                    datetime.fromisoformat(arg(name))
+        except ValueError:
+            self._send("Nieprawidłowe parametry", status=400, content_type="text/plain; charset=utf-8")
+            return
+        filters = {"order_id": arg("order_id"), "from": arg("from"), "to": arg("to")}
+        items, total = get_storage().history(
+            page,
+            per_page,
+            order_id=filters["order_id"] or None,
+            date_from=filters["from"] or None,
+            date_to=filters["to"] or None,
+        )
+        cached = get_storage().cached_orders(item["order_id"] for item in items)
+        for item in items:
+            item["label_cached"] = item["order_id"] in cached
+        if as_json:
+            self._send(
+                json.dumps({
+                    "page": page,
+                    "per_page": per_page,
+                    "total": total,
+                    "items": items,
+                }, ensure_ascii=False),
+                content_type="application/json; charset=utf-8",
+            )
+            return
+
+        labels = {"printed": "Wydrukowane", "queued": "W kolejce", "failed": "Błąd druku"}
+        rows = "".join(
+            f"<tr><td>{html.escape(str(item['order_id']))}</td>"
+            f"<td>{html.escape(str(item['printed_at'] or ''))}</td>"
+            f"<td>{labels.get(item['status'], item['status'])}</td>"
+            + (
+                f"<td><a class='btn btn-sm btn-outline-primary' href='/reprint?{html.escape(urlencode({'order_id': item['order_id'], **account_query()}), quote=True)}'>Drukuj ponownie</a></td></tr>"
+                if item["label_cached"] else "<td></td></tr>"
+            )
+            for item in items
+        )
+        form_html = (
+            "<form class='table-custom mb-3 d-flex gap-2' method='get'>"
+            f"<input class='form-control' name='order_id' placeholder='ID zamówienia' value='{html.escape(filters['order_id'], quote=True)}'>"
+            f"<input class='form-control w-auto' type='date' name='from' value='{html.escape(filters['from'], quote=True)}'>"
+            f"<input class='form-control w-auto' type='date' name='to' value='{html.escape(filters['to'], quote=True)}'>"
+            + "".join(
+                f"<input type='hidden' name='{k}' value='{html.escape(v, quote=True)}'>"
+                for k, v in account_query().items()
+            )
+            + "<button class='btn btn-primary'>Filtruj</button>"
+            "</form>"
+        )
+        table_html = (
+            "<table class='table table-striped table-bordered table-custom bg-white'>"
+            "<thead><tr><th>ID zamówienia</th><th>Czas</th><th>Status</th><th>Etykieta</th></tr></thead>"
+            "<tbody>" + rows + "</tbody></table>"
+        )
+        pages = max((total + per_page - 1) // per_page, 1)
+
+        def link(target, text):
+            params = {k: v for k, v in filters.items() if v}
+            params.update(page=target, per_page=per_page, **account_query())
+            return f"<a class='btn btn-outline-secondary mx-1' href='/history?{html.escape(urlencode(params), quote=True)}'>{text}</a>"
+
+        pager_html = (
+            "<div class='text-center'>"
+            + (link(page - 1, "&laquo;") if page > 1 else "")
+            + f"<span class='mx-2'>Strona {page} z {pages} ({total})</span>"
+            + (link(page + 1, "&raquo;") if page < pages else "")
+            + "</div>"
+        )
+        self._send(render_page("Historia drukowania", form_html + table_html + pager_html))
+
+    def _stream_logs(self, query):
+        """Follow ``LOG_FILE`` as server-sent events."""
+        level = (query.get("level", [""])[0] or "").upper()
+        search = query.get("q", [""])[0]
+        stop = threading.Event()
+        stream = follow_log(settings().LOG_FILE, stop)
+        # position at the current end of the log before answering
+        try:
+            first = next(stream)
+        except OSError as e:
+            self._send(f"Błąd czytania logów: {e}", status=500, content_type="text/plain; charset=utf-8")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        idle_since = time.monotonic()
+        try:
+            for line in itertools.chain([first], stream):
+                if line is None:
+                    if time.monotonic() - idle_since >= 15:
+                        self.wfile.write(b": keep-alive\n\n")
+                        self.wfile.flush()
+                        idle_since = time.monotonic()
+                    continue
+                if log_line_matches(line, level, search):
+                    self.wfile.write(f"data: {line}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    idle_since = time.monotonic()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            stop.set()
+            stream.close()
+
     def log_message(self, format, *args):
         return
 
@@ -425,109 +3858,409 @@ class AgentRequestHandler(http.server.BaseHTTPRequestHandler):
         else:
             super().send_error(code, message, explain)
 
-def start_http_server():
-    with socketserver.TCPServer(("", HTTP_PORT), AgentRequestHandler) as httpd:
+class AgentHTTPServer(http.server.ThreadingHTTPServer):
+    """One thread per connection, so a slow request never blocks the UI.
+
+    Requests run in the context the server was created in, so the UI of an
+    ``Agent`` shows that agent's database, limiter and printers. With
+    ``accounts`` each request runs inside the account picked with
+    ``?account=`` and ``/metrics`` labels the per-account gauges.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, accounts=()):
+        self.context = contextvars.copy_context()
+        self.accounts = {account.name: account for account in accounts}
+        super().__init__(server_address, handler)
+
+    def process_request_thread(self, request, client_address):
+        self.context.copy().run(super().process_request_thread, request, client_address)
+
+
+def start_http_server(accounts=()):
+    port = settings().HTTP_PORT
+    with AgentHTTPServer(("", port), AgentRequestHandler, accounts) as httpd:
         logger.info(
-            f"[HTTP] Serwer UI dostępny na porcie {HTTP_PORT}"
+            f"[HTTP] Serwer UI dostępny na porcie {port}"
         )
         httpd.serve_forever()
 
-if __name__ == "__main__":
-    logger.info(
-        "[START] Agent BaseLinker z automatycznym getLabel + Messenger + dotenv"
-    )
-    validate_env()
-    ensure_db_init()
-    if ENABLE_HTTP_SERVER:
-        threading.Thread(target=start_http_server, daemon=True).start()
 
-    while True:
-        clean_old_printed_orders()
-        printed = load_printed_orders()
-        queue = load_queue()
+def configure(**values):
+    """Override settings by name and drop the shared components that read them.
 
-        if not is_quiet_time():
-            grouped = {}
-            for item in queue:
-                grouped.setdefault(item["order_id"], []).append(item)
+    ``configure(STATUS_ID=1, DB_FILE="/tmp/agent.db")``; names are those of
+    ``SETTINGS``, values are already parsed. They go into the process-wide
+    ``config`` and the module-wide components are rebuilt from it on next
+    use. To change the settings of one agent only, use ``Agent(config=…)``.
+    """
+    global api_limiter, api_client, messenger_client, label_cache
+    global printer, router, notifier, scheduler
+    config.update(**values)
+    with _components_lock:
+        for client in (api_client, messenger_client):
+            if client is not None:
+                client.close()
+        api_limiter = api_client = messenger_client = label_cache = None
+        printer = router = notifier = scheduler = None
 
-            new_queue = []
-            for oid, items in grouped.items():
-                try:
-                    for it in items:
-                        print_label(it["label_data"], it.get("ext", "pdf"), it["order_id"])
-                    mark_as_printed(oid)
-                    printed[oid] = datetime.now()
-                except Exception as e:
-                    logger.error(f"Błąd przetwarzania z kolejki: {e}")
-                    new_queue.extend(items)
 
-            queue = new_queue
-            save_queue(queue)
+class Agent:
+    """The poll loop as an object: ``run_once`` for one cycle, ``run`` for ever.
+
+    ``config`` maps setting names to values for this agent, on top of the
+    process settings. Components built from the settings can be replaced:
+    ``api`` is a ``call_api``-like callable, ``printer`` a ``PrinterBackend``
+    (or a whole ``PrinterRouter``), ``notifier`` a ``send(text)`` callable
+    (or a ``NotificationWorker``) and ``storage`` a ``Storage``. The agent
+    keeps its components to itself: module functions called inside
+    ``activate()`` use them instead of the module-wide ones, so several
+    agents can live in one process and ``close`` leaves the module as it was.
+    """
+
+    def __init__(self, config=None, api=None, printer=None, notifier=None, storage=None):
+        self.config = settings().derive(**(config or {}))
+        self.api = api
+        self.headers = api_headers(self.config.API_TOKEN)
+        self.limiter = RateLimiter(self.config.API_RATE_LIMIT, self.config.API_RATE_BURST)
+        self.api_client = make_api_client(self.config)
+        self.messenger_client = make_messenger_client(self.config)
+        self.fetch_pool = ThreadPoolExecutor(
+            max_workers=self.config.FETCH_WORKERS, thread_name_prefix="fetch"
+        )
+        self._storage = storage
+        self._printed_index = None
+        self._lock = threading.RLock()
+        self.poller = None
+        self.last_order_data = {}
+        with self.activate():
+            self.label_cache = LabelCache(storage_factory=lambda: self.storage)
+            if isinstance(printer, PrinterRouter):
+                self.printer, self.router = None, printer
+            else:
+                self.printer = printer or make_printer_backend(
+                    self.config.PRINTER_BACKEND, on_status=log_print_status
+                )
+                self.router = PrinterRouter(
+                    load_printer_routes(self.config.PRINTER_ROUTES), on_status=log_print_status
+                )
+            if callable(notifier) and not isinstance(notifier, NotificationWorker):
+                notifier = NotificationWorker(storage_factory=lambda: self.storage, send=notifier)
+            self.notifier = notifier or NotificationWorker(storage_factory=lambda: self.storage)
+            self.scheduler = PollScheduler()
+
+    @property
+    def storage(self):
+        with self._lock:
+            if self._storage is None:
+                self._storage = Storage(self.config.DB_FILE)
+            return self._storage
+
+    def printed_index(self):
+        with self._lock:
+            if self._printed_index is None:
+                self._printed_index = PrintedIndex(
+                    self.storage, self.config.DEDUP_MODE,
+                    self.config.DEDUP_BLOOM_CAPACITY, self.config.DEDUP_BLOOM_ERROR,
+                )
+            return self._printed_index
 
+    @contextlib.contextmanager
+    def activate(self):
+        token = _active.set(self)
         try:
-            orders = get_orders()
-            for order in orders:
-                order_id = str(order["order_id"])
-
-                last_order_data = {
-                    "order_id": order_id,
-                    "name": order.get("delivery_fullname", "Nieznany klient"),
-                    "platform": order.get("order_source", "brak"),
-                    "shipping": order.get("delivery_method", "brak"),
-                    "products": order.get("products", [])
-                }
+            yield self
+        finally:
+            _active.reset(token)
 
-                if order_id in printed:
-                    continue
+    def start(self):
+        """Prepare the database and resume orders a crash interrupted."""
+        with self.activate():
+            ensure_db_init()
+            recover_orders()
+            self.poller = OrderPoller(self.storage, statuses=self.router.statuses())
+        return self
+
+    def run_once(self):
+        """Run one poll cycle and return its stats (see :func:`poll_cycle`)."""
+        if self.poller is None:
+            self.start()
+        with self.activate():
+            stats = poll_cycle(self.poller, self.fetch_pool)
+        self.scheduler.record(stats["orders"])
+        return stats
+
+    def run(self):
+        """Start the UI and notifier threads and poll until the process ends."""
+        self.start()
+        with self.activate():
+            if self.config.ENABLE_HTTP_SERVER:
+                threading.Thread(
+                    target=contextvars.copy_context().run, args=(start_http_server,),
+                    daemon=True,
+                ).start()
+            self.notifier.start()
+        while True:
+            self.run_once()
+            self.scheduler.wait()
+
+    def close(self):
+        self.notifier.stop()
+        self.router.wait(30)
+        self.fetch_pool.shutdown()
+        for client in (self.api_client, self.messenger_client):
+            client.close()
+        if self._storage is not None:
+            self._storage.close()
+
+
+ACCOUNT_KEYS = (
+    "name", "api_token", "status_id", "db_file", "printer", "printer_routes",
+    "recipient_id", "page_access_token", "api_rate_limit", "api_rate_burst",
+)
+
+def account_shard(name, count):
+    """Stable shard number of an account, the same in every process."""
+    return zlib.crc32(name.encode("utf-8")) % count
+
+def load_accounts(spec, shard=None):
+    """Parse ``ACCOUNTS_FILE``: a JSON list of accounts or a path to one.
+
+    Every account needs a unique ``name`` and an ``api_token``; other keys
+    (``ACCOUNT_KEYS``) default to the module settings. With ``shard`` given
+    as ``"index/count"`` only the accounts of that shard are returned, so
+    several processes can split the file without sharing any state.
+    """
+    spec = (spec or "").strip()
+    if not spec.startswith("["):
+        with open(spec, encoding="utf-8") as f:
+            spec = f.read()
+    accounts = json.loads(spec)
+    names = set()
+    for account in accounts:
+        unknown = set(account) - set(ACCOUNT_KEYS)
+        if unknown:
+            raise ValueError(f"Nieznane pola konta: {', '.join(sorted(unknown))}")
+        name = account.get("name")
+        if not name or name in names or not account.get("api_token"):
+            raise ValueError(f"Konto bez unikalnej nazwy lub tokenu API: {name}")
+        names.add(name)
+        if not (account.get("recipient_id") or settings().RECIPIENT_ID) or not (
+            account.get("page_access_token") or settings().PAGE_ACCESS_TOKEN
+        ):
+            raise ValueError(f"Konto {name} bez odbiorcy lub tokenu Messengera")
+    if shard:
+        index, _, count = shard.partition("/")
+        index, count = int(index), int(count)
+        if not 0 <= index < count:
+            raise ValueError(f"Nieprawidłowy shard: {shard}")
+        accounts = [a for a in accounts if account_shard(a["name"], count) == index]
+    return accounts
+
+
+class Account:
+    """One BaseLinker account served next to others in the same process.
+
+    Holds what must not be shared between shops: the token and its rate
+    limiter, the SQLite file (watermark, queue, outbox, history), the dedup
+    index, the printer routes and the Messenger recipient, plus a ``config``
+    with the account's settings. Code run inside ``activate()`` (and work it
+    hands to pools) uses these instead of the module-wide ones. ``printers``
+    maps printer specs to workers shared with the other accounts; ``wake``
+    is the shared notifier event.
+    """
+
+    def __init__(self, name, api_token, status_id=None, db_file=None, printer=None,
+                 printer_routes=(), recipient_id=None, page_access_token=None,
+                 api_rate_limit=None, api_rate_burst=None, printers=None, wake=None):
+        self.name = name
+        parent = settings()
+        self.headers = api_headers(api_token)
+        self.status_id = int(status_id or parent.STATUS_ID)
+        if api_rate_limit is None:
+            api_rate_limit = parent.API_RATE_LIMIT
+        api_rate_burst = api_rate_burst or parent.API_RATE_BURST
+        self.limiter = RateLimiter(api_rate_limit, api_rate_burst)
+        if not db_file:
+            db_file = f"{os.path.splitext(parent.DB_FILE)[0]}-{name}.db"
+        self.config = parent.derive(
+            API_TOKEN=api_token, STATUS_ID=self.status_id, DB_FILE=db_file,
+            API_RATE_LIMIT=api_rate_limit, API_RATE_BURST=api_rate_burst,
+            RECIPIENT_ID=recipient_id or parent.RECIPIENT_ID,
+            PAGE_ACCESS_TOKEN=page_access_token or parent.PAGE_ACCESS_TOKEN,
+        )
+        self.storage = Storage(db_file, migrate_files=False)
+        printers = {} if printers is None else printers
+        spec = printer or parent.PRINTER_BACKEND
+        if spec not in printers:
+            printers[spec] = PrintWorker(spec, None if spec == parent.PRINTER_BACKEND else (
+                make_printer_backend(spec, on_status=log_print_status)
+            ))
+        routes = printer_routes
+        if not isinstance(routes, str):
+            routes = json.dumps(list(routes))
+        self.router = PrinterRouter(
+            load_printer_routes(routes), on_status=log_print_status,
+            default=printers[spec], pool=printers, status_id=self.status_id,
+        )
+        self.notifier = NotificationWorker(
+            storage_factory=lambda: self.storage, wake=wake,
+            send=functools.partial(
+                send_messenger_text, recipient_id=recipient_id,
+                access_token=page_access_token,
+            ),
+        )
+        self.poller = None
+        self.last_order_data = {}
+        self._printed_index = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
 
-                logger.info(
-                    f"📜 Zamówienie {order_id} ({last_order_data['name']})"
+    def printed_index(self):
+        with self._lock:
+            if self._printed_index is None:
+                self._printed_index = PrintedIndex(
+                    self.storage, self.config.DEDUP_MODE,
+                    self.config.DEDUP_BLOOM_CAPACITY, self.config.DEDUP_BLOOM_ERROR,
                 )
-                packages = get_order_packages(order_id)
-                labels = []
-
-                for p in packages:
-                    package_id = p.get("package_id")
-                    courier_code = p.get("courier_code")
-                    if not package_id or not courier_code:
-                        logger.warning(
-                            "  Brak danych: package_id lub courier_code"
-                        )
-                        continue
-
-                    logger.info(f"  📦 Paczka {package_id} (kurier: {courier_code})")
-
-                    label_data, ext = get_label(courier_code, package_id)
-                    if label_data:
-                        labels.append((label_data, ext))
-                    else:
-                        logger.warning("  ❌ Brak etykiety (label_data = null)")
-
-                if labels:
-                    if is_quiet_time():
-                        logger.info(
-                            "🕒 Cisza nocna — etykiety nie zostaną wydrukowane teraz."
-                        )
-                        for label_data, ext in labels:
-                            queue.append({
-                                "order_id": order_id,
-                                "label_data": label_data,
-                                "ext": ext,
-                                "last_order_data": last_order_data,
-                            })
-                        send_messenger_message(last_order_data)
-                        mark_as_printed(order_id)
-                        printed[order_id] = datetime.now()
-                    else:
-                        for label_data, ext in labels:
-                            print_label(label_data, ext, order_id)
-                        send_messenger_message(last_order_data)
-                        mark_as_printed(order_id)
-                        printed[order_id] = datetime.now()
+            return self._printed_index
 
-        except Exception as e:
-            logger.error(f"[BŁĄD GŁÓWNY] {e}")
+    def start(self):
+        """Resume interrupted orders and create the poller; call when active."""
+        recover_orders()
+        self.poller = OrderPoller(self.storage, statuses=self.router.statuses())
+
+    def close(self):
+        self.router.wait(30)
+        self.storage.close()
+
+
+class AccountSet:
+    """Serve many accounts from one process (``ACCOUNTS_FILE``).
+
+    Each account keeps its own limiter, watermark, queue and database, while
+    poll cycles run on one pool of ``workers`` threads, label downloads on
+    one pool of ``fetch_workers`` threads, API calls on the shared keep-alive
+    session, printers on shared workers and notifications on one sender
+    thread. Split big account lists across processes with ``ACCOUNT_SHARD``.
+    """
+
+    def __init__(self, accounts, workers=None, fetch_workers=None):
+        self.printers = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.accounts = [
+            Account(**config, printers=self.printers, wake=self._wake)
+            for config in accounts
+        ]
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers or settings().ACCOUNT_WORKERS, thread_name_prefix="account"
+        )
+        self.fetch_pool = ThreadPoolExecutor(
+            max_workers=fetch_workers or settings().FETCH_WORKERS, thread_name_prefix="fetch"
+        )
+        self._notify_thread = None
+
+    @property
+    def scheduler(self):
+        return get_scheduler()
+
+    @classmethod
+    def from_config(cls, spec=None, shard=None, **kwargs):
+        spec = settings().ACCOUNTS_FILE if spec is None else spec
+        shard = settings().ACCOUNT_SHARD if shard is None else shard
+        return cls(load_accounts(spec, shard), **kwargs)
+
+    def _cycle(self, account):
+        with account.activate():
+            if account.poller is None:
+                account.start()
+            return poll_cycle(account.poller, self.fetch_pool)
+
+    def run_once(self):
+        """Poll every account once; returns ``{name: stats}``."""
+        futures = {
+            account.name: self.pool.submit(self._cycle, account)
+            for account in self.accounts
+        }
+        stats = {}
+        for name, future in futures.items():
+            try:
+                stats[name] = future.result()
+            except Exception as e:
+                logger.error(f"Błąd konta {name}: {e}")
+                stats[name] = None
+        self.scheduler.record(sum(s["orders"] for s in stats.values() if s))
+        return stats
+
+    def notify_once(self):
+        """Send what is due for every account; returns the number handled."""
+        handled = 0
+        for account in self.accounts:
+            with account.activate():
+                try:
+                    while True:
+                        sent = account.notifier.run_once()
+                        handled += sent
+                        if not sent or self._stop.is_set():
+                            break
+                except Exception as e:
+                    logger.error(f"Błąd wysyłki powiadomień: {e}")
+        return handled
+
+    def _notify_loop(self):
+        while not self._stop.is_set():
+            self.notify_once()
+            self._wake.wait(settings().NOTIFY_INTERVAL)
+            self._wake.clear()
+
+    def start(self):
+        """Start the UI and the shared sender thread."""
+        if settings().ENABLE_HTTP_SERVER:
+            threading.Thread(
+                target=start_http_server, args=(self.accounts,), daemon=True
+            ).start()
+        self._notify_thread = threading.Thread(
+            target=self._notify_loop, name="notifier", daemon=True
+        )
+        self._notify_thread.start()
+        logger.info(f"Obsługiwane konta: {', '.join(a.name for a in self.accounts)}")
+        return self
 
-        save_queue(queue)
-        time.sleep(POLL_INTERVAL)
+    def run(self):
+        """Poll every account until the process ends."""
+        self.start()
+        while True:
+            self.run_once()
+            self.scheduler.wait()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._notify_thread:
+            self._notify_thread.join(5)
+        self.pool.shutdown()
+        self.fetch_pool.shutdown()
+        for account in self.accounts:
+            account.close()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    logger.info(
+        "[START] Agent BaseLinker z automatycznym getLabel + Messenger + dotenv"
+    )
+    validate_env()
+    agent = AccountSet.from_config() if config.ACCOUNTS_FILE else Agent()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: agent.scheduler.trigger("(SIGUSR1)"))
+    agent.run()
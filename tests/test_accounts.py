@@ -0,0 +1,142 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "bench"))
+import json
+import logging
+import threading
+
+import pytest
+
+import bl_api_print_agent as bl
+import fake_baselinker
+
+
+def test_load_accounts_validates_and_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "RECIPIENT_ID", "r")
+    monkeypatch.setattr(bl.config, "PAGE_ACCESS_TOKEN", "p")
+    accounts = [{"name": f"shop{n}", "api_token": f"t{n}"} for n in range(30)]
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps(accounts))
+    assert bl.load_accounts(str(path)) == accounts
+
+    shards = [bl.load_accounts(str(path), f"{i}/3") for i in range(3)]
+    names = [a["name"] for shard in shards for a in shard]
+    assert sorted(names) == sorted(a["name"] for a in accounts)
+    assert all(shards)
+
+    with pytest.raises(ValueError):
+        bl.load_accounts('[{"name": "a"}]')
+    with pytest.raises(ValueError):
+        bl.load_accounts('[{"name": "a", "api_token": "x"}, {"name": "a", "api_token": "y"}]')
+    with pytest.raises(ValueError):
+        bl.load_accounts('[{"name": "a", "api_token": "x", "token": "y"}]')
+    with pytest.raises(ValueError):
+        bl.load_accounts(str(path), "3/3")
+
+
+@pytest.fixture
+def shops(monkeypatch):
+    shops = {
+        "ta": fake_baselinker.FakeShop(orders=3, label_size=16, status_id=1),
+        "tb": fake_baselinker.FakeShop(orders=2, label_size=16, status_id=2),
+    }
+    server = fake_baselinker.FakeBaseLinker(backend=shops)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(bl.config, "BASE_URL", f"{server.url}/connector.php")
+    monkeypatch.setattr(bl.config, "MESSENGER_URL", f"{server.url}/messenger")
+    monkeypatch.setattr(bl.config, "ORDER_POLL_MODE", "watermark")
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    monkeypatch.setattr(bl, "printer", bl.NullBackend())
+    monkeypatch.setattr(bl, "scheduler", bl.PollScheduler())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_accounts_share_pools_but_not_state(tmp_path, shops):
+    accounts = bl.AccountSet([
+        {"name": "a", "api_token": "ta", "status_id": 1, "api_rate_limit": 6000,
+         "db_file": str(tmp_path / "a.db"), "recipient_id": "ra"},
+        {"name": "b", "api_token": "tb", "status_id": 2, "api_rate_limit": 6000,
+         "db_file": str(tmp_path / "b.db"), "recipient_id": "rb"},
+    ], workers=2, fetch_workers=2)
+    a, b = accounts.accounts
+    recorded = []
+    bl.scheduler.record = recorded.append
+    try:
+        stats = accounts.run_once()
+        for account in accounts.accounts:
+            account.router.wait(5)
+        assert {name: s["orders"] for name, s in stats.items()} == {"a": 3, "b": 2}
+        assert a.router.default is b.router.default
+        assert len(bl.printer.jobs) == 5
+        assert a.storage.count_order_states() == {"notified": 3}
+        assert b.storage.count_order_states() == {"notified": 2}
+        assert a.storage.get_state("orders.watermark")[1] == 3
+        assert b.storage.get_state("orders.watermark")[1] == 2
+        assert a.limiter.usage()["used_last_minute"] == 7
+        assert b.limiter.usage()["used_last_minute"] == 5
+        assert "1" in a.printed_index() and "3" not in b.printed_index()
+
+        assert accounts.notify_once() == 5
+        assert shops.messages == 5
+        assert [s["orders"] for s in accounts.run_once().values()] == [0, 0]
+        assert recorded == [5, 0]
+    finally:
+        accounts.close()
+
+
+def test_account_context_reaches_log_records(tmp_path):
+    account = bl.Account("shop", "token", db_file=str(tmp_path / "shop.db"))
+    record = logging.LogRecord("bl", logging.INFO, __file__, 1, "x", (), None)
+    with account.activate():
+        assert bl.get_storage() is account.storage
+        assert bl.get_router() is account.router
+        bl.LogContextFilter().filter(record)
+    assert json.loads(bl.JsonFormatter().format(record))["account"] == "shop"
+    assert bl.current_account() is None
+    account.close()
+
+
+def test_ui_and_metrics_follow_the_selected_account(tmp_path):
+    import http.client
+    accounts = [
+        bl.Account(name, f"t{name}", db_file=str(tmp_path / f"{name}.db"))
+        for name in ("a", "b")
+    ]
+    with accounts[1].activate():
+        bl.get_storage().queue_order("7", [(b"x", "pdf")], {"order_id": "7"})
+        bl.mark_as_printed("8")
+        list(bl.iter_new_orders([{"order_id": 7}], {"7"}, {}))
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler, accounts)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+
+    def get(path):
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, resp.read().decode()
+
+    try:
+        assert json.loads(get("/status")[1])["queue_depth"] == 0
+        assert json.loads(get("/status?account=b")[1])["queue_depth"] == 1
+        history = json.loads(get("/history.json?account=b")[1])
+        assert {item["order_id"] for item in history["items"]} == {"7", "8"}
+        assert json.loads(get("/history.json?account=a")[1])["total"] == 0
+        assert "account=b" in get("/history?account=b")[1]
+        assert get("/status?account=c")[0] == 404
+        assert bl.get_last_order() == {} and accounts[0].last_order_data == {}
+        assert accounts[1].last_order_data["order_id"] == "7"
+        assert "Brak danych" in get("/test?account=a")[1]
+        assert "/test?account=b" in get("/?account=b")[1]
+
+        metrics = get("/metrics")[1]
+        assert 'bl_queue_depth{account="a"} 0' in metrics
+        assert 'bl_queue_depth{account="b"} 1' in metrics
+        assert 'bl_orders{account="b",state="queued"} 1' in metrics
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        for account in accounts:
+            account.close()
@@ -0,0 +1,159 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import subprocess
+
+import pytest
+
+import bl_api_print_agent as bl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def process_config():
+    """Restore the process settings ``configure`` changes."""
+    saved = dict(vars(bl.config))
+    yield
+    vars(bl.config).clear()
+    vars(bl.config).update(saved)
+    bl.configure()
+
+
+class FakeApi:
+    def __init__(self, orders):
+        self.orders = orders
+        self.calls = []
+
+    def __call__(self, method, parameters={}, binary_field=None):
+        self.calls.append(method)
+        if method == "getOrders":
+            since = parameters.get("date_confirmed_from", 0)
+            return {"orders": [o for o in self.orders if o["date_confirmed"] >= since]}
+        if method == "getOrderPackages":
+            oid = parameters["order_id"]
+            return {"packages": [{"package_id": int(oid) * 10, "courier_code": "dpd"}]}
+        if method == "getLabel":
+            return {"label": b"label-%d" % parameters["package_id"], "extension": "pdf"}
+        return {}
+
+
+def test_import_leaves_dotenv_and_log_file_alone(tmp_path):
+    (tmp_path / ".env").write_text("STATUS_ID=5\n")
+    log = tmp_path / "agent.log"
+    env = {k: v for k, v in os.environ.items() if k != "STATUS_ID"}
+    env.update(LOG_FILE=str(log), PYTHONPATH=ROOT)
+    out = subprocess.run(
+        [sys.executable, "-c",
+         "import threading, bl_api_print_agent as bl;"
+         "print(bl.STATUS_ID, bl.log_listener, threading.active_count())"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True,
+    ).stdout.split()
+    assert out == ["91618", "None", "1"]
+    assert not log.exists()
+
+
+def test_malformed_setting_fails_on_use_not_import(tmp_path):
+    env = {**os.environ, "POLL_INTERVAL": "x", "PYTHONPATH": ROOT}
+    out = subprocess.run(
+        [sys.executable, "-c",
+         "import bl_api_print_agent as bl\n"
+         "print(bl.STATUS_ID)\n"
+         "try:\n    bl.PollScheduler()\n"
+         "except ValueError as e:\n    print(e)"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True,
+    ).stdout.splitlines()
+    assert out == ["91618", "Nieprawidłowa wartość POLL_INTERVAL: 'x'"]
+
+
+def test_configure_rebuilds_components(process_config):
+    limiter, printer = bl.get_api_limiter(), bl.get_printer()
+    bl.configure(API_TOKEN="t", API_RATE_LIMIT=7, PRINTER_BACKEND="null")
+    assert bl.API_TOKEN == "t"
+    assert bl.get_api_limiter() is not limiter and bl.get_api_limiter().per_minute == 7
+    assert bl.get_printer() is not printer and bl.get_printer().name == "null"
+    with pytest.raises(ValueError):
+        bl.configure(STATUS=1)
+
+
+def test_agent_run_once_with_plugged_components(tmp_path, monkeypatch):
+    api = FakeApi([
+        {"order_id": 1, "date_confirmed": 100, "delivery_fullname": "A"},
+        {"order_id": 2, "date_confirmed": 200, "delivery_fullname": "B"},
+    ])
+    sent = []
+    backend = bl.NullBackend()
+    agent = bl.Agent(
+        config={"DB_FILE": str(tmp_path / "agent.db"), "LABEL_CACHE_DAYS": 0,
+                "ORDER_POLL_MODE": "watermark"},
+        api=api, printer=backend, notifier=lambda text: sent.append(text) or True,
+    )
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+
+    stats = agent.run_once()
+    agent.router.wait(5)
+    assert (stats["orders"], stats["labels"]) == (2, 2)
+    assert [docs for _, _, docs in backend.jobs] == [[b"label-10"], [b"label-20"]]
+    while agent.notifier.run_once():
+        pass
+    assert len(sent) == 2
+    assert agent.storage.count_order_states() == {"notified": 2}
+    assert agent.storage.get_state("orders.watermark") == [200, 2]
+
+    assert agent.run_once()["orders"] == 0
+    assert api.calls.count("getLabel") == 2
+    agent.close()
+    assert bl.DB_FILE != agent.storage.path
+    assert bl.get_storage() is not agent.storage
+
+
+def test_agent_reuses_its_fetch_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    api = FakeApi([{"order_id": 1, "date_confirmed": 100}])
+    agent = bl.Agent(
+        config={"DB_FILE": str(tmp_path / "pool.db"), "ORDER_POLL_MODE": "watermark"},
+        api=api, printer=bl.NullBackend(),
+    )
+    pools = []
+    real = bl.ThreadPoolExecutor
+    monkeypatch.setattr(bl, "ThreadPoolExecutor", lambda *a, **kw: pools.append(kw) or real(*a, **kw))
+
+    agent.run_once()
+    api.orders.append({"order_id": 2, "date_confirmed": 200})
+    agent.run_once()
+    agent.router.wait(5)
+    assert api.calls.count("getLabel") == 2
+    assert not [kw for kw in pools if kw.get("thread_name_prefix") == "fetch"]
+    agent.close()
+
+
+def test_agents_keep_their_own_components(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    agents = [
+        bl.Agent(
+            config={"DB_FILE": str(tmp_path / f"{n}.db"), "STATUS_ID": n,
+                    "ORDER_POLL_MODE": "watermark"},
+            api=FakeApi([{"order_id": n, "date_confirmed": n}]), printer=bl.NullBackend(),
+        )
+        for n in (1, 2)
+    ]
+    for agent in agents:
+        agent.run_once()
+        agent.router.wait(5)
+        with agent.activate():
+            assert bl.get_storage() is agent.storage
+            assert bl.get_router() is agent.router
+            assert bl.STATUS_ID == agent.config.STATUS_ID
+    assert [len(a.printer.jobs) for a in agents] == [1, 1]
+    assert "1" in agents[0].printed_index() and "1" not in agents[1].printed_index()
+    assert agents[0].limiter is not agents[1].limiter
+    for agent in agents:
+        agent.close()
+
+
+def test_agent_uses_given_storage(tmp_path):
+    storage = bl.Storage(str(tmp_path / "given.db"))
+    agent = bl.Agent(storage=storage, api=FakeApi([]))
+    with agent.activate():
+        assert bl.get_storage() is storage
+    assert bl.get_storage() is not storage
+    storage.close()
@@ -0,0 +1,127 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "bench"))
+import threading
+
+import pytest
+
+import bl_api_print_agent as bl
+import fake_baselinker
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(backend, **kwargs):
+        server = fake_baselinker.FakeBaseLinker(backend=backend, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "STATUS_ID", 91618)
+    monkeypatch.setattr(bl, "api_limiter", bl.RateLimiter(0))
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    monkeypatch.setattr(bl, "scheduler", bl.PollScheduler())
+    monkeypatch.setattr(bl, "label_cache", bl.LabelCache(days=0))
+    sent = []
+
+    def start(server, name, mode="watermark"):
+        monkeypatch.setattr(bl.config, "BASE_URL", f"{server.url}/connector.php")
+        monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / f"{name}.db"))
+        monkeypatch.setattr(bl, "_storage", None)
+        monkeypatch.setattr(bl, "_printed_index", None)
+        monkeypatch.setattr(bl, "printer", bl.NullBackend())
+        monkeypatch.setattr(bl, "router", bl.PrinterRouter())
+        monkeypatch.setattr(bl, "notifier", bl.NotificationWorker(
+            digest_threshold=0, send=lambda text: sent.append(text) or True,
+        ))
+        return bl.OrderPoller(bl.get_storage(), mode=mode)
+
+    yield start
+    bl.get_storage().close()
+
+
+def printed_orders():
+    return sorted(
+        int(title.split("_")[1]) for title, _, _ in bl.printer.jobs
+    )
+
+
+def test_poll_cycle_prints_every_order_of_fake_shop(serve, agent):
+    shop = fake_baselinker.FakeShop(orders=110, packages=2, label_size=64)
+    server = serve(shop)
+    poller = agent(server, "shop")
+
+    stats = bl.poll_cycle(poller)
+    bl.router.wait(5)
+    assert stats["orders"] == 110 and stats["labels"] == 220
+    assert bl.get_storage().count_order_states() == {"notified": 110}
+    assert server.calls["getOrderPackages"] == 110
+    assert server.calls["getLabel"] == 220
+    assert bl.printer.jobs[0][2] == [shop.label(100), shop.label(101)]
+
+    assert bl.poll_cycle(poller)["orders"] == 0
+    assert server.calls["getLabel"] == 220
+
+
+def test_journal_of_fake_shop_brings_new_orders(serve, agent):
+    shop = fake_baselinker.FakeShop(orders=5, label_size=16)
+    server = serve(shop)
+    poller = agent(server, "journal", mode="journal")
+
+    assert bl.poll_cycle(poller)["orders"] == 5
+    assert bl.get_storage().get_state("orders.journal_log_id") == 5
+    shop.count = 130
+    assert bl.poll_cycle(poller)["orders"] == 125
+    bl.router.wait(5)
+    assert printed_orders() == list(range(1, 131))
+    assert bl.get_storage().get_state("orders.journal_log_id") == 130
+    assert server.calls["getJournalList"] == 3
+
+
+def test_injected_errors_are_counted(serve, agent):
+    server = serve(fake_baselinker.FakeShop(orders=5), error_rate=1, error_kind="api")
+    bl.poll_cycle(agent(server, "errors"))
+    assert server.errors["getOrders"] == server.calls["getOrders"] == 1
+    assert bl.get_storage().count_order_states() == {}
+
+
+def test_locked_database_during_drain_does_not_end_the_loop(serve, agent, monkeypatch):
+    server = serve(fake_baselinker.FakeShop(orders=2))
+    poller = agent(server, "locked")
+
+    def locked(printed):
+        raise bl.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(bl, "drain_queue", locked)
+    errors = bl.metrics.value("bl_poll_errors_total") or 0
+    assert bl.poll_cycle(poller)["orders"] == 2
+    assert bl.metrics.value("bl_poll_errors_total") == errors + 1
+
+
+def test_recorded_traffic_replays(serve, agent, tmp_path):
+    traffic = str(tmp_path / "traffic.jsonl")
+    shop = serve(fake_baselinker.FakeShop(orders=3, packages=1, label_size=32))
+    proxy = serve(None, upstream=f"{shop.url}/connector.php", record=traffic)
+    bl.poll_cycle(agent(proxy, "recorded"))
+    bl.router.wait(5)
+    recorded = bl.printer.jobs
+    assert printed_orders() == [1, 2, 3]
+    proxy.record_file.flush()
+
+    replay = fake_baselinker.Replay(traffic)
+    server = serve(replay)
+    bl.poll_cycle(agent(server, "replayed"))
+    bl.router.wait(5)
+    assert bl.printer.jobs == recorded
+    assert sorted(replay.visible()) == ["1", "2", "3"]
+    assert server.calls["getLabel"] == 3
@@ -0,0 +1,71 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import bl_api_print_agent as bl
+
+
+def test_index_follows_mark_as_printed_without_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "dedup.db"))
+    bl.get_storage().mark_as_printed("old")
+    index = bl.get_printed_index()
+    assert "old" in index
+
+    def no_reload():
+        raise AssertionError("index reloaded")
+
+    monkeypatch.setattr(bl.get_storage(), "iter_printed_orders", no_reload)
+    bl.mark_as_printed("new")
+    assert bl.get_printed_index() is index
+    assert "new" in index
+    assert "other" not in index
+    assert len(index) == 2
+
+
+def test_exact_index_expires_old_orders(tmp_path):
+    storage = bl.Storage(str(tmp_path / "exact.db"))
+    index = bl.PrintedIndex(storage)
+    now = datetime.now()
+    index.add("a", now - timedelta(days=10))
+    index.add("b", now - timedelta(days=1))
+    index.add("a", now)  # already known, keeps its first timestamp
+    index.expire(now - timedelta(days=5))
+    assert "a" not in index
+    assert "b" in index
+    storage.close()
+
+
+def test_bloom_index_has_no_false_negatives(tmp_path):
+    storage = bl.Storage(str(tmp_path / "bloom.db"))
+    for i in range(500):
+        storage.mark_as_printed(str(i))
+    index = bl.PrintedIndex(storage, mode="bloom", capacity=500, error_rate=0.01)
+    assert all(str(i) in index for i in range(500))
+    false_hits = sum(str(i) in index for i in range(500, 5500))
+    assert false_hits == 0
+    assert index.lookups < 500 + 200
+    storage.close()
+
+
+def test_bloom_false_positive_is_confirmed_in_storage(tmp_path):
+    storage = bl.Storage(str(tmp_path / "confirm.db"))
+    index = bl.PrintedIndex(storage, mode="bloom", capacity=1, error_rate=0.5)
+    index.add("x")
+    bucket = next(iter(index._buckets.values()))
+    bucket.bits[:] = b"\xff" * len(bucket.bits)
+    assert "never-printed" not in index
+    assert index.lookups == 1
+    storage.close()
+
+
+def test_bloom_index_drops_expired_days(tmp_path):
+    storage = bl.Storage(str(tmp_path / "days.db"))
+    index = bl.PrintedIndex(storage, mode="bloom")
+    now = datetime.now()
+    index.add("old", now - timedelta(days=10))
+    index.add("new", now)
+    index.expire(now - timedelta(days=5))
+    assert len(index._buckets) == 1
+    assert len(index) == 1
+    storage.close()
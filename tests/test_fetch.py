@@ -0,0 +1,16 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time
+
+import bl_api_print_agent as bl
+
+
+def test_fetch_labels_concurrently_keeps_order(monkeypatch):
+    def fake_fetch(order_id):
+        time.sleep(0.05 if order_id == "1" else 0)
+        return [(order_id.encode(), "pdf")]
+
+    monkeypatch.setattr(bl, "fetch_order_labels", fake_fetch)
+    result = list(bl.fetch_labels_concurrently(["1", "2", "3"], workers=3))
+    assert [oid for oid, _ in result] == ["1", "2", "3"]
+    assert result[0][1] == [(b"1", "pdf")]
@@ -0,0 +1,201 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import json
+import threading
+import time
+import http.server
+from urllib.parse import parse_qs
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+class StubConnector(http.server.BaseHTTPRequestHandler):
+    """Stands in for BaseLinker's ``connector.php``."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        server = self.server
+        server.calls.append({
+            "method": form["method"][0],
+            "parameters": json.loads(form["parameters"][0]),
+            "token": self.headers.get("X-BLToken"),
+            "client": self.client_address,
+        })
+        status = server.statuses.pop(0) if server.statuses else 200
+        time.sleep(server.delay)
+        body = json.dumps(self.respond(server.calls[-1])).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, call):
+        if call["method"] == "getLabel":
+            return {"status": "SUCCESS", "label": self.server.label, "extension": "zpl"}
+        if call["method"] != "getOrders":
+            return {"status": "SUCCESS"}
+        since = call["parameters"].get("date_confirmed_from", 0)
+        id_from = call["parameters"].get("id_from", 0)
+        page = sorted(
+            (o for o in self.server.orders
+             if o["date_confirmed"] >= since and o["order_id"] >= id_from),
+            key=lambda o: (o["date_confirmed"], o["order_id"]),
+        )[:100]
+        return {"status": "SUCCESS", "orders": page}
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubConnector)
+    server.calls = []
+    server.statuses = []
+    server.orders = []
+    server.label = None
+    server.delay = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/connector.php"
+    client = bl.HttpClient((1, 2), retries=2, backoff=0)
+    monkeypatch.setattr(bl.config, "BASE_URL", url)
+    monkeypatch.setattr(bl, "api_client", client)
+    monkeypatch.setattr(bl, "api_limiter", bl.RateLimiter(0))
+    monkeypatch.setattr(bl.config, "API_TOKEN", "secret")
+    yield server
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_call_api_posts_method_and_parameters(stub):
+    assert bl.call_api("getOrders", {"status_id": 5}) == {
+        "status": "SUCCESS",
+        "orders": [],
+    }
+    call = stub.calls[0]
+    assert call["method"] == "getOrders"
+    assert call["parameters"] == {"status_id": 5}
+    assert call["token"] == "secret"
+
+
+def test_call_api_reuses_connection(stub):
+    bl.call_api("getOrders")
+    bl.call_api("getOrders")
+    assert stub.calls[0]["client"] == stub.calls[1]["client"]
+
+
+def test_call_api_retries_server_errors(stub):
+    stub.statuses = [503, 429]
+    assert bl.call_api("getLabel").get("status") == "SUCCESS"
+    assert len(stub.calls) == 3
+
+
+def test_non_idempotent_client_never_resends(stub):
+    client = bl.HttpClient((1, 0.2), retries=2, backoff=0, idempotent=False)
+    form = {"method": "sendMessage", "parameters": "{}"}
+    stub.statuses = [503]
+    assert client.post(bl.BASE_URL, "messenger", data=form).status_code == 503
+    assert len(stub.calls) == 1
+    stub.delay = 0.5
+    with pytest.raises(bl.requests.exceptions.RequestException):
+        client.post(bl.BASE_URL, "messenger", data=form)
+    assert len(stub.calls) == 2
+    client.close()
+
+
+def test_latency_is_recorded_per_method(stub):
+    bl.call_api("getOrders")
+    bl.call_api("getLabel")
+    bl.call_api("getLabel")
+    stats = bl.get_api_client().latency_stats()
+    assert stats["getOrders"]["count"] == 1
+    assert stats["getLabel"]["count"] == 2
+    assert stats["getLabel"]["max"] >= stats["getLabel"]["avg"] > 0
+
+
+def test_iter_orders_walks_every_page(stub):
+    stub.orders = [
+        {"order_id": i, "date_confirmed": 1000 + i} for i in range(1, 251)
+    ]
+    ids = [o["order_id"] for o in bl.iter_orders()]
+    assert ids == list(range(1, 251))
+    assert [c["parameters"].get("date_confirmed_from") for c in stub.calls] == [
+        None, 1100, 1199
+    ]
+
+
+def test_iter_orders_handles_ties_at_page_boundary(stub):
+    stub.orders = [{"order_id": i, "date_confirmed": 5} for i in range(1, 101)]
+    stub.orders += [{"order_id": i, "date_confirmed": 6} for i in range(101, 121)]
+    ids = [o["order_id"] for o in bl.iter_orders()]
+    assert ids == list(range(1, 121))
+
+
+def test_iter_orders_pages_through_a_crowded_second(stub):
+    stub.orders = [{"order_id": i, "date_confirmed": 5} for i in range(1, 251)]
+    stub.orders += [{"order_id": i, "date_confirmed": 6} for i in range(251, 271)]
+    ids = [o["order_id"] for o in bl.iter_orders()]
+    assert ids == list(range(1, 271))
+    assert [c["parameters"].get("id_from") for c in stub.calls] == [None, 101, 201, None]
+
+
+def test_iter_orders_respects_page_cap(stub):
+    stub.orders = [
+        {"order_id": i, "date_confirmed": 1000 + i} for i in range(1, 251)
+    ]
+    # pages overlap on the last confirmation date, which is deduplicated
+    assert len(list(bl.iter_orders(max_pages=2))) == 199
+
+
+def test_label_fetching_starts_before_paging_finishes(stub, monkeypatch):
+    stub.orders = [
+        {"order_id": i, "date_confirmed": 1000 + i} for i in range(1, 251)
+    ]
+    pages_seen = []
+
+    def fake_fetch(order_id):
+        pages_seen.append(len(stub.calls))
+        return []
+
+    monkeypatch.setattr(bl, "fetch_order_labels", fake_fetch)
+    ids = (str(o["order_id"]) for o in bl.iter_orders())
+    results = list(bl.fetch_labels_concurrently(ids, workers=2))
+    assert len(results) == 250
+    assert min(pages_seen) == 1
+
+
+def test_read_streamed_field_decodes_across_chunks():
+    import base64
+
+    payload = bytes(range(256)) * 40
+    encoded = base64.b64encode(payload).decode()
+    body = json.dumps({"status": "SUCCESS", "label": encoded, "extension": "pdf"})
+    body = body.replace("/", "\\/").encode()
+    for size in (1, 3, 7, 4096):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        doc = bl.read_streamed_field(chunks, "label")
+        assert doc["label"] == payload
+        assert doc["extension"] == "pdf"
+
+
+def test_read_streamed_field_without_label():
+    doc = bl.read_streamed_field([b'{"status": "ERROR", "error_code": "X"}'], "label")
+    assert doc == {"status": "ERROR", "error_code": "X"}
+    doc = bl.read_streamed_field([b'{"label": null}'], "label")
+    assert doc == {"label": None}
+
+
+def test_get_label_streams_and_decodes(stub):
+    import base64
+
+    stub.label = base64.b64encode(b"^XA^FDlabel/1^XZ" * 5000).decode()
+    label, ext = bl.get_label("dpd", 123)
+    assert label == b"^XA^FDlabel/1^XZ" * 5000
+    assert ext == "zpl"
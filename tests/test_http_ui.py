@@ -0,0 +1,126 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import http.client
+import threading
+import time
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+@pytest.fixture
+def ui(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "ui.db"))
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(conn, path):
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    return resp.status, resp.read().decode()
+
+
+def test_keep_alive_responses_are_not_delayed(ui):
+    conn = http.client.HTTPConnection("127.0.0.1", ui.server_port, timeout=2)
+    get(conn, "/metrics")
+    start = time.monotonic()
+    for _ in range(10):
+        assert get(conn, "/metrics")[0] == 200
+    assert time.monotonic() - start < 0.3
+
+
+def test_slow_print_does_not_block_ui(ui, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(bl, "print_test_page", lambda: release.wait(5))
+    conn = http.client.HTTPConnection("127.0.0.1", ui.server_port, timeout=2)
+
+    start = time.monotonic()
+    status, body = get(conn, "/testprint")
+    assert status == 200
+    assert "zlecony" in body
+    assert time.monotonic() - start < 1
+
+    status, body = get(conn, "/")
+    assert "Test wydruku" in body and "W toku" in body
+
+    release.set()
+    for _ in range(100):
+        if "wysłany" in bl.background_status["Test wydruku"][1]:
+            break
+        time.sleep(0.01)
+    assert "wysłany" in get(conn, "/")[1]
+    conn.close()
+
+
+def test_keep_alive_serves_several_requests_per_connection(ui):
+    conn = http.client.HTTPConnection("127.0.0.1", ui.server_port, timeout=2)
+    for _ in range(3):
+        assert get(conn, "/history")[0] == 200
+    assert get(conn, "/missing")[0] == 404
+    conn.close()
+
+
+def test_stuck_client_does_not_block_others(ui):
+    import socket
+
+    stuck = socket.create_connection(("127.0.0.1", ui.server_port))
+    stuck.sendall(b"GET / HTTP/1.1\r\n")
+    conn = http.client.HTTPConnection("127.0.0.1", ui.server_port, timeout=2)
+    assert get(conn, "/")[0] == 200
+    conn.close()
+    stuck.close()
+
+
+def seed_history(storage):
+    conn = storage.connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO printed_orders(order_id, printed_at) VALUES (?, ?)",
+            [(str(100 + i), f"2024-03-{1 + i:02d}T12:00:00") for i in range(10)],
+        )
+    storage.enqueue("105", b"label", "pdf", {})
+    storage.enqueue("999", b"label", "pdf", {})
+
+
+def test_history_pages_and_filters(tmp_path):
+    storage = bl.Storage(str(tmp_path / "history.db"))
+    seed_history(storage)
+
+    items, total = storage.history(page=1, per_page=4)
+    assert total == 11
+    assert [i["order_id"] for i in items] == ["999", "109", "108", "107"]
+    assert items[0]["status"] == "queued"
+
+    items, _ = storage.history(page=2, per_page=4)
+    assert [i["order_id"] for i in items] == ["106", "105", "104", "103"]
+    assert items[1]["status"] == "queued"
+
+    items, total = storage.history(date_from="2024-03-02", date_to="2024-03-03")
+    assert total == 2
+    assert [i["order_id"] for i in items] == ["102", "101"]
+
+    items, total = storage.history(order_id="10")
+    assert total == 10
+    storage.close()
+
+
+def test_history_json_endpoint(ui):
+    import json
+
+    seed_history(bl.get_storage())
+    conn = http.client.HTTPConnection("127.0.0.1", ui.server_port, timeout=2)
+    status, body = get(conn, "/history.json?per_page=3&page=2")
+    data = json.loads(body)
+    assert status == 200
+    assert data["total"] == 11
+    assert [i["order_id"] for i in data["items"]] == ["107", "106", "105"]
+
+    status, body = get(conn, "/history?order_id=101")
+    assert status == 200 and "101" in body and "Strona 1 z 1" in body
+    assert get(conn, "/history?from=bad")[0] == 400
+    conn.close()
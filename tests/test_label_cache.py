@@ -0,0 +1,99 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import http.client
+import json
+import threading
+import time
+
+import bl_api_print_agent as bl
+
+
+def test_retry_uses_cached_label(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "cache.db"))
+    cache = bl.LabelCache(days=1, max_bytes=0)
+    monkeypatch.setattr(bl, "label_cache", cache)
+    monkeypatch.setattr(bl, "get_order_packages", lambda oid: [
+        {"package_id": 1, "courier_code": "dpd"},
+        {"package_id": 2, "courier_code": "dpd"},
+    ])
+    calls = []
+
+    def fake_get_label(courier_code, package_id):
+        calls.append(package_id)
+        return f"label{package_id}".encode(), "pdf"
+
+    monkeypatch.setattr(bl, "get_label", fake_get_label)
+
+    first = bl.fetch_order_labels("7")
+    second = bl.fetch_order_labels("7")
+    assert first == second == [(b"label1", "pdf"), (b"label2", "pdf")]
+    assert calls == [1, 2]
+    assert cache.stats() == {"hits": 2, "misses": 2, "entries": 2, "bytes": 12}
+    assert cache.order_labels("7") == first
+
+
+def test_cache_expires_and_evicts_least_recently_used(tmp_path):
+    storage = bl.Storage(str(tmp_path / "evict.db"))
+    cache = bl.LabelCache(lambda: storage, days=1, max_bytes=25)
+    cache.put("dpd", 1, "1", b"a" * 10, "pdf")
+    cache.put("dpd", 2, "2", b"b" * 10, "pdf")
+    cache.put("dpd", 3, "3", b"c" * 10, "pdf")
+    time.sleep(0.01)
+    assert cache.get("dpd", 1)  # now the most recently used
+    storage.connection().execute(
+        "UPDATE label_cache SET fetched_at = '2000-01-01' WHERE package_id = '3'"
+    )
+    storage.connection().commit()
+
+    assert cache.get("dpd", 3) is None
+    assert cache.evict() == 1
+    assert storage.label_cache_size() == (2, 20)
+
+    cache.max_bytes = 15
+    assert cache.evict() == 1
+    assert cache.get("dpd", 1) == (b"a" * 10, "pdf")
+    assert cache.get("dpd", 2) is None
+    assert storage.connection().execute("SELECT COUNT(*) FROM label_blobs").fetchone()[0] == 1
+    storage.close()
+
+
+def test_queued_blob_survives_cache_eviction(tmp_path):
+    storage = bl.Storage(str(tmp_path / "shared.db"))
+    storage.enqueue("1", b"same", "pdf", {})
+    storage.cache_label("dpd", 1, "1", b"same", "pdf")
+    storage.evict_label_cache(days=-1, max_bytes=0)
+    assert [storage.read_label(it["label_ref"]) for it in storage.load_queue()] == [b"same"]
+    storage.close()
+
+
+def test_history_reprints_from_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "reprint.db"))
+    backend = bl.NullBackend()
+    monkeypatch.setattr(bl, "printer", backend)
+    monkeypatch.setattr(bl, "router", bl.PrinterRouter())
+    monkeypatch.setattr(bl, "label_cache", bl.LabelCache(days=1))
+    monkeypatch.setattr(bl, "call_api", lambda *a, **kw: (_ for _ in ()).throw(AssertionError))
+    storage = bl.get_storage()
+    storage.mark_as_printed("5")
+    storage.mark_as_printed("6")
+    storage.cache_label("dpd", 1, "5", b"^XA", "zpl")
+
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=2)
+        conn.request("GET", "/history.json")
+        items = json.loads(conn.getresponse().read())["items"]
+        assert {i["order_id"]: i["label_cached"] for i in items} == {"5": True, "6": False}
+
+        conn.request("GET", "/reprint?order_id=5")
+        assert conn.getresponse().read()
+        for _ in range(200):
+            if backend.jobs:
+                break
+            time.sleep(0.01)
+        assert backend.jobs == [("label_reprint_5", "zpl", [b"^XA"])]
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,131 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import atexit
+import json
+import logging
+import logging.handlers
+import threading
+
+import bl_api_print_agent as bl
+
+
+def write_log(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            level = "ERROR" if i % 10 == 0 else "INFO"
+            f.write(f"2024-01-01 00:00:00 [{level}] linia {i} zażółć\n")
+
+
+def test_iter_lines_reversed_crosses_chunks(tmp_path):
+    log = tmp_path / "agent.log"
+    write_log(log, 500)
+    lines = list(bl.iter_lines_reversed(str(log), chunk_size=64))
+    assert len(lines) == 500
+    assert lines[0].endswith("linia 499 zażółć")
+    assert lines[-1].endswith("linia 0 zażółć")
+
+
+def test_tail_log_reads_only_the_end(tmp_path):
+    log = tmp_path / "agent.log"
+    write_log(log, 20000)
+    lines = bl.tail_log(str(log), 3)
+    assert [line.split()[4] for line in lines] == ["19997", "19998", "19999"]
+
+
+def test_tail_log_filters(tmp_path):
+    log = tmp_path / "agent.log"
+    write_log(log, 100)
+    errors = bl.tail_log(str(log), 2, level="ERROR")
+    assert [line.split()[4] for line in errors] == ["80", "90"]
+    found = bl.tail_log(str(log), 10, search="LINIA 42 ")
+    assert len(found) == 1
+
+
+def test_follow_log_survives_rotation(tmp_path):
+    log = tmp_path / "agent.log"
+    log.write_text("old\n")
+    stop = threading.Event()
+    stream = bl.follow_log(str(log), stop, poll=0.01)
+
+    assert next(stream) is None
+    with open(log, "a") as f:
+        f.write("new line\n")
+    assert next(stream) == "new line"
+
+    os.rename(log, tmp_path / "agent.log.1")
+    log.write_text("after rotation\n")
+    lines = [next(stream) for _ in range(3)]
+    assert "after rotation" in lines
+    stop.set()
+    stream.close()
+
+
+def test_logs_stream_endpoint(tmp_path, monkeypatch):
+    import http.client
+
+    log = tmp_path / "agent.log"
+    log.write_text("")
+    monkeypatch.setattr(bl.config, "LOG_FILE", str(log))
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+        conn.request("GET", "/logs/stream?level=ERROR")
+        resp = conn.getresponse()
+        assert resp.getheader("Content-Type").startswith("text/event-stream")
+        with open(log, "a") as f:
+            f.write("x [INFO] skip\nx [ERROR] boom\n")
+        assert resp.fp.readline() == b"data: x [ERROR] boom\n"
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_logging_goes_through_queue_listener(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "LOG_FILE", str(tmp_path / "agent.log"))
+    monkeypatch.setattr(bl, "log_listener", None)
+    root = logging.getLogger()
+    before = list(root.handlers)
+    listener = bl.setup_logging()
+    try:
+        assert bl.setup_logging() is listener
+        added = [h for h in root.handlers if h not in before]
+        assert len(added) == 1 and isinstance(added[0], logging.handlers.QueueHandler)
+        assert listener._thread is not None
+    finally:
+        atexit.unregister(listener.stop)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        for handler in root.handlers[len(before):]:
+            root.removeHandler(handler)
+
+
+def test_json_records_carry_context_fields():
+    record = logging.LogRecord("bl", logging.INFO, __file__, 1, "wydruk %s", ("ok",), None)
+    with bl.log_context(order_id="42"), bl.log_context(method="getLabel"):
+        bl.LogContextFilter().filter(record)
+    line = bl.JsonFormatter().format(record)
+    entry = json.loads(line)
+    assert entry["message"] == "wydruk ok"
+    assert entry["order_id"] == "42" and entry["method"] == "getLabel"
+    assert bl.log_line_matches(line, "INFO")
+    assert not bl.log_line_matches(line, "ERROR")
+
+
+def test_raw_payload_is_sampled_and_truncated(monkeypatch):
+    logged = []
+    monkeypatch.setattr(bl.logger, "isEnabledFor", lambda level: True)
+    monkeypatch.setattr(bl.logger, "debug", lambda msg, *args, **kw: logged.append(args))
+    monkeypatch.setattr(bl.config, "LOG_RAW_MAX_CHARS", 20)
+    monkeypatch.setattr(bl.config, "LOG_RAW_SAMPLE_RATE", 1)
+    bl.log_raw_payload("getOrders", {"orders": ["x" * 100]})
+    assert len(logged) == 1
+    method, text = logged[0]
+    assert method == "getOrders"
+    assert text.startswith('{"orders": ["xxxx') and "(+" in text and len(text) < 60
+
+    monkeypatch.setattr(bl.config, "LOG_RAW_SAMPLE_RATE", 0)
+    bl.log_raw_payload("getOrders", {"orders": []})
+    assert len(logged) == 1
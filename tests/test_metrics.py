@@ -0,0 +1,90 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import http.client
+import json
+import threading
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+def test_histogram_buckets_are_cumulative():
+    m = bl.Metrics()
+    m.histogram("t_seconds", "test", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        m.observe("t_seconds", value, kind='a"b')
+    text = m.render()
+    assert 't_seconds_bucket{kind="a\\"b",le="0.1"} 1' in text
+    assert 't_seconds_bucket{kind="a\\"b",le="1.0"} 3' in text
+    assert 't_seconds_bucket{kind="a\\"b",le="+Inf"} 4' in text
+    assert 't_seconds_count{kind="a\\"b"} 4' in text
+    assert m.value("t_seconds", kind='a"b') == (4, 6.05)
+
+
+def test_counters_gauges_and_collectors():
+    m = bl.Metrics()
+    m.counter("c_total", "test")
+    m.gauge("g", "test")
+    m.inc("c_total", method="x")
+    m.inc("c_total", 2, method="x")
+    m.set("g", 7)
+    m.collect("states", "gauge", "test", lambda: {"queued": 2}, label="state")
+    m.collect("broken", "gauge", "test", lambda: 1 / 0)
+    text = m.render()
+    assert "# TYPE c_total counter" in text
+    assert 'c_total{method="x"} 3' in text
+    assert "g 7" in text
+    assert 'states{state="queued"} 2' in text
+    assert "broken" not in text
+    assert m.snapshot()["c_total"] == {"method=x": 3}
+
+
+def test_call_api_and_print_are_instrumented(monkeypatch):
+    monkeypatch.setattr(bl, "metrics", bl.Metrics())
+    for name in ("bl_api_requests_total", "bl_print_jobs_total", "bl_labels_printed_total"):
+        bl.metrics.counter(name, "test")
+    for name in ("bl_api_request_seconds", "bl_api_throttle_seconds", "bl_print_job_seconds"):
+        bl.metrics.histogram(name, "test")
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {"status": "SUCCESS"}
+
+    monkeypatch.setattr(bl.get_api_client(), "post", lambda *a, **kw: Response())
+    bl.call_api("getOrders", {})
+    assert bl.metrics.value("bl_api_requests_total", method="getOrders", status=200) == 1
+    assert bl.metrics.value("bl_api_request_seconds", method="getOrders")[0] == 1
+
+    backend = bl.NullBackend()
+    assert bl.print_labels([(b"^XA", "zpl"), (b"^XZ", "zpl")], "1", backend)
+    assert bl.metrics.value("bl_labels_printed_total", backend="null") == 2
+    assert bl.metrics.value("bl_print_jobs_total", backend="null", result="ok") == 1
+
+
+@pytest.fixture
+def ui(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "metrics.db"))
+    server = bl.AgentHTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=2)
+    server.shutdown()
+    server.server_close()
+
+
+def test_metrics_and_status_endpoints(ui):
+    bl.enqueue_label("1", b"x", "pdf", {})
+    ui.request("GET", "/metrics")
+    resp = ui.getresponse()
+    text = resp.read().decode()
+    assert resp.getheader("Content-Type").startswith("text/plain; version=0.0.4")
+    assert "# TYPE bl_api_request_seconds histogram" in text
+    assert "bl_queue_depth 1" in text
+
+    ui.request("GET", "/status")
+    status = json.loads(ui.getresponse().read())
+    assert status["queue_depth"] == 1
+    assert "limit_per_minute" in status["api"]
+    assert "bl_poll_cycles_total" in status["metrics"]
@@ -0,0 +1,106 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time
+
+import bl_api_print_agent as bl
+
+
+def order(oid):
+    return {
+        "order_id": oid,
+        "name": f"Klient {oid}",
+        "platform": "allegro",
+        "shipping": "InPost",
+        "products": [{"name": "Bardzo długa nazwa produktu", "quantity": 1}],
+    }
+
+
+def make_worker(storage, results, **kwargs):
+    sent = []
+
+    def send(message):
+        sent.append(message)
+        return results.pop(0) if results else True
+
+    worker = bl.NotificationWorker(
+        storage_factory=lambda: storage, send=send, backoff=1, **kwargs
+    )
+    return worker, sent
+
+
+def test_outbox_deduplicates_by_order(tmp_path):
+    storage = bl.Storage(str(tmp_path / "outbox.db"))
+    assert storage.enqueue_notification("1", order("1")) is True
+    assert storage.enqueue_notification("1", order("1")) is False
+    assert storage.count_notifications() == 1
+    storage.close()
+
+
+def test_failed_send_is_retried_with_backoff(tmp_path):
+    storage = bl.Storage(str(tmp_path / "retry.db"))
+    storage.enqueue_notification("1", order("1"))
+    worker, sent = make_worker(storage, [False], digest_threshold=0, max_attempts=3)
+
+    assert worker.run_once() == 1
+    assert storage.due_notifications() == []
+    row = storage.connection().execute(
+        "SELECT attempts, status FROM notification_outbox"
+    ).fetchone()
+    assert row == (1, "pending")
+
+    storage.connection().execute(
+        "UPDATE notification_outbox SET next_attempt_at = '2000-01-01'"
+    )
+    assert worker.run_once() == 1
+    assert storage.count_notifications("sent") == 1
+    assert len(sent) == 2
+    storage.close()
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    storage = bl.Storage(str(tmp_path / "giveup.db"))
+    storage.enqueue_notification("1", order("1"))
+    worker, _ = make_worker(storage, [False, False], digest_threshold=0, max_attempts=2)
+    for _ in range(2):
+        worker.run_once()
+        storage.connection().execute(
+            "UPDATE notification_outbox SET next_attempt_at = '2000-01-01'"
+        )
+    assert storage.count_notifications("failed") == 1
+    storage.close()
+
+
+def test_high_volume_is_coalesced_into_digest(tmp_path):
+    storage = bl.Storage(str(tmp_path / "digest.db"))
+    for i in range(7):
+        storage.enqueue_notification(str(i), order(str(i)))
+    worker, sent = make_worker(storage, [], digest_threshold=3, digest_size=5)
+
+    assert worker.run_once() == 5
+    assert worker.run_once() == 2
+    # the remaining two are below the threshold and go out one by one
+    assert len(sent) == 3
+    assert sent[0].startswith("📦 Nowe zamówienia (5):")
+    assert sent[1].startswith("📦 Nowe zamówienie od: Klient 5")
+    assert storage.count_notifications("sent") == 7
+    storage.close()
+
+
+def test_notify_order_does_not_wait_for_messenger(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "async.db"))
+    worker, sent = make_worker(bl.get_storage(), [], digest_threshold=0)
+    original = worker.send
+    worker.send = lambda message: time.sleep(0.2) or original(message)
+    monkeypatch.setattr(bl, "notifier", worker)
+    worker.start()
+    try:
+        start = time.monotonic()
+        bl.notify_order(order("9"))
+        assert time.monotonic() - start < 0.1
+        for _ in range(100):
+            if sent:
+                break
+            time.sleep(0.01)
+        assert sent and "Klient 9" in sent[0]
+    finally:
+        worker.stop()
@@ -0,0 +1,196 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import bl_api_print_agent as bl
+
+
+def order(oid, confirmed):
+    return {"order_id": oid, "date_confirmed": confirmed}
+
+
+class FakeOrders:
+    def __init__(self, orders):
+        self.orders = orders
+        self.calls = []
+
+    def __call__(self, parameters=None, max_pages=None):
+        parameters = parameters or {}
+        self.calls.append(parameters)
+        since = parameters.get("date_confirmed_from", 0)
+        return [o for o in self.orders if o["date_confirmed"] >= since]
+
+
+def test_watermark_poll_returns_only_new_orders(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "poll.db"))
+    fake = FakeOrders([order(1, 100), order(2, 200)])
+    monkeypatch.setattr(bl, "iter_orders", fake)
+    poller = bl.OrderPoller(storage, mode="watermark", resync_minutes=0)
+
+    assert [o["order_id"] for o in list(poller.poll())] == [1, 2]
+    poller.commit({"1", "2"})
+    assert storage.get_state("orders.watermark") == [200, 2]
+
+    fake.orders.append(order(3, 200))
+    assert [o["order_id"] for o in list(poller.poll())] == [3]
+    assert fake.calls[-1] == {"date_confirmed_from": 200}
+    storage.close()
+
+
+def test_watermark_stops_at_unfinished_order(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "poll_retry.db"))
+    fake = FakeOrders([order(1, 100), order(2, 200), order(3, 300)])
+    monkeypatch.setattr(bl, "iter_orders", fake)
+    poller = bl.OrderPoller(storage, mode="watermark", resync_minutes=0)
+
+    list(poller.poll())
+    poller.commit({"1", "3"})
+    assert storage.get_state("orders.watermark") == [100, 1]
+    assert [o["order_id"] for o in list(poller.poll())] == [2, 3]
+    storage.close()
+
+
+def test_resync_does_not_move_watermark_back(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "poll_resync.db"))
+    fake = FakeOrders([order(1, 100), order(2, 200)])
+    monkeypatch.setattr(bl, "iter_orders", fake)
+    now = [0]
+    poller = bl.OrderPoller(storage, mode="watermark", resync_minutes=2, clock=lambda: now[0])
+
+    list(poller.poll())
+    poller.commit({"1", "2"})
+    now[0] = 60
+    assert list(poller.poll()) == []
+    poller.commit(set())
+    fake.orders.insert(0, order(5, 50))
+    now[0] = 120
+    assert [o["order_id"] for o in list(poller.poll())] == [5, 1, 2]
+    assert fake.calls[-1] == {}
+    poller.commit({"5"})
+    assert storage.get_state("orders.watermark") == [200, 2]
+    storage.close()
+
+
+def test_order_moved_into_status_late_waits_for_resync(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "poll_late.db"))
+    fake = FakeOrders([order(2, 200)])
+    monkeypatch.setattr(bl, "iter_orders", fake)
+    now = [0]
+    poller = bl.OrderPoller(storage, mode="watermark", resync_minutes=5, clock=lambda: now[0])
+    list(poller.poll())
+    poller.commit({"2"})
+
+    fake.orders.insert(0, order(1, 100))
+    for now[0] in (60, 120, 240):
+        assert list(poller.poll()) == []
+    now[0] = 300
+    assert [o["order_id"] for o in poller.poll()] == [1, 2]
+    storage.close()
+
+
+def test_journal_falls_back_to_full_scan(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "journal_off.db"))
+    storage.set_state("orders.journal_log_id", 10)
+    monkeypatch.setattr(bl, "call_api", lambda method, params: {"status": "ERROR"})
+    fake = FakeOrders([order(1, 100), order(2, 200)])
+    monkeypatch.setattr(bl, "iter_orders", fake)
+    poller = bl.OrderPoller(storage, mode="journal", resync_minutes=0)
+
+    assert [o["order_id"] for o in poller.poll()] == [1, 2]
+    assert fake.calls == [{}]
+    poller.commit({"1", "2"})
+    assert storage.get_state("orders.watermark") is None
+    assert storage.get_state("orders.journal_log_id") == 10
+    storage.close()
+
+
+def test_journal_follows_status_changes(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "journal.db"))
+    storage.set_state("orders.journal_log_id", 10)
+    monkeypatch.setattr(bl.config, "STATUS_ID", 7)
+    monkeypatch.setattr(bl, "call_api", lambda method, params: {
+        "status": "SUCCESS",
+        "logs": [
+            {"log_id": 11, "order_id": 1, "object_id": 7},
+            {"log_id": 12, "order_id": 2, "object_id": 99},
+            {"log_id": 13, "order_id": 3, "object_id": 7},
+        ],
+    })
+    fetched = []
+
+    def fake_iter_orders(parameters=None, max_pages=None):
+        fetched.append(parameters["order_id"])
+        return iter([order(parameters["order_id"], 0)])
+
+    monkeypatch.setattr(bl, "iter_orders", fake_iter_orders)
+    poller = bl.OrderPoller(storage, mode="journal", resync_minutes=0)
+
+    assert [o["order_id"] for o in list(poller.poll())] == [1, 3]
+    assert fetched == [1, 3]
+    poller.commit({"1"})
+    assert storage.get_state("orders.journal_log_id") == 13
+    assert storage.order_state("3") == "fetched"
+
+    monkeypatch.setattr(bl, "call_api", lambda method, params: {"status": "SUCCESS", "logs": []})
+    assert [o["order_id"] for o in list(poller.poll())] == [3]
+    assert fetched == [1, 3, 3]
+    storage.record_fetched("3", {})
+    storage.queue_order("3", [], {})
+    poller.commit({"3"})
+    assert list(poller.poll()) == []
+    storage.close()
+
+
+def test_journal_reads_past_full_pages_and_skips_printed(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "journal_pages.db"))
+    storage.set_state("orders.journal_log_id", 0)
+    storage.mark_as_printed("1")
+    storage.record_fetched("2", {"order_id": "2"})
+    monkeypatch.setattr(bl.config, "STATUS_ID", 7)
+    logs = [{"log_id": n, "order_id": n, "object_id": 7} for n in range(1, 151)]
+
+    def fake_call_api(method, params):
+        after = params["last_log_id"]
+        page = [log for log in logs if log["log_id"] > after][:bl.OrderPoller.JOURNAL_PAGE_SIZE]
+        return {"status": "SUCCESS", "logs": page}
+
+    fetched = []
+
+    def fake_iter_orders(parameters=None, max_pages=None):
+        fetched.append(parameters["order_id"])
+        return iter([] if parameters["order_id"] == 2 else [order(parameters["order_id"], 0)])
+
+    monkeypatch.setattr(bl, "call_api", fake_call_api)
+    monkeypatch.setattr(bl, "iter_orders", fake_iter_orders)
+    poller = bl.OrderPoller(storage, mode="journal", resync_minutes=0)
+
+    assert len(list(poller.poll())) == 148
+    assert fetched == list(range(2, 151))
+    poller.commit({str(n) for n in range(3, 151)})
+    assert storage.get_state("orders.journal_log_id") == 150
+    assert storage.fetched_orders() == []
+    storage.close()
+
+
+def test_journal_keeps_orders_arriving_during_first_scan(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "journal_seed.db"))
+    monkeypatch.setattr(bl.config, "STATUS_ID", 7)
+    logs = [{"log_id": 1, "order_id": 1, "object_id": 7}]
+    monkeypatch.setattr(bl, "call_api", lambda method, params: {
+        "status": "SUCCESS",
+        "logs": [log for log in logs if log["log_id"] > params["last_log_id"]],
+    })
+
+    def fake_iter_orders(parameters=None, max_pages=None):
+        if "order_id" in parameters:
+            return iter([order(parameters["order_id"], 0)])
+        # order 2 arrives while the first scan runs
+        logs.append({"log_id": 2, "order_id": 2, "object_id": 7})
+        return iter([order(1, 0)])
+
+    monkeypatch.setattr(bl, "iter_orders", fake_iter_orders)
+    poller = bl.OrderPoller(storage, mode="journal", resync_minutes=0)
+
+    assert [o["order_id"] for o in poller.poll()] == [1]
+    poller.commit({"1"})
+    assert storage.get_state("orders.journal_log_id") == 1
+    assert [o["order_id"] for o in poller.poll()] == [2]
+    storage.close()
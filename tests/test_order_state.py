@@ -0,0 +1,164 @@
+"""Fault injection: crash an order at every step, restart, count the results."""
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+class Crash(Exception):
+    """Stands for the process dying at the injected point."""
+
+
+class Agent:
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.backend = bl.NullBackend()
+        self.sent = []
+        self.armed = False
+        monkeypatch.setattr(bl, "printer", self.backend)
+        self.start()
+
+    def start(self):
+        self.monkeypatch.setattr(bl, "_storage", None)
+        self.monkeypatch.setattr(bl, "_printed_index", None)
+        self.monkeypatch.setattr(bl, "router", bl.PrinterRouter())
+        self.monkeypatch.setattr(bl, "notifier", bl.NotificationWorker(
+            digest_threshold=0, send=lambda text: self.sent.append(text) or True,
+        ))
+
+    def crash_at(self, owner, name, after=False):
+        """Raise ``Crash`` before (or after) ``owner.name`` runs, once armed."""
+        original = getattr(owner, name)
+
+        def faulty(*args, **kwargs):
+            if self.armed and not after:
+                raise Crash(name)
+            result = original(*args, **kwargs)
+            if self.armed and after:
+                raise Crash(name)
+            return result
+
+        self.monkeypatch.setattr(owner, name, faulty)
+        self.armed = True
+
+    def poll(self, order_id, quiet=False):
+        """One cycle of the main loop for a single order."""
+        if order_id in bl.get_printed_index():
+            return
+        data = {"order_id": order_id, "name": "Klient", "products": []}
+        try:
+            bl.handle_order(order_id, [(b"label-" + order_id.encode(), "pdf")], data, quiet)
+        except Crash:
+            pass
+        bl.router.wait(5)
+
+    def restart(self):
+        bl.get_storage().close()
+        self.armed = False
+        self.start()
+        bl.recover_orders()
+        bl.drain_queue(bl.get_printed_index())
+        bl.router.wait(5)
+        while bl.notifier.run_once():
+            pass
+
+    def prints(self, order_id):
+        return sum(
+            docs.count(b"label-" + order_id.encode()) for _, _, docs in self.backend.jobs
+        )
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "state.db"))
+    agent = Agent(monkeypatch)
+    yield agent
+    bl.get_storage().close()
+
+
+def run(agent, quiet=False):
+    agent.poll("1", quiet)
+    agent.restart()
+    # the order is polled again after the restart unless it was recorded
+    agent.poll("1")
+    agent.restart()
+    return agent.prints("1"), len(agent.sent), bl.get_storage().order_state("1")
+
+
+def test_happy_path_prints_and_notifies_once(agent):
+    assert run(agent) == (1, 1, "notified")
+
+
+def test_quiet_hours_order_is_printed_and_notified_once(agent):
+    assert run(agent, quiet=True) == (1, 1, "notified")
+
+
+def test_crash_while_queueing_rolls_back(agent):
+    agent.crash_at(bl, "_set_order_state")
+    agent.poll("1", quiet=True)
+    storage = bl.get_storage()
+    assert storage.order_state("1") == "fetched"
+    assert storage.count_queue() == 0
+    assert "1" not in bl.get_printed_index()
+    agent.restart()
+    agent.poll("1")
+    agent.restart()
+    assert (agent.prints("1"), len(agent.sent)) == (1, 1)
+
+
+def test_crash_after_queueing_prints_from_queue(agent):
+    agent.crash_at(bl.PrinterRouter, "dispatch")
+    assert run(agent) == (1, 1, "notified")
+
+
+def test_crash_after_printing_claimed_labels(agent):
+    agent.crash_at(bl.Storage, "start_printing", after=True)
+    assert run(agent) == (1, 1, "notified")
+
+
+def test_crash_before_print_is_recorded_may_print_twice(agent):
+    agent.crash_at(bl.Storage, "finish_printing")
+    agent.poll("1")
+    assert bl.get_storage().order_state("1") == "printing"
+    agent.restart()
+    # the printer got the job but the agent never learnt; this is the one
+    # window where a label may come out twice
+    assert agent.prints("1") == 2
+    assert len(agent.sent) == 1
+
+
+def test_crash_after_printed_before_notification(agent):
+    agent.crash_at(bl, "notify_order")
+    agent.poll("1")
+    assert bl.get_storage().order_state("1") == "printed"
+    assert run(agent) == (1, 1, "notified")
+
+
+def test_crash_after_notification_is_queued(agent):
+    agent.crash_at(bl.Storage, "enqueue_notification", after=True)
+    assert run(agent) == (1, 1, "notified")
+
+
+def test_failed_print_is_retried_by_drain(agent):
+    agent.backend._send = lambda *a: (_ for _ in ()).throw(bl.PrintError("jam"))
+    agent.poll("1")
+    assert bl.get_storage().order_state("1") == "queued"
+    del agent.backend._send
+    agent.restart()
+    assert (agent.prints("1"), len(agent.sent)) == (1, 1)
+    assert bl.get_storage().order_state("1") == "notified"
+
+
+def test_order_fails_after_max_attempts(agent, monkeypatch):
+    monkeypatch.setattr(bl.config, "QUEUE_MAX_ATTEMPTS", 2)
+    agent.backend._send = lambda *a: (_ for _ in ()).throw(bl.PrintError("jam"))
+    agent.poll("1")
+    agent.restart()
+    storage = bl.get_storage()
+    assert storage.order_state("1") == "failed"
+    assert storage.count_order_states() == {"failed": 1}
+    assert [(i["order_id"], i["status"]) for i in storage.history()[0]] == [("1", "failed")]
+    agent.restart()
+    assert (agent.prints("1"), len(agent.sent)) == (0, 0)
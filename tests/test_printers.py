@@ -0,0 +1,173 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import http.server
+import socketserver
+import struct
+import threading
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+class RawPrinter(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.connections = 0
+        self.received = b""
+        super().__init__(("127.0.0.1", 0), self.Handler)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.server.connections += 1
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                self.server.received += data
+
+
+@pytest.fixture
+def raw_printer():
+    server = RawPrinter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(predicate):
+    import time
+
+    for _ in range(200):
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_make_printer_backend_parses_specs(tmp_path):
+    assert isinstance(bl.make_printer_backend("lp"), bl.LpBackend)
+    assert bl.make_printer_backend("lp:Zebra").printer == "Zebra"
+    sock = bl.make_printer_backend("socket://10.0.0.5")
+    assert (sock.host, sock.port) == ("10.0.0.5", 9100)
+    ipp = bl.make_printer_backend("ipp://cups.local/printers/zebra")
+    assert ipp.url == "http://cups.local:631/printers/zebra"
+    assert bl.make_printer_backend(f"file://{tmp_path}").directory == str(tmp_path)
+    assert isinstance(bl.make_printer_backend("null"), bl.NullBackend)
+    with pytest.raises(ValueError):
+        bl.make_printer_backend("carrier-pigeon")
+
+
+def test_socket_backend_reuses_connection_within_session(raw_printer):
+    statuses = []
+    backend = bl.RawSocketBackend(
+        "127.0.0.1", raw_printer.server_address[1],
+        on_status=lambda *args: statuses.append(args[:2]),
+    )
+    with backend.session():
+        backend.print_job([b"^XA1^XZ"], "zpl", "a")
+        backend.print_job([b"^XA2^XZ"], "zpl", "b")
+    assert wait_for(lambda: raw_printer.received == b"^XA1^XZ^XA2^XZ")
+    assert backend.connections == 1
+    assert statuses == [
+        ("a", "submitted"), ("a", "completed"),
+        ("b", "submitted"), ("b", "completed"),
+    ]
+
+    backend.print_job([b"^XA3^XZ"], "zpl", "c")
+    assert backend.connections == 2
+
+
+def test_socket_backend_reports_failure():
+    statuses = []
+    backend = bl.RawSocketBackend(
+        "127.0.0.1", 1, timeout=1,
+        on_status=lambda *args: statuses.append(args[1]),
+    )
+    with pytest.raises(OSError):
+        backend.print_job([b"x"], "zpl", "dead")
+    assert statuses == ["submitted", "failed"]
+
+
+class IppPrinter(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.client_address, body))
+        request_id = struct.unpack(">I", body[4:8])[0]
+        name = b"job-id"
+        response = (
+            struct.pack(">BBHI", 1, 1, 0x0000, request_id)
+            + b"\x02"
+            + struct.pack(">BH", 0x21, len(name)) + name
+            + struct.pack(">H", 4) + struct.pack(">i", 42)
+            + b"\x03"
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/ipp")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        return
+
+
+def test_ipp_backend_sends_print_job_over_one_connection():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IppPrinter)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    statuses = []
+    backend = bl.IppBackend(
+        f"ipp://127.0.0.1:{server.server_port}/printers/zebra",
+        on_status=lambda *args: statuses.append(args),
+    )
+    try:
+        backend.print_job([b"%PDF-1", b"%PDF-2"], "pdf", "batch")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(server.requests) == 2
+    assert server.requests[0][0] == server.requests[1][0]
+    body = server.requests[0][1]
+    assert struct.unpack(">H", body[2:4])[0] == 0x0002
+    assert b"application/pdf" in body
+    assert body.endswith(b"\x03%PDF-1")
+    assert statuses[-1] == ("batch", "completed", "job-id 42,42")
+
+
+def test_file_backend_and_print_labels(tmp_path, monkeypatch):
+    backend = bl.FileBackend(str(tmp_path / "out"))
+    monkeypatch.setattr(bl, "printer", backend)
+    assert bl.print_labels([(b"^XA", "zpl"), (b"^XZ", "zpl")], "1")
+    files = sorted(os.listdir(tmp_path / "out"))
+    assert len(files) == 1 and files[0].endswith(".zpl")
+    assert (tmp_path / "out" / files[0]).read_bytes() == b"^XA^XZ"
+
+
+def test_lp_backend_uses_no_temp_files(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_run(args, capture_output, input=None, pass_fds=(), timeout=None):
+        assert timeout == bl.PRINT_TIMEOUT
+        calls.append((args, input, [os.readlink(f"/proc/self/fd/{fd}") for fd in pass_fds]))
+        return type("R", (), {"returncode": 0, "stdout": b"request id is X-1", "stderr": b""})()
+
+    monkeypatch.setattr(bl.subprocess, "run", fake_run)
+    backend = bl.LpBackend("Zebra")
+
+    backend.print_job([b"%PDF-one"], "pdf", "label_1")
+    args, data, _ = calls[0]
+    assert args == ["lp", "-d", "Zebra", "-t", "label_1", "-"]
+    assert data == b"%PDF-one"
+
+    backend.print_job([b"%PDF-a", b"%PDF-b"], "pdf", "labels_2")
+    args, data, targets = calls[1]
+    assert data is None
+    assert [a.startswith("/dev/fd/") for a in args[5:]] == [True, True]
+    assert all(t.startswith("/memfd:") for t in targets)
@@ -0,0 +1,63 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import bl_api_print_agent as bl
+
+
+def test_drain_queue_retries_only_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "drain.db"))
+    bl.enqueue_label("1", b"ok", "pdf", {})
+    bl.enqueue_label("2", b"bad", "pdf", {})
+    monkeypatch.setattr(bl, "print_label", lambda data, ext, oid, backend=None: data == b"ok")
+
+    printed = {}
+    bl.drain_queue(printed, batch_size=1)
+    assert bl.router.wait(5)
+
+    assert list(printed) == ["1"]
+    assert [i["order_id"] for i in bl.load_queue()] == ["2"]
+
+
+def test_plan_print_jobs_keeps_orders_together():
+    items = [
+        {"id": 1, "order_id": "a", "ext": "pdf"},
+        {"id": 2, "order_id": "b", "ext": "pdf"},
+        {"id": 3, "order_id": "a", "ext": "pdf"},
+        {"id": 4, "order_id": "c", "ext": "zpl"},
+        {"id": 5, "order_id": "d", "ext": "pdf"},
+        {"id": 6, "order_id": "d", "ext": "pdf"},
+        {"id": 7, "order_id": "d", "ext": "pdf"},
+    ]
+    jobs = [[i["id"] for i in job] for job in bl.plan_print_jobs(items, 2)]
+    assert jobs == [[1, 3], [2], [4], [5, 6], [7]]
+
+
+def test_drain_queue_prints_one_job_per_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "batch.db"))
+    for oid in ("1", "1", "2"):
+        bl.enqueue_label(oid, f"%PDF {oid}".encode(), "pdf", {})
+    bl.enqueue_label("3", b"^XA^XZ", "zpl", {})
+    bl.enqueue_label("3", b"^XA^FDx^XZ", "zpl", {})
+
+    calls = []
+
+    def fake_run(args, capture_output, input=None, pass_fds=(), timeout=None):
+        files = args[args.index("-t") + 2:]
+        if files == ["-"]:
+            docs = [input]
+        else:
+            docs = [open(path, "rb").read() for path in files]
+        calls.append(docs)
+        return type("R", (), {
+            "returncode": 0 if len(calls) == 1 else 1,
+            "stdout": b"",
+            "stderr": b"jam",
+        })()
+
+    monkeypatch.setattr(bl.subprocess, "run", fake_run)
+    printed = {}
+    bl.drain_queue(printed, job_size=10)
+    assert bl.router.wait(5)
+
+    assert calls == [[b"%PDF 1", b"%PDF 1", b"%PDF 2"], [b"^XA^XZ^XA^FDx^XZ"]]
+    assert sorted(printed) == ["1", "2"]
+    assert [i["order_id"] for i in bl.load_queue()] == ["3", "3"]
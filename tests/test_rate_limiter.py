@@ -0,0 +1,50 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import threading
+import time
+
+import bl_api_print_agent as bl
+
+
+def test_rate_limiter_blocks_when_budget_is_used():
+    clock = {"now": 0.0}
+    limiter = bl.RateLimiter(60, burst=2, clock=lambda: clock["now"])
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.usage()["used_last_minute"] == 2
+    assert limiter.usage()["tokens"] == 0
+
+    clock["now"] = 61.0
+    usage = limiter.usage()
+    assert usage["used_last_minute"] == 0
+    assert usage["tokens"] == 2
+
+
+def test_rate_limiter_serves_priority_lanes_first():
+    clock = {"now": 0.0}
+    limiter = bl.RateLimiter(600, burst=1, clock=lambda: clock["now"])
+    limiter.acquire()
+    served = []
+
+    def call(name, priority):
+        limiter.acquire(priority)
+        served.append(name)
+
+    threads = [threading.Thread(target=call, args=("getOrders", 2))]
+    threads[0].start()
+    while limiter.usage()["waiting"] < 1:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=call, args=("getLabel", 0)))
+    threads[1].start()
+    while limiter.usage()["waiting"] < 2:
+        time.sleep(0.001)
+
+    clock["now"] = 0.1
+    while len(served) < 1:
+        time.sleep(0.001)
+    clock["now"] = 0.2
+    for t in threads:
+        t.join(2)
+
+    assert served == ["getLabel", "getOrders"]
+    assert limiter.usage()["throttled"] == 2
@@ -0,0 +1,154 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import json
+import threading
+
+import pytest
+
+import bl_api_print_agent as bl
+
+
+class JammedBackend(bl.PrinterBackend):
+    """Blocks every job until ``release`` is set, then fails it."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def _send(self, documents, extension, title):
+        self.release.wait(5)
+        raise bl.PrintError("paper jam")
+
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    monkeypatch.setattr(bl.config, "DB_FILE", str(tmp_path / "routing.db"))
+    monkeypatch.setattr(bl.config, "STATUS_ID", 1)
+    default = bl.NullBackend()
+    monkeypatch.setattr(bl, "printer", default)
+    routes = bl.load_printer_routes(json.dumps([
+        {"printer": "null", "courier": "dpd", "status": [1, 2]},
+        {"printer": "file://" + str(tmp_path / "zebra"), "ext": ["ZPL"]},
+    ]))
+    router = bl.PrinterRouter(routes)
+    router.dpd = router.workers["null"]
+    router.zebra = router.workers["file://" + str(tmp_path / "zebra")]
+    monkeypatch.setattr(bl, "router", router)
+    return router
+
+
+def test_load_printer_routes_validates_rules(tmp_path):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps([{"printer": "lp:Zebra", "source": "Allegro"}]))
+    assert bl.load_printer_routes(str(path)) == [
+        {"printer": "lp:Zebra", "source": {"allegro"}}
+    ]
+    assert bl.load_printer_routes("") == []
+    with pytest.raises(ValueError):
+        bl.load_printer_routes('[{"courier": "dpd"}]')
+    with pytest.raises(ValueError):
+        bl.load_printer_routes('[{"printer": "null", "carrier": "dpd"}]')
+
+
+def test_router_picks_first_matching_rule(router):
+    dpd = {"status": 2, "courier": "DPD", "platform": "allegro"}
+    assert router.route(dpd, "pdf") is router.dpd
+    assert router.route({**dpd, "status": 3}, "pdf") is router.default
+    assert router.route({**dpd, "status": 3}, "zpl") is router.zebra
+    assert router.route({}, "pdf") is router.default
+    assert router.statuses() == {1, 2}
+
+
+def test_jammed_printer_does_not_block_others(router):
+    jammed = JammedBackend()
+    router.dpd.backend = jammed
+    bl.handle_order("1", [(b"a", "pdf")], {"order_id": "1", "courier": "dpd", "status": 1})
+    bl.handle_order("2", [(b"^XA", "zpl")], {"order_id": "2"})
+    bl.handle_order("3", [(b"c", "pdf")], {"order_id": "3"})
+
+    assert router.wait(timeout=0.5) is False
+    assert set(router.in_flight) == {"1"}
+    assert os.listdir(router.zebra.backend.directory)
+    assert [title for title, _, _ in bl.printer.jobs] == ["label_3"]
+    storage = bl.get_storage()
+    assert storage.order_state("1") == "printing"
+    assert storage.order_state("2") == storage.order_state("3") == "notified"
+
+    jammed.release.set()
+    assert router.wait(timeout=5)
+    queued = storage.load_queue()
+    assert [item["order_id"] for item in queued] == ["1"]
+    assert storage.order_state("1") == "queued"
+    assert "1" in bl.get_printed_index()
+
+
+def test_order_with_mixed_formats_prints_one_job_per_format(router):
+    labels = [(b"a", "pdf"), (b"b", "png"), (b"c", "pdf")]
+    bl.handle_order("1", labels, {"order_id": "1"})
+    assert router.wait(5)
+    assert sorted((ext, docs) for _, ext, docs in bl.printer.jobs) == [
+        ("pdf", [b"a", b"c"]), ("png", [b"b"]),
+    ]
+    assert bl.get_storage().order_state("1") == "notified"
+
+
+def test_drain_queue_routes_queued_labels(router):
+    bl.enqueue_label("1", b"dpd", "pdf", {"courier": "dpd", "status": 1})
+    bl.enqueue_label("2", b"^XA", "zpl", {})
+    bl.enqueue_label("3", b"any", "pdf", {})
+    printed = {}
+    bl.drain_queue(printed)
+    assert router.wait(5)
+
+    assert sorted(printed) == ["1", "2", "3"]
+    assert [docs for _, _, docs in router.dpd.backend.jobs] == [[b"dpd"]]
+    assert [docs for _, _, docs in bl.printer.jobs] == [[b"any"]]
+    assert len(os.listdir(router.zebra.backend.directory)) == 1
+    assert bl.get_storage().count_queue() == 0
+
+
+def test_drain_does_not_wait_for_jammed_printer(router):
+    jammed = JammedBackend()
+    router.dpd.backend = jammed
+    bl.enqueue_label("1", b"dpd", "pdf", {"courier": "dpd", "status": 1})
+    bl.enqueue_label("2", b"any", "pdf", {})
+    printed = {}
+    bl.drain_queue(printed)
+
+    assert router.wait(timeout=0.5) is False
+    assert set(router.in_flight) == {"1"}
+    assert list(printed) == ["2"]
+    storage = bl.get_storage()
+    assert storage.peek_batch() == []
+    bl.drain_queue(printed)
+    assert set(router.in_flight) == {"1"}
+
+    jammed.release.set()
+    assert router.wait(timeout=5)
+    assert [item["order_id"] for item in storage.peek_batch()] == ["1"]
+    assert list(printed) == ["2"]
+
+
+def test_poller_reads_several_statuses_in_one_stream(tmp_path, monkeypatch):
+    storage = bl.Storage(str(tmp_path / "statuses.db"))
+    monkeypatch.setattr(bl.config, "STATUS_ID", 1)
+    orders = [
+        {"order_id": 1, "date_confirmed": 100, "order_status_id": 1},
+        {"order_id": 2, "date_confirmed": 200, "order_status_id": 9},
+        {"order_id": 3, "date_confirmed": 300, "order_status_id": 2},
+    ]
+    calls = []
+
+    def fake_iter_orders(parameters=None, max_pages=None):
+        calls.append(parameters)
+        return iter(orders)
+
+    monkeypatch.setattr(bl, "iter_orders", fake_iter_orders)
+    storage.set_state("orders.watermark", [50, 0])
+    poller = bl.OrderPoller(storage, mode="watermark", resync_minutes=0, statuses=[1, 2])
+
+    assert [o["order_id"] for o in poller.poll()] == [1, 3]
+    assert calls == [{"date_confirmed_from": 50, "status_id": None}]
+    poller.commit({"1", "3"})
+    assert storage.get_state("orders.watermark") == [300, 3]
+    storage.close()
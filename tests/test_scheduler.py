@@ -0,0 +1,102 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import threading
+import time
+from datetime import datetime
+
+import bl_api_print_agent as bl
+
+
+def test_interval_follows_order_rate():
+    clock = {"now": 0.0}
+    sched = bl.PollScheduler(
+        base=60, min_interval=10, max_interval=300, window=600,
+        clock=lambda: clock["now"],
+    )
+    assert sched.record(0) == 90
+    assert sched.record(0) == 135
+    assert sched.record(30) == 10
+    clock["now"] = 60
+    assert sched.record(0) == 10
+    clock["now"] = 700
+    assert sched.record(0) == 15
+    for _ in range(10):
+        sched.record(0)
+    assert sched.interval == 300
+
+
+def test_back_off_is_bounded_by_default(monkeypatch):
+    monkeypatch.setattr(bl.config, "ORDER_POLL_MODE", "journal")
+    sched = bl.PollScheduler(base=60, min_interval=10, clock=lambda: 0.0)
+    assert [sched.record(0) for _ in range(4)] == [90, 120, 120, 120]
+
+    monkeypatch.setattr(bl.config, "ORDER_POLL_MODE", "watermark")
+    monkeypatch.setattr(bl.config, "TRIGGER_TOKEN", None)
+    sched = bl.PollScheduler(base=60, min_interval=10, clock=lambda: 0.0)
+    assert [sched.record(0) for _ in range(5)] == [60] * 5
+
+
+def test_polls_stay_within_base_budget():
+    clock = {"now": 0.0}
+    sched = bl.PollScheduler(
+        base=60, min_interval=10, max_interval=120, window=600,
+        clock=lambda: clock["now"],
+    )
+    polls = 0
+    while clock["now"] < 3600:
+        sched.record(5)
+        polls += 1
+        clock["now"] += sched.interval
+    assert polls <= 3600 / 60 + 600 / 60
+
+
+def test_seconds_until_quiet_end(monkeypatch):
+    monkeypatch.setattr(bl.config, "QUIET_HOURS_END", 22)
+    assert bl.seconds_until_quiet_end(datetime(2024, 1, 1, 21, 59, 30)) == 30
+    assert bl.seconds_until_quiet_end(datetime(2024, 1, 1, 22, 0, 0)) == 86400
+
+
+def test_sleep_stops_at_quiet_hours_end(monkeypatch):
+    sched = bl.PollScheduler(base=60, max_interval=300)
+    sched.interval = 300
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: True)
+    monkeypatch.setattr(bl, "seconds_until_quiet_end", lambda: 20)
+    assert sched.next_sleep() == 21
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    assert sched.next_sleep() == 300
+
+
+def test_trigger_wakes_waiting_loop(monkeypatch):
+    monkeypatch.setattr(bl, "is_quiet_time", lambda: False)
+    sched = bl.PollScheduler(base=30)
+    threading.Timer(0.05, sched.trigger).start()
+    start = time.monotonic()
+    assert sched.wait() is True
+    assert time.monotonic() - start < 5
+
+
+def test_trigger_endpoint_checks_token(monkeypatch):
+    import http.server
+    import urllib.error
+    import urllib.request
+
+    sched = bl.PollScheduler()
+    monkeypatch.setattr(bl, "scheduler", sched)
+    monkeypatch.setattr(bl.config, "TRIGGER_TOKEN", "s3cret")
+    server = http.server.HTTPServer(("127.0.0.1", 0), bl.AgentRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}/trigger"
+    try:
+        try:
+            urllib.request.urlopen(base + "?token=nope", data=b"")
+            assert False, "expected 403"
+        except urllib.error.HTTPError as e:
+            assert e.code == 403
+        assert sched.triggers == 0
+
+        with urllib.request.urlopen(base + "?token=s3cret", data=b"{}") as resp:
+            assert resp.status == 200
+        assert sched.triggers == 1
+    finally:
+        server.shutdown()
+        server.server_close()
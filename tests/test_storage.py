@@ -0,0 +1,83 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import sqlite3
+import threading
+
+import bl_api_print_agent as bl
+
+
+def test_storage_shared_between_threads(tmp_path):
+    storage = bl.Storage(str(tmp_path / "shared.db"))
+    storage.mark_as_printed("main")
+    seen = {}
+
+    def worker():
+        storage.mark_as_printed("http")
+        seen.update(storage.load_printed_orders())
+
+    t = threading.Thread(target=worker)
+    t.start()
+    t.join()
+
+    assert set(seen) == {"main", "http"}
+    mode = storage.connection().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    storage.close()
+
+
+def test_storage_closes_connections_of_finished_threads(tmp_path):
+    storage = bl.Storage(str(tmp_path / "threads.db"))
+
+    def worker():
+        storage.load_printed_orders()
+
+    for _ in range(20):
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+
+    assert len(storage._connections) == 1
+    storage.close()
+    assert storage._connections == set()
+
+
+def test_queue_mark_done_and_failed(tmp_path):
+    storage = bl.Storage(str(tmp_path / "queue_status.db"))
+    first = storage.enqueue("1", b"aaa", "pdf", {})
+    second = storage.enqueue("2", b"bbb", "pdf", {})
+
+    storage.mark_done([first])
+    storage.mark_failed([second], "jam", max_attempts=2)
+    assert [i["id"] for i in storage.peek_batch()] == [second]
+    assert storage.peek_batch()[0]["attempts"] == 1
+
+    storage.mark_failed([second], "jam", max_attempts=2)
+    assert storage.peek_batch() == []
+    assert storage.count_queue() == 0
+    storage.close()
+
+
+def test_label_queue_migration_keeps_old_rows(tmp_path):
+    db = tmp_path / "old.db"
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "CREATE TABLE label_queue(order_id TEXT, label_data TEXT, ext TEXT, last_order_data TEXT)"
+    )
+    conn.execute("INSERT INTO label_queue VALUES ('7', 'eHl6', 'pdf', '{}')")
+    conn.commit()
+    conn.close()
+
+    storage = bl.Storage(str(db))
+    items = storage.peek_batch()
+    assert [i["order_id"] for i in items] == ["7"]
+    assert storage.read_label(items[0]["label_ref"]) == b"xyz"
+    storage.close()
+
+
+def test_identical_labels_share_one_blob(tmp_path):
+    storage = bl.Storage(str(tmp_path / "blobs.db"))
+    storage.enqueue("1", b"same", "pdf", {})
+    storage.enqueue("1", b"same", "pdf", {})
+    count = storage.connection().execute("SELECT COUNT(*) FROM label_blobs").fetchone()[0]
+    assert count == 1
+    storage.close()
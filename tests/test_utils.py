@@ -17,8 +17,8 @@ def test_is_quiet_time(monkeypatch):
             return type("obj", (), {"hour": cls.hour})()
 
     monkeypatch.setattr(bl, "datetime", DummyDateTime)
-    monkeypatch.setattr(bl, "QUIET_HOURS_START", 10)
-    monkeypatch.setattr(bl, "QUIET_HOURS_END", 22)
+    monkeypatch.setattr(bl.config, "QUIET_HOURS_START", 10)
+    monkeypatch.setattr(bl.config, "QUIET_HOURS_END", 22)
 
     DummyDateTime.hour = 11
     assert bl.is_quiet_time() is True
@@ -26,8 +26,8 @@ def test_is_quiet_time(monkeypatch):
     DummyDateTime.hour = 23
     assert bl.is_quiet_time() is False
 
-    monkeypatch.setattr(bl, "QUIET_HOURS_START", 22)
-    monkeypatch.setattr(bl, "QUIET_HOURS_END", 8)
+    monkeypatch.setattr(bl.config, "QUIET_HOURS_START", 22)
+    monkeypatch.setattr(bl.config, "QUIET_HOURS_END", 8)
 
     DummyDateTime.hour = 23
     assert bl.is_quiet_time() is True
@@ -41,7 +41,7 @@ def test_is_quiet_time(monkeypatch):
 
 def test_mark_and_load_printed(tmp_path, monkeypatch):
     db = tmp_path / "test.db"
-    monkeypatch.setattr(bl, "DB_FILE", str(db))
+    monkeypatch.setattr(bl.config, "DB_FILE", str(db))
     bl.ensure_db()
     bl.mark_as_printed("abc")
     orders = bl.load_printed_orders()
@@ -50,7 +50,7 @@ def test_mark_and_load_printed(tmp_path, monkeypatch):
 
 def test_mark_as_printed_deduplicates(tmp_path, monkeypatch):
     db = tmp_path / "test_dupes.db"
-    monkeypatch.setattr(bl, "DB_FILE", str(db))
+    monkeypatch.setattr(bl.config, "DB_FILE", str(db))
     bl.ensure_db()
 
     import datetime as dt
@@ -76,18 +76,21 @@ def test_mark_as_printed_deduplicates(tmp_path, monkeypatch):
 
 def test_queue_roundtrip(tmp_path, monkeypatch):
     db = tmp_path / "queue.db"
-    monkeypatch.setattr(bl, "DB_FILE", str(db))
+    monkeypatch.setattr(bl.config, "DB_FILE", str(db))
     bl.ensure_db()
     item = {
         "order_id": "1",
-        "label_data": "xxx",
+        "label": b"%PDF-1.4",
         "ext": "pdf",
         "last_order_data": {"a": 1},
     }
-    bl.save_queue([item])
+    bl.enqueue_label(
+        item["order_id"], item["label"], item["ext"], item["last_order_data"]
+    )
     loaded = bl.load_queue()
     assert len(loaded) == 1
     assert loaded[0]["order_id"] == item["order_id"]
-    assert loaded[0]["label_data"] == item["label_data"]
+    assert "label_data" not in loaded[0]
+    assert bl.get_storage().read_label(loaded[0]["label_ref"]) == item["label"]
     assert loaded[0]["ext"] == item["ext"]
     assert loaded[0]["last_order_data"] == item["last_order_data"]